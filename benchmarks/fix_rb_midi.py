@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""Micro-benchmark of the track fixing in fix_rb_midi.
+
+Compares `fix_track` against the original three-pass implementation on a synthetic RealBand-like
+song, reporting CPU time and peak memory per file and checking that both fix the tracks the same
+way. Then compares the mido and raw engines of `fix_midi_file` end to end (load, fix, save) and
+checks that their outputs are byte-identical.
+"""
+
+import argparse
+import contextlib
+import copy
+import gc
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import mido
+
+from pybiab.midi_utils import fix_midi_file, fix_track, patch_mido
+
+
+def make_song(num_bars=252, num_tracks=8, notes_per_bar=16, seed=0):
+    """Create a synthetic MIDI file resembling a RealBand render."""
+    rng = random.Random(seed)
+    midi_file = mido.MidiFile(ticks_per_beat=120)
+    for i in range(num_tracks):
+        track = midi_file.add_track('Track {}'.format(i))
+        # RealBand sometimes writes key signatures that mido can't decode
+        track.append(mido.MetaMessage('key_signature', key=None))
+        channels = [i, (i + 1) % 16]
+        for bar in range(num_bars):
+            if bar % 32 == 0:
+                track.append(mido.Message('program_change', channel=i, program=rng.randrange(128)))
+            for _ in range(notes_per_bar):
+                channel = rng.choice(channels)
+                note = rng.randrange(36, 96)
+                track.append(mido.Message('note_on', channel=channel, note=note, velocity=100,
+                                          time=rng.randrange(30)))
+                track.append(mido.Message('note_off', channel=channel, note=note, time=15))
+    return midi_file
+
+
+def save_song(midi_file, path):
+    """Save a song from `make_song`, encoding the invalid key signatures as RealBand would."""
+    midi_file = copy.deepcopy(midi_file)
+    for track in midi_file.tracks:
+        track[:] = [mido.UnknownMetaMessage(0x59, data=(9, 0), time=msg.time)
+                    if msg.type == 'key_signature' and msg.key is None else msg
+                    for msg in track]
+    midi_file.save(path)
+
+
+def fix_tracks_legacy(midi_file):
+    """The original implementation: three passes and a copy of every track."""
+    num_invalid = 0
+    for track in midi_file.tracks:
+        channels = set()
+        for message in track:
+            if isinstance(message, mido.Message):
+                channels.add(message.channel)
+        channels = sorted(channels)
+
+        messages = list(track)
+        track.clear()
+        for message in messages:
+            if isinstance(message, mido.MetaMessage):
+                if message.type == 'key_signature' and message.key is None:
+                    num_invalid += 1
+                    continue
+
+            track.append(message)
+
+            if message.type == 'program_change':
+                track.extend(
+                    mido.Message('program_change', program=message.program, channel=channel, time=0)
+                    for channel in channels if channel != message.channel)
+
+    return any(msg.type in ['note_on', 'note_off']
+               for track in midi_file.tracks for msg in track)
+
+
+def fix_tracks(midi_file):
+    return any([fix_track(track).has_notes for track in midi_file.tracks])
+
+
+def measure(funcs, midi_file, repeat):
+    """Return the best time and the peak traced memory of each function, each run on a fresh
+    copy."""
+    times = {name: [] for name in funcs}
+    for _ in range(repeat):
+        # Interleave the runs so that both implementations see the same conditions
+        for name, func in funcs.items():
+            midi_file_copy = copy.deepcopy(midi_file)
+            gc.collect()
+            gc.disable()
+            start = time.perf_counter()
+            func(midi_file_copy)
+            times[name].append(time.perf_counter() - start)
+            gc.enable()
+
+    results = {}
+    for name, func in funcs.items():
+        midi_file_copy = copy.deepcopy(midi_file)
+        tracemalloc.start()
+        func(midi_file_copy)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results[name] = min(times[name]), peak
+    return results
+
+
+def measure_engines(engines, input_file, output_dir, repeat):
+    """Return the best time of `fix_midi_file` with each engine and the paths of the outputs."""
+    times = {engine: [] for engine in engines}
+    outputs = {engine: os.path.join(output_dir, engine + '.mid') for engine in engines}
+    for _ in range(repeat):
+        for engine in engines:
+            gc.collect()
+            gc.disable()
+            with contextlib.redirect_stderr(io.StringIO()):
+                start = time.perf_counter()
+                fix_midi_file(input_file, outputs[engine], engine=engine)
+                times[engine].append(time.perf_counter() - start)
+            gc.enable()
+    return {engine: min(times[engine]) for engine in engines}, outputs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--bars', type=int, default=252)
+    parser.add_argument('--tracks', type=int, default=8)
+    parser.add_argument('--repeat', type=int, default=30)
+    args = parser.parse_args()
+
+    patch_mido()
+    midi_file = make_song(num_bars=args.bars, num_tracks=args.tracks)
+    num_messages = sum(len(track) for track in midi_file.tracks)
+    print('{} tracks, {} messages'.format(len(midi_file.tracks), num_messages), file=sys.stderr)
+
+    results = measure({'legacy': fix_tracks_legacy, 'fix_track': fix_tracks},
+                      midi_file, args.repeat)
+    for name in results:
+        print('{:12s} {:8.2f} ms {:10.1f} KiB peak'.format(
+            name, results[name][0] * 1000, results[name][1] / 1024))
+
+    print('speedup {:.2f}x, peak memory {:.2f}x'.format(
+        results['legacy'][0] / results['fix_track'][0],
+        results['legacy'][1] / max(results['fix_track'][1], 1)))
+    legacy_file, fixed_file = copy.deepcopy(midi_file), copy.deepcopy(midi_file)
+    fix_tracks_legacy(legacy_file)
+    fix_tracks(fixed_file)
+    if ([list(track) for track in legacy_file.tracks]
+            != [list(track) for track in fixed_file.tracks]):
+        sys.exit('fix_track differs from the original implementation')
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        input_file = os.path.join(tmp_dir, 'input.mid')
+        save_song(midi_file, input_file)
+        times, outputs = measure_engines(['mido', 'raw'], input_file, tmp_dir, args.repeat)
+        for engine in times:
+            print('{:12s} {:8.2f} ms'.format(engine, times[engine] * 1000))
+        with open(outputs['mido'], 'rb') as f_mido, open(outputs['raw'], 'rb') as f_raw:
+            identical = f_mido.read() == f_raw.read()
+    print('speedup {:.2f}x, outputs {}'.format(
+        times['mido'] / times['raw'], 'identical' if identical else 'DIFFERENT'))
+    if not identical:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
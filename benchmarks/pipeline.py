@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+"""End-to-end throughput benchmark of the batch scripts.
+
+Generates a synthetic corpus (song files, style files, ABC files, a song/style manifest and
+RealBand-like MIDI files) and runs `rb_render`, `bb_change_substyle`, `bb_abc2sgu` and
+`fix_rb_midi` on it as separate processes, the first three against the simulated controller (see
+`pybiab.simulated_controller`), so no Windows or real application is needed. The manifest repeats
+songs with several styles and keys and draws the styles from a Zipf distribution, like real job
+lists do, in shuffled order.
+
+For each scenario, the report gives the wall time, the jobs per hour, the total time per stage
+(operation or wait, from the run log), the peak RSS of the largest process and the number of
+restarts. The overhead of a restart is estimated by rendering once more with injected failures
+and dividing the extra job time by the number of restarts. The simulated latencies can be taken
+from a latency profile fitted to the log of a real run with `--fit-profile`, and are scaled by
+`--time-scale`, so the jobs per hour of the simulated scenarios are only comparable between runs
+with the same parameters.
+
+The report can be saved as JSON with `--output` and compared with a saved report with
+`--baseline`, which exits with status 1 if the jobs per hour of any scenario dropped or its peak
+RSS grew by more than `--tolerance`.
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import psutil
+
+from pybiab.instrumentation import RunSummary, read_events
+from pybiab.midi_utils import patch_mido
+from pybiab.simulated_controller import fit_profile, load_profile, save_profile
+from pybiab.song_file import KEYS, MAX_BARS, _encode_rle, parse_song_info
+
+from fix_rb_midi import make_song, save_song
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ['rb_render', 'rb_render_failures', 'bb_change_substyle',
+             'bb_change_substyle_direct', 'bb_abc2sgu', 'fix_rb_midi_raw', 'fix_rb_midi_mido']
+_MAJOR_KEYS = KEYS[1:18]
+
+
+def make_song_bytes(title, style, rng, num_bars=32):
+    """Create a Band-in-a-Box song file using the style file `style` (see `pybiab.song_file`)."""
+    markers = {0: 1}
+    if num_bars > 16:
+        markers[16] = 2
+    chords = {beat: rng.randrange(1, 20) for beat in range(0, num_bars * 4, 2)}
+    roots = {beat: rng.randrange(1, 13) for beat in chords}
+    title = title.encode('latin-1')
+    style = style.encode('ascii')
+    data = (bytes([0xbb, len(title)]) + title + bytes([0, 0, 0, rng.randrange(1, 35)])
+            + rng.randrange(60, 200).to_bytes(2, 'little') + bytes([1])
+            + _encode_rle(markers, MAX_BARS) + _encode_rle(chords, MAX_BARS * 4)
+            + _encode_rle(roots, MAX_BARS * 4) + bytes([1, num_bars, 3])
+            + bytes(rng.randrange(16, 64)) + bytes([len(style)]) + style + bytes(32))
+    parse_song_info(data)  # Make sure the song can be read back
+    return data
+
+
+def make_manifest(num_jobs, num_songs, num_styles, rng, key_rate=.2):
+    """Return a list of `(song, style, key)` jobs with repeated songs and a Zipf distribution of
+    the styles, in random order."""
+    weights = [1 / (rank + 1) for rank in range(num_styles)]
+    jobs = set()
+    max_jobs = num_songs * num_styles * (len(_MAJOR_KEYS) + 1)
+    while len(jobs) < min(num_jobs, max_jobs):
+        song = rng.randrange(num_songs)
+        style, = rng.choices(range(num_styles), weights)
+        key = rng.choice(_MAJOR_KEYS) if rng.random() < key_rate else None
+        jobs.add(('SONG{:04d}.SGU'.format(song), 'STYLE{:03d}.STY'.format(style), key))
+    jobs = sorted(jobs, key=lambda job: (job[0], job[1], job[2] or ''))
+    rng.shuffle(jobs)
+    return jobs
+
+
+def make_corpus(root, num_jobs, num_songs, num_styles, num_midi_files, num_tracks, num_bars,
+                seed=0):
+    """Write the synthetic corpus under `root`."""
+    rng = random.Random(seed)
+    dirs = {name: os.path.join(root, name) for name in ['songs', 'styles', 'abc', 'midi']}
+    for path in dirs.values():
+        os.makedirs(path)
+
+    for i in range(num_styles):
+        with open(os.path.join(dirs['styles'], 'STYLE{:03d}.STY'.format(i)), 'wb') as f:
+            f.write(bytes(rng.randrange(256) for _ in range(4096)))
+    for i in range(num_songs):
+        title = 'Song {}'.format(i)
+        style = 'STYLE{:03d}.STY'.format(rng.randrange(num_styles))
+        with open(os.path.join(dirs['songs'], 'SONG{:04d}.SGU'.format(i)), 'wb') as f:
+            f.write(make_song_bytes(title, style, rng, num_bars=rng.choice([16, 32, 48])))
+        with open(os.path.join(dirs['abc'], 'song{:04d}.abc'.format(i)), 'w') as f:
+            f.write('X:1\nT:{}\nM:4/4\nK:{}\n|C|F|G|C|\n'.format(title, rng.choice('CDEFGAB')))
+
+    with open(os.path.join(root, 'manifest.tsv'), 'w', encoding='utf-8') as f:
+        for song, style, key in make_manifest(num_jobs, num_songs, num_styles, rng):
+            print(song, style, *([key] if key else []), sep='\t', file=f)
+
+    # A few distinct files, copied around, so that generating the corpus stays fast
+    songs = []
+    for i in range(min(num_midi_files, 4)):
+        path = os.path.join(root, 'song{}.mid'.format(i))
+        save_song(make_song(num_bars=num_bars, num_tracks=num_tracks, seed=seed + i), path)
+        with open(path, 'rb') as f:
+            songs.append(f.read())
+    for i in range(num_midi_files):
+        with open(os.path.join(dirs['midi'], 'song{:05d}.mid'.format(i)), 'wb') as f:
+            f.write(songs[i % len(songs)])
+    return dirs
+
+
+def run_scenario(argv, work_dir, log_path=None):
+    """Run a script in a new process and measure it.
+
+    Returns the wall time, the peak RSS in KiB of the largest process (the script or one of its
+    workers) and the `RunSummary` of its log, if any. Raises `RuntimeError` if the script fails
+    other than by failing jobs.
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [REPO_DIR] + ([os.environ['PYTHONPATH']] if os.environ.get('PYTHONPATH') else [])))
+    stderr_path = os.path.join(work_dir, 'stderr.txt')
+    with open(stderr_path, 'wb') as stderr:
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, '-m'] + argv, env=env,
+                                   stdout=subprocess.DEVNULL, stderr=stderr)
+        peak_rss = _wait_peak_rss(process)
+        wall_time = time.perf_counter() - start
+
+    summary = None
+    if log_path is not None and os.path.exists(log_path):
+        summary = RunSummary()
+        for event in read_events(log_path):
+            summary.add(event)
+    # The scripts exit with status 1 when jobs failed, which is part of the results
+    if process.returncode != 0 and not (process.returncode == 1 and summary is not None
+                                        and summary.jobs['failed']):
+        with open(stderr_path, encoding='utf-8', errors='replace') as f:
+            tail = f.read()[-2000:]
+        raise RuntimeError('{} exited with status {}:\n{}'.format(
+            argv[0], process.returncode, tail))
+    return wall_time, peak_rss, summary
+
+
+def _wait_peak_rss(process, interval=.05):
+    """Wait for a `subprocess.Popen` to exit and return the peak RSS in KiB of the largest
+    process in its tree, sampled every `interval` seconds.
+
+    `ru_maxrss` from `wait4` cannot be used: it carries over across fork and exec, so it reports
+    at least the RSS of this (benchmark) process at the time of the fork.
+    """
+    peak_rss = 0
+    try:
+        root = psutil.Process(process.pid)
+    except psutil.NoSuchProcess:
+        root = None
+    while process.poll() is None:
+        if root is not None:
+            try:
+                tree = [root] + root.children(recursive=True)
+            except psutil.NoSuchProcess:
+                tree = []
+            for proc in tree:
+                try:
+                    peak_rss = max(peak_rss, proc.memory_info().rss // 1024)
+                except psutil.Error:
+                    pass
+        time.sleep(interval)
+    return peak_rss
+
+
+def _report(wall_time, peak_rss, summary=None, num_jobs=None):
+    report = dict(wall_time=wall_time, peak_rss_kib=peak_rss)
+    if summary is not None:
+        summary_report = summary.report()
+        report.update(
+            jobs=summary_report['jobs'].get('done', 0),
+            failed=summary_report['jobs'].get('failed', 0),
+            jobs_per_hour=summary_report['jobs_per_hour'],
+            restarts=summary_report['restarts'], retries=summary_report['retries'],
+            stages={name: dict(count=stats['count'], total=stats['total'])
+                    for name, stats in sorted(summary_report['operations'].items())})
+    else:
+        report.update(jobs=num_jobs, jobs_per_hour=num_jobs / wall_time * 3600)
+    return report
+
+
+def run_benchmark(args, tmp_dir):
+    dirs = make_corpus(tmp_dir, args.jobs, args.songs, args.styles, args.midi_files,
+                       args.tracks, args.bars, seed=args.seed)
+    manifest = os.path.join(tmp_dir, 'manifest.tsv')
+    profile = load_profile(args.profile) if args.profile else dict(latency={}, failure_rate={})
+    profile_path = os.path.join(tmp_dir, 'profile.json')
+    save_profile(profile, profile_path)
+    failure_profile_path = os.path.join(tmp_dir, 'profile_failures.json')
+    save_profile(dict(profile, failure_rate=dict(profile['failure_rate'],
+                                                 generate_all=args.failure_rate)),
+                 failure_profile_path)
+    simulate = ['--simulate', str(args.time_scale), '--instance=sim'] + ['--instance=sim'] * (
+        args.workers - 1)
+
+    scenarios = {
+        'rb_render': ['pybiab.scripts.rb_render', dirs['songs'], dirs['styles'], '{out}',
+                      manifest, '--simulate-profile', profile_path, '--key-in-name'] + simulate,
+        'rb_render_failures': ['pybiab.scripts.rb_render', dirs['songs'], dirs['styles'], '{out}',
+                               manifest, '--simulate-profile', failure_profile_path,
+                               '--key-in-name'] + simulate,
+        'bb_change_substyle': ['pybiab.scripts.bb_change_substyle', dirs['songs'], '{out}',
+                               '--simulate-profile', profile_path] + simulate,
+        'bb_change_substyle_direct': ['pybiab.scripts.bb_change_substyle', dirs['songs'],
+                                      '{out}', '--direct'],
+        'bb_abc2sgu': ['pybiab.scripts.bb_abc2sgu', dirs['abc'], '{out}',
+                       '--simulate-profile', profile_path] + simulate,
+        'fix_rb_midi_raw': ['pybiab.scripts.fix_rb_midi', dirs['midi'], '{out}',
+                            '--engine', 'raw', '--jobs', str(args.workers)],
+        'fix_rb_midi_mido': ['pybiab.scripts.fix_rb_midi', dirs['midi'], '{out}',
+                             '--engine', 'mido', '--jobs', str(args.workers)],
+    }
+
+    results = {}
+    for name in args.scenario or SCENARIOS:
+        work_dir = os.path.join(tmp_dir, 'run_' + name)
+        os.makedirs(work_dir)
+        argv = [arg.replace('{out}', os.path.join(work_dir, 'output'))
+                for arg in scenarios[name]]
+        log_path = None
+        if not name.startswith('fix_rb_midi'):
+            log_path = os.path.join(work_dir, 'log.jsonl')
+            argv += ['--log', log_path]
+        print('Running {}'.format(name), file=sys.stderr)
+        wall_time, peak_rss, summary = run_scenario(argv, work_dir, log_path)
+        results[name] = _report(wall_time, peak_rss, summary, num_jobs=args.midi_files)
+
+    if 'rb_render' in results and 'rb_render_failures' in results:
+        ok, failures = results['rb_render'], results['rb_render_failures']
+        if failures['restarts']:
+            failures['restart_overhead'] = max(
+                failures['stages']['job']['total'] - ok['stages']['job']['total'], 0.
+            ) / failures['restarts']
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Compare the results with a baseline, returning a list of regressions."""
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        reference = baseline[name]
+        if result['jobs_per_hour'] < reference['jobs_per_hour'] * (1 - tolerance):
+            regressions.append('{}: {:.1f} jobs/hour, baseline {:.1f}'.format(
+                name, result['jobs_per_hour'], reference['jobs_per_hour']))
+        if result['peak_rss_kib'] > reference['peak_rss_kib'] * (1 + tolerance):
+            regressions.append('{}: {} KiB peak RSS, baseline {} KiB'.format(
+                name, result['peak_rss_kib'], reference['peak_rss_kib']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenario', choices=SCENARIOS, action='append', default=[],
+                        help='scenario to run; repeat to run several (default: all)')
+    parser.add_argument('--jobs', type=int, default=200, help='number of render jobs')
+    parser.add_argument('--songs', type=int, default=60)
+    parser.add_argument('--styles', type=int, default=20)
+    parser.add_argument('--midi-files', type=int, default=400)
+    parser.add_argument('--tracks', type=int, default=8)
+    parser.add_argument('--bars', type=int, default=64)
+    parser.add_argument('--workers', type=int, default=4,
+                        help='number of simulated instances and of fix_rb_midi workers')
+    parser.add_argument('--time-scale', type=float, default=.01,
+                        help='factor applied to the simulated latencies')
+    parser.add_argument('--profile', type=str, default=None,
+                        help='latency profile for the simulated controller')
+    parser.add_argument('--failure-rate', type=float, default=.05,
+                        help='failure rate of the generation in the rb_render_failures scenario')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', '-o', type=str, default=None,
+                        help='JSON file to save the report to')
+    parser.add_argument('--baseline', type=str, default=None,
+                        help='JSON report to compare with')
+    parser.add_argument('--tolerance', type=float, default=.2,
+                        help='relative change from the baseline considered a regression')
+    parser.add_argument('--fit-profile', type=str, nargs=2, metavar=('LOG', 'PROFILE'),
+                        help='only fit a latency profile to the run log of a real run and save it')
+    args = parser.parse_args()
+
+    if args.fit_profile:
+        log_path, profile_path = args.fit_profile
+        save_profile(fit_profile(read_events(log_path)), profile_path)
+        return
+
+    patch_mido()
+    params = {name: getattr(args, name)
+              for name in ['jobs', 'songs', 'styles', 'midi_files', 'tracks', 'bars', 'workers',
+                           'time_scale', 'failure_rate', 'seed']}
+    params['profile'] = load_profile(args.profile) if args.profile else None
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        results = run_benchmark(args, tmp_dir)
+
+    print('{:26s} {:>8s} {:>8s} {:>11s} {:>10s} {:>8s}'.format(
+        'scenario', 'jobs', 'wall', 'jobs/hour', 'peak RSS', 'restarts'))
+    for name, result in results.items():
+        print('{:26s} {:8d} {:7.1f}s {:11.0f} {:7.1f}MiB {:8s}'.format(
+            name, result['jobs'], result['wall_time'], result['jobs_per_hour'],
+            result['peak_rss_kib'] / 1024, str(result.get('restarts', '-'))))
+    if 'restart_overhead' in results.get('rb_render_failures', {}):
+        print('restart overhead {:.2f}s'.format(results['rb_render_failures']['restart_overhead']))
+
+    report = dict(params=params, platform=sys.platform, python=sys.version.split()[0],
+                  results=results)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if json.loads(json.dumps(params)) != baseline['params']:
+            print('Warning: the baseline was run with different parameters', file=sys.stderr)
+        regressions = compare(results, baseline['results'], args.tolerance)
+        for regression in regressions:
+            print('REGRESSION', regression)
+        if regressions:
+            sys.exit(1)
+        print('no regressions against {}'.format(args.baseline))
+
+
+if __name__ == '__main__':
+    main()
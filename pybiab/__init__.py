@@ -1,2 +1,28 @@
-from .biab_controller import BandInABoxController
-from .realband_controller import RealBandController
\ No newline at end of file
+"""Band-in-a-Box/RealBand automation.
+
+The controllers are imported on first access, so that importing the package (or any of the
+modules which do not need them) does not pay for importing the GUI automation libraries.
+"""
+
+import importlib
+
+_EXPORTS = {
+    'BandInABoxController': '.biab_controller',
+    'Controller': '.controller',
+    'RealBandController': '.realband_controller',
+    'SimulatedController': '.simulated_controller',
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+    value = getattr(importlib.import_module(_EXPORTS[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
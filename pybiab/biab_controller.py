@@ -1,22 +1,41 @@
-import re
 import sys
-import traceback
 
-from pywinauto import Application
-from pywinauto.application import ProcessNotFoundError
-from pywinauto.base_wrapper import ElementNotEnabled
-from pywinauto.findwindows import ElementNotFoundError
-from pywinauto.findbestmatch import MatchError
-from pywinauto.timings import wait_until_passes, TimeoutError
-import psutil
-import win32com.client
-
-
-class BandInABoxController:
-    """An object for controlling Band-in-a-Box."""
+try:
+    from pywinauto import Application
+    from pywinauto.application import ProcessNotFoundError
+    from pywinauto.base_wrapper import ElementNotEnabled
+    from pywinauto.findwindows import ElementNotFoundError
+    from pywinauto.findbestmatch import MatchError
+    from pywinauto.timings import TimeoutError
+    import win32com.client
+except ImportError as e:
+    # Not on Windows; fail only when the controller is used
+    _import_error = e
+else:
+    _import_error = None
+
+from .controller import EditController
+from .processes import ProcessTracker
+from .readiness import TimeoutPolicy, WaitRecorder, wait_until, wait_until_passes
+
+
+class BandInABoxController(EditController):
+    """An object for controlling Band-in-a-Box.
+
+    The timeouts of the waits are set by the `TimeoutPolicy` in `timeouts`.
+    """
     _TARGET_VERSION = '2018.0.0.520'
-
-    def __init__(self, binary_path=r'C:\bb\bbw.exe', try_connect=True):
+    _SONG_SETTINGS_CHECKBOXES = {
+        'ending': '&Generate 2 bar Ending for this song',
+        'style_aliases': 'Allow Style Aliases (auto-substtution of style) for this song',
+    }
+
+    def __init__(self, binary_path=r'C:\bb\bbw.exe', try_connect=True, timeouts=None):
+        if _import_error is not None:
+            raise ImportError('{} requires pywinauto and pywin32 (Windows only)'
+                              .format(type(self).__name__)) from _import_error
+        self.wait_stats = WaitRecorder()
+        self.timeouts = timeouts or TimeoutPolicy()
         self.biab_version = _get_exe_version(binary_path)
         if self.biab_version != self._TARGET_VERSION:
             print('This code was written for Band-in-a-Box {}, your version is {}. '
@@ -31,32 +50,50 @@ class BandInABoxController:
                 try_connect = False
         if not try_connect:
             self._app.start(binary_path)
+        self._processes = ProcessTracker(self._app.process)
+        try:
+            self._wait_startup(try_connect)
+        except Exception:
+            if not try_connect:
+                # Do not leave a half-started instance behind
+                self._processes.kill()
+            raise
+
+    def _wait_startup(self, connected):
+        if not connected:
             self._app.wait_cpu_usage_lower(threshold=5)
 
         def get_ready():
             rb_window = self._app.window(class_name='TBandWindow')
-            if rb_window.exists() and rb_window.is_visible() and rb_window.is_enabled():
+            if rb_window.exists(timeout=0) and rb_window.is_visible() and rb_window.is_enabled():
                 return
 
             raise TimeoutError()
 
         wait_until_passes(func=get_ready,
                           exceptions=(ElementNotFoundError, TimeoutError),
-                          timeout=15, retry_interval=1)
+                          timeout=15, name='startup', recorder=self.wait_stats,
+                          policy=self.timeouts)
 
     @property
     def app(self):
         return self._app
 
     def kill(self):
-        self._app.kill()
-        for proc in psutil.process_iter():
-            if proc.name() == 'bbw.exe':
-                print('Killing', proc, file=sys.stderr)
-                try:
-                    proc.kill()
-                except psutil.NoSuchProcess:
-                    traceback.print_exc(file=sys.stderr)
+        self._processes.kill()
+
+    def is_alive(self):
+        return self._processes.is_running()
+
+    def recover(self, timeout=5):
+        """Close any dialogs and wait for the main window to become ready."""
+        try:
+            for dialog in self._app.windows(class_name='#32770', visible_only=True):
+                dialog.close()
+            self.wait_ready(timeout=timeout, name='recover')
+        except (RuntimeError, ElementNotFoundError, MatchError):
+            return False
+        return True
 
     def load_song(self, path):
         """Load a song from the given file."""
@@ -67,7 +104,7 @@ class BandInABoxController:
         """Input a path in the file open dialog."""
         while True:
             dialog = self._app.window(class_name='#32770')
-            dialog.wait('ready')
+            self.wait_window_ready(dialog, name='open_dialog')
 
             # If asked whether to save changes, say no
             try:
@@ -81,20 +118,61 @@ class BandInABoxController:
 
         dialog.Edit1.set_edit_text(path)
         dialog.Edit1.send_keystrokes('{ENTER}')
-        self._wait_ready(timeout=60)
+        # The file has been accepted once the dialog is gone
+        wait_until(lambda: not dialog.exists(timeout=0), timeout=60,
+                   name='open_dialog_close', recorder=self.wait_stats, policy=self.timeouts)
+        self.wait_ready(timeout=60, name='load_song')
 
     def save_song(self, path):
         """Save the current song under the given filename."""
         self.menu_select('File->Save song As')
 
         file_dialog = self._app.window(class_name='#32770')
-        file_dialog.wait('ready')
+        self.wait_window_ready(file_dialog, name='save_dialog')
         file_dialog.Edit1.set_edit_text(path)
         file_dialog.Edit1.send_keystrokes('{ENTER}')
-        self._wait_ready()
-
-    def menu_select(self, path, timeout=10, retry_interval=0.5):
-        self._wait_ready()
+        wait_until(lambda: not file_dialog.exists(timeout=0), timeout=30,
+                   name='save_dialog_close', recorder=self.wait_stats, policy=self.timeouts)
+        self.wait_ready()
+
+    def change_song_settings(self, tempo=None, last_bar=None, **checkboxes):
+        """Change settings of the current song, opening the song settings dialog only once.
+
+        `tempo` and `last_bar` are set in the Title/Chorus dialog. The keyword arguments
+        `ending` and `style_aliases` check or uncheck the respective boxes.
+        """
+        self.menu_select('Edit->Song Form->Settings (for This Song)')
+        dialog = self._app.TSONGSETTINGSDIALOG
+        self.wait_window_ready(dialog, timeout=20, name='settings_dialog')
+        for name, checked in checkboxes.items():
+            checkbox = dialog.children(class_name='TCheckBox',
+                                       title=self._SONG_SETTINGS_CHECKBOXES[name])[0]
+            if checked:
+                checkbox.check_by_click_input()
+            else:
+                checkbox.uncheck_by_click_input()
+
+        if tempo is not None or last_bar is not None:
+            dialog.children(class_name='TButton', title='T&itle/Chorus')[0].click_input()
+            title_dialog = self._app.TSONGSETDIALOG
+            self.wait_window_ready(title_dialog, timeout=20, name='title_dialog')
+            if tempo is not None:
+                title_dialog.TEdit3.set_text(tempo)
+            if last_bar is not None:
+                title_dialog.TEdit1.set_text(last_bar)
+            title_dialog.children(class_name='TButton', title='&OK')[0].click_input()
+            self.wait_window_ready(dialog, timeout=20, name='settings_dialog')
+
+        dialog.children(class_name='TButton', title='&OK')[0].click_input()
+        self.wait_ready(timeout=20)
+
+    def send_chord_sheet_keys(self, keys):
+        """Send keystrokes (in pywinauto's notation) to the chord sheet."""
+        self.wait_ready(timeout=20)
+        self._app.TBandWindow.TCS.send_keystrokes(keys)
+
+    def menu_select(self, path, timeout=10):
+        self.wait_ready()
 
         def select_option():
             self._app.TBandWindow.menu_select(path)
@@ -102,10 +180,23 @@ class BandInABoxController:
         wait_until_passes(func=select_option,
                           exceptions=(ElementNotEnabled, RuntimeError),
                           timeout=timeout,
-                          retry_interval=retry_interval)
+                          name='menu_select', recorder=self.wait_stats, policy=self.timeouts)
+
+    def wait_ready(self, timeout=30, name='ready'):
+        """Wait until the main window is visible and enabled."""
+        self.wait_window_ready(self._app.TBandWindow, timeout=timeout, name=name)
+
+    def wait_window_ready(self, window, timeout=10, name=None):
+        """Wait until a window is visible and enabled, polling adaptively.
+
+        `timeout` is the default for the `TimeoutPolicy`, which times the wait under `name`.
+        """
+        def is_ready():
+            wrapper = window.wrapper_object()
+            return wrapper.is_visible() and wrapper.is_enabled()
 
-    def _wait_ready(self, timeout=30):
-        self._app.TBandWindow.wait('ready', timeout=timeout)
+        wait_until(is_ready, timeout, name=name, recorder=self.wait_stats,
+                   exceptions=(ElementNotFoundError, MatchError), policy=self.timeouts)
 
 
 def _get_exe_version(path):
@@ -0,0 +1,90 @@
+"""The interfaces shared by the application controllers.
+
+`Controller` has the operations which all controllers support. `RenderController` (RealBand)
+adds loading styles and generating the accompaniment and `EditController` (Band-in-a-Box) adds
+editing songs. `SimulatedController` implements both.
+"""
+
+import abc
+
+
+class Controller(abc.ABC):
+    """The interface of an object controlling Band-in-a-Box, RealBand or a simulation of them."""
+
+    @abc.abstractmethod
+    def load_song(self, path):
+        """Load a song from the given file."""
+
+    @abc.abstractmethod
+    def save_song(self, path):
+        """Save the current song under the given filename."""
+
+    @abc.abstractmethod
+    def wait_ready(self, timeout=30):
+        """Wait until the application is ready for the next operation."""
+
+    @abc.abstractmethod
+    def kill(self):
+        """Kill the controlled application."""
+
+    def is_alive(self):
+        """Return whether the controlled application is still running."""
+        return True
+
+    def recover(self):
+        """Try to get the application back to its main window after an operation failed, e.g. by
+        closing stray dialogs.
+
+        Returns whether the application is ready again, in which case the operation can be
+        retried without restarting it.
+        """
+        return False
+
+
+class RenderController(Controller):
+    """The interface of a controller which renders songs with a style (see `Renderer`)."""
+
+    # The keys which `set_key` accepts, as listed in RealBand's Key Signature dialog
+    KEYS = ('C', 'Db', 'D', 'Eb', 'E', 'F', 'Gb', 'G', 'Ab', 'A', 'Bb', 'B',
+            'C#', 'D#', 'F#', 'G#', 'A#',
+            'Cm', 'Dbm', 'Dm', 'Ebm', 'Em', 'Fm', 'Gbm', 'Gm', 'Abm', 'Am', 'Bbm', 'Bm',
+            'C#m', 'D#m', 'F#m', 'G#m', 'A#m')
+
+    @abc.abstractmethod
+    def load_style(self, path):
+        """Load a style from the given file."""
+
+    @abc.abstractmethod
+    def generate_all(self):
+        """Generate all Band-in-a-Box tracks."""
+
+    @abc.abstractmethod
+    def set_key(self, key, transpose=False):
+        """Set the key of the song to one of `KEYS`. Raises `ValueError` for other keys."""
+
+    @property
+    @abc.abstractmethod
+    def key_signature(self):
+        """The key signature of the song."""
+
+    @property
+    @abc.abstractmethod
+    def time_signature(self):
+        """The time signature (meter) of the song."""
+
+    @property
+    @abc.abstractmethod
+    def tempo(self):
+        """The tempo of the song."""
+
+
+class EditController(Controller):
+    """The interface of a controller which edits songs (see `SongEditor`)."""
+
+    @abc.abstractmethod
+    def change_song_settings(self, tempo=None, last_bar=None, **checkboxes):
+        """Change settings in the song settings dialog."""
+
+    @abc.abstractmethod
+    def send_chord_sheet_keys(self, keys):
+        """Send keystrokes to the chord sheet."""
@@ -0,0 +1,127 @@
+"""A long-lived render process which other processes send jobs to.
+
+Starting RealBand (or just connecting to it and importing the GUI automation libraries) takes
+seconds, which dominates the time per job when an external orchestrator renders one job per
+invocation. `serve` keeps a `Renderer` with its controller ready and renders the jobs sent to it
+by `DaemonClient`s over a local connection (a Unix socket, or a named pipe on Windows). The
+client only needs the standard library, so it starts in milliseconds.
+
+Connections are served one at a time, since there is only one controller; other clients wait
+until the current one disconnects. If the environment variable `PYBIAB_DAEMON_AUTHKEY` is set,
+both sides use it to authenticate the connection.
+"""
+
+import os
+import sys
+import tempfile
+from multiprocessing.connection import Client, Listener
+
+AUTHKEY_VARIABLE = 'PYBIAB_DAEMON_AUTHKEY'
+
+
+def default_address():
+    """Return the default address of the daemon for this platform."""
+    if sys.platform == 'win32':
+        return r'\\.\pipe\pybiab-rb-render'
+    return os.path.join(tempfile.gettempdir(), 'pybiab-rb-render.sock')
+
+
+def _authkey():
+    key = os.environ.get(AUTHKEY_VARIABLE)
+    return key.encode('utf-8') if key else None
+
+
+def serve(renderer, address=None):
+    """Render the jobs sent by clients with a `Renderer` until a client asks to stop.
+
+    Raises `RuntimeError` if another daemon is already listening at the address.
+    """
+    # Only the daemon needs the renderer's dependencies
+    from .render_farm import RenderJob
+
+    address = address or default_address()
+    if sys.platform != 'win32' and os.path.exists(address):
+        try:
+            Client(address, authkey=_authkey()).close()
+        except OSError:
+            os.remove(address)  # Left behind by a daemon which did not exit cleanly
+        else:
+            raise RuntimeError('a daemon is already listening at {}'.format(address))
+
+    with Listener(address, authkey=_authkey()) as listener:
+        print('Listening at {}'.format(address), file=sys.stderr)
+        while True:
+            try:
+                conn = listener.accept()
+            except (OSError, EOFError) as e:
+                # E.g. a client which failed to authenticate
+                print('Rejected a connection: {}: {}'.format(type(e).__name__, e),
+                      file=sys.stderr)
+                continue
+            with conn:
+                if _serve_connection(conn, renderer, RenderJob):
+                    return
+
+
+def _serve_connection(conn, renderer, job_type):
+    """Serve the requests of a client. Returns `True` if the client asked to stop the daemon."""
+    while True:
+        try:
+            request = conn.recv()
+        except (EOFError, OSError):
+            return False
+        try:
+            command, *args = request
+        except (TypeError, ValueError):
+            conn.send(('failed', 'malformed request {!r}'.format(request)))
+            continue
+        if command == 'render':
+            try:
+                # A malformed job raises TypeError
+                renderer.render(job_type(*args))
+            except Exception as e:
+                conn.send(('failed', '{}: {}'.format(type(e).__name__, e)))
+            else:
+                conn.send(('done', None))
+        elif command == 'ping':
+            conn.send(('ok', None))
+        elif command == 'stop':
+            conn.send(('ok', None))
+            return True
+        else:
+            conn.send(('failed', 'unknown command {!r}'.format(command)))
+
+
+class DaemonClient:
+    """A connection to a daemon started with `serve`."""
+
+    def __init__(self, address=None):
+        self._conn = Client(address or default_address(), authkey=_authkey())
+
+    def _request(self, *request):
+        self._conn.send(request)
+        return self._conn.recv()
+
+    def render(self, song, style, output_path, key=None):
+        """Render a job (see `RenderJob`), with the song and style paths relative to the
+        daemon's song and style directories and an absolute output path.
+
+        Returns a `(status, error)` pair, where `status` is `'done'` or `'failed'`.
+        """
+        return self._request('render', song, style, key, os.path.abspath(output_path))
+
+    def ping(self):
+        return self._request('ping')
+
+    def stop(self):
+        """Stop the daemon."""
+        return self._request('stop')
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
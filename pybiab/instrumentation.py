@@ -0,0 +1,217 @@
+"""Timing of controller operations and run reports.
+
+A `RunLog` collects events, which are dicts with the kind of the event under `'event'` and the
+UNIX time at which it ended under `'time'`, and optionally writes them to a JSONL file. The kinds
+of events are:
+
+- `'operation'`: a call of a public controller method or a read of a public property, with the
+  `'operation'` name, its `'duration'`, whether it was `'ok'` and the `'error'` if not
+- `'wait'`: a wait inside a controller, with the `'name'` of the wait, its `'duration'`, the
+  number of `'attempts'`, whether it `'timed_out'` and, for waits whose timeout depends on it,
+  the `'context'` (see `readiness.TimeoutPolicy`)
+- `'retry'`: a retry after the controlled application recovered from a failure, with the
+  `'error'` which caused it
+- `'restart'`: a restart of the controlled application, with the `'error'` which caused it
+- `'job'`: a finished job, with a `'job'` description, its `'duration'` including all attempts,
+  its `'status'` (`'done'` or `'failed'`), the number of `'attempts'` and the `'error'`
+
+A `RunSummary` aggregates the events into percentiles per operation, retries, restarts and
+throughput.
+"""
+
+import collections
+import functools
+import json
+import math
+import time
+
+# Public attributes of the controllers which are not operations
+_UNTIMED = frozenset(['app', 'wait_stats'])
+
+DEFAULT_MAX_SAMPLES = 10000
+
+
+class RunSummary:
+    """Aggregates run events into statistics.
+
+    The counts and totals cover all events, but only the last `max_samples` durations of each
+    operation are kept for the percentiles, so that a long run (e.g. `rb_daemon serve`) does not
+    use more and more memory.
+    """
+
+    def __init__(self, max_samples=DEFAULT_MAX_SAMPLES):
+        self.counts = collections.Counter()
+        self.totals = collections.defaultdict(float)
+        self.samples = collections.defaultdict(
+            functools.partial(collections.deque, maxlen=max_samples))
+        self.errors = collections.Counter()
+        self.jobs = collections.Counter()
+        self.retries = 0
+        self.restarts = 0
+        self.start_time = None
+        self.end_time = None
+
+    def add(self, event):
+        end_time = event['time']
+        start_time = end_time - event.get('duration', 0)
+        if self.start_time is None or start_time < self.start_time:
+            self.start_time = start_time
+        if self.end_time is None or end_time > self.end_time:
+            self.end_time = end_time
+
+        kind = event['event']
+        if kind == 'operation':
+            self._add_duration(event['operation'], event['duration'])
+            if not event['ok']:
+                self.errors[event['operation']] += 1
+        elif kind == 'wait':
+            name = 'wait:{}'.format(event['name'])
+            self._add_duration(name, event['duration'])
+            if event['timed_out']:
+                self.errors[name] += 1
+        elif kind == 'retry':
+            self.retries += 1
+        elif kind == 'restart':
+            self.restarts += 1
+        elif kind == 'job':
+            self.jobs[event['status']] += 1
+            self._add_duration('job', event['duration'])
+
+    def _add_duration(self, name, duration):
+        self.counts[name] += 1
+        self.totals[name] += duration
+        self.samples[name].append(duration)
+
+    @property
+    def jobs_per_hour(self):
+        if self.start_time is None or self.end_time <= self.start_time:
+            return 0.
+        return self.jobs['done'] / (self.end_time - self.start_time) * 3600
+
+    def report(self):
+        """Return the statistics as a dict."""
+        operations = {}
+        for name, samples in self.samples.items():
+            durations = sorted(samples)
+            operations[name] = dict(count=self.counts[name], total=self.totals[name],
+                                    p50=_percentile(durations, 50),
+                                    p95=_percentile(durations, 95),
+                                    p99=_percentile(durations, 99),
+                                    errors=self.errors[name])
+        return dict(operations=operations, jobs=dict(self.jobs), retries=self.retries,
+                    restarts=self.restarts,
+                    jobs_per_hour=self.jobs_per_hour)
+
+    def format(self):
+        """Return the statistics as a human-readable table."""
+        report = self.report()
+        lines = ['{:24s} {:>7s} {:>9s} {:>9s} {:>9s} {:>10s} {:>6s}'.format(
+            'operation', 'count', 'p50', 'p95', 'p99', 'total', 'errors')]
+        for name, stats in sorted(report['operations'].items()):
+            lines.append('{:24s} {:7d} {:8.3f}s {:8.3f}s {:8.3f}s {:9.1f}s {:6d}'.format(
+                name, stats['count'], stats['p50'], stats['p95'], stats['p99'], stats['total'],
+                stats['errors']))
+        lines.append('{} jobs done, {} failed, {} retries, {} restarts, {:.1f} jobs/hour'.format(
+            self.jobs['done'], self.jobs['failed'], self.retries, self.restarts,
+            self.jobs_per_hour))
+        return '\n'.join(lines)
+
+
+def _percentile(sorted_values, percent):
+    """Return a percentile of sorted values using the nearest-rank method."""
+    rank = max(math.ceil(percent / 100 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+
+class RunLog:
+    """Collects run events, writing them to a JSONL file and/or passing them to a sink.
+
+    Extra keyword arguments are added to every event (e.g. `worker=1`). A `RunLog` can be used
+    as the `wait_stats` recorder of a controller.
+    """
+
+    def __init__(self, path=None, sink=None, **context):
+        self.summary = RunSummary()
+        self._file = open(path, 'a', encoding='utf-8') if path else None
+        self._sink = sink
+        self._context = context
+
+    def log(self, event, **fields):
+        """Log an event of the given kind."""
+        record = dict(event=event, time=time.time())
+        record.update(self._context)
+        record.update(fields)
+        self.add(record)
+
+    def add(self, record):
+        """Add an event which was already created, e.g. by another process."""
+        self.summary.add(record)
+        if self._file is not None:
+            self._file.write(json.dumps(record) + '\n')
+            self._file.flush()
+        if self._sink is not None:
+            self._sink(record)
+
+    def record(self, name, seconds, timed_out=False, attempts=1, context=None):
+        fields = dict(name=name, duration=seconds, attempts=attempts, timed_out=timed_out)
+        if context is not None:
+            fields['context'] = context
+        self.log('wait', **fields)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def read_events(path):
+    """Read the events from a JSONL file written by `RunLog`."""
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class InstrumentedController:
+    """Wraps a controller, logging every public method call and property read to a `RunLog`.
+
+    The controller's waits are logged too, by making the log its `wait_stats` recorder. The
+    waits recorded before (e.g. waiting for the application to start) are replayed into the log
+    if the recorder supports it. Works with any object, so a mock controller can be used.
+    """
+
+    def __init__(self, controller, log):
+        self._controller = controller
+        self._log = log
+        if hasattr(controller, 'wait_stats'):
+            if hasattr(controller.wait_stats, 'replay'):
+                controller.wait_stats.replay(log)
+            controller.wait_stats = log
+
+    @property
+    def controller(self):
+        return self._controller
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name in _UNTIMED:
+            return getattr(self._controller, name)
+        if isinstance(getattr(type(self._controller), name, None), property):
+            return self._timed(name, getattr, self._controller, name)
+
+        value = getattr(self._controller, name)
+        if not callable(value):
+            return value
+
+        @functools.wraps(value)
+        def timed(*args, **kwargs):
+            return self._timed(name, value, *args, **kwargs)
+        return timed
+
+    def _timed(self, name, func, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            self._log.log('operation', operation=name, duration=time.perf_counter() - start,
+                          ok=False, error='{}: {}'.format(type(e).__name__, e))
+            raise
+        self._log.log('operation', operation=name, duration=time.perf_counter() - start, ok=True)
+        return result
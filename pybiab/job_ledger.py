@@ -0,0 +1,183 @@
+"""A persistent record of the progress of batch jobs.
+
+A `JobLedger` is an SQLite database with one row per job, identified by a string key (normally
+the absolute path of the job's output). Each job is `'queued'`, `'running'`, `'done'` or
+`'failed'`, and the ledger keeps the number of attempts, the time the last attempt started and
+finished and the last error. Finding the jobs left to do is then a single indexed query instead
+of a stat of every output file.
+
+Outputs should be written with `atomic_output`, so that an interrupted job never leaves behind a
+file which looks finished.
+"""
+
+import contextlib
+import glob
+import os
+import sqlite3
+import time
+import urllib.request
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    key TEXT PRIMARY KEY,
+    state TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    started REAL,
+    finished REAL,
+    error TEXT
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state);
+"""
+
+
+class JobLedger:
+    """A job ledger stored in an SQLite database at the given path, opened for reading
+    (`mode='r'`) or for updating (`mode='a'`, creating the database if needed).
+
+    The database can be opened by several processes at once. `is_new` tells whether the
+    database was just created, e.g. to adopt outputs made before the ledger was used.
+    """
+
+    def __init__(self, path, mode='a', timeout=60):
+        if mode not in ('r', 'a'):
+            raise ValueError('invalid mode {!r}'.format(mode))
+        if mode == 'r' and not os.path.exists(path):
+            raise FileNotFoundError('no ledger at {}'.format(path))
+        self.path = path
+        self.mode = mode
+        self.is_new = not os.path.exists(path)
+        if mode == 'r':
+            # Make sure that reading never writes to the database
+            uri = 'file:{}?mode=ro'.format(urllib.request.pathname2url(os.path.abspath(path)))
+            self._conn = sqlite3.connect(uri, timeout=timeout, isolation_level=None, uri=True)
+        else:
+            self._conn = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.executescript(_SCHEMA)
+
+    @staticmethod
+    def key(output_path):
+        """Return the key of a job with the given output path."""
+        return os.path.abspath(output_path)
+
+    def add(self, keys):
+        """Queue jobs which are not in the ledger yet."""
+        with self._transaction():
+            self._conn.executemany('INSERT OR IGNORE INTO jobs (key) VALUES (?)',
+                                   ((key,) for key in keys))
+
+    def done(self):
+        """Return the set of keys of the finished jobs."""
+        return {key for key, in self._conn.execute(
+            "SELECT key FROM jobs WHERE state = 'done'")}
+
+    def mark_done(self, keys):
+        """Mark jobs as finished without running them."""
+        now = time.time()
+        with self._transaction():
+            self._conn.executemany(
+                "INSERT INTO jobs (key, state, finished) VALUES (?, 'done', ?) "
+                "ON CONFLICT (key) DO UPDATE SET state = 'done', finished = excluded.finished, "
+                "error = NULL",
+                ((key, now) for key in keys))
+
+    def start(self, key):
+        """Record the start of an attempt at a job."""
+        with self._transaction():
+            self._conn.execute(
+                "INSERT INTO jobs (key, state, attempts, started) VALUES (?, 'running', 1, ?) "
+                "ON CONFLICT (key) DO UPDATE SET state = 'running', attempts = attempts + 1, "
+                "started = excluded.started, finished = NULL, error = NULL",
+                (key, time.time()))
+
+    def finish(self, key):
+        """Record that a job is done."""
+        self._set_state(key, 'done', None)
+
+    def fail(self, key, error):
+        """Record that an attempt at a job failed with the given error."""
+        self._set_state(key, 'failed', error)
+
+    def _set_state(self, key, state, error):
+        with self._transaction():
+            self._conn.execute(
+                'UPDATE jobs SET state = ?, finished = ?, error = ? WHERE key = ?',
+                (state, time.time(), error, key))
+
+    def counts(self):
+        """Return a dict mapping each state to the number of jobs in it."""
+        return dict(self._conn.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state'))
+
+    def failed(self):
+        """Return a list of `(key, attempts, error)` tuples of the failed jobs."""
+        return self._conn.execute(
+            "SELECT key, attempts, error FROM jobs WHERE state = 'failed' ORDER BY key").fetchall()
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        self._conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self._conn.execute('ROLLBACK')
+            raise
+        self._conn.execute('COMMIT')
+
+    def close(self):
+        self._conn.close()
+
+
+@contextlib.contextmanager
+def atomic_output(path):
+    """Provide a temporary path to write an output to, and move the output into place on success.
+
+    The temporary path has the same extension as `path`. If the application writing the output
+    appends an extension to the temporary path (as Band-in-a-Box does), the extension is kept.
+    On failure, the temporary files are removed.
+    """
+    temp_path = _temp_path(path)
+    _remove_files(temp_path)
+    try:
+        yield temp_path
+    except BaseException:
+        _remove_files(temp_path)
+        raise
+    for temp_file in _find_files(temp_path):
+        os.replace(temp_file, path + temp_file[len(temp_path):])
+
+
+def write_atomic(path, data):
+    """Write bytes to a file atomically, like `atomic_output` but without looking for files with
+    appended extensions, which is much faster in a large directory."""
+    temp_path = _temp_path(path)
+    try:
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(temp_path)
+        raise
+    os.replace(temp_path, path)
+
+
+def find_outputs(path):
+    """Return the existing outputs written to `path` by `atomic_output`, i.e. the file itself or
+    the files with an extension appended to it (as Band-in-a-Box does)."""
+    temp_path = _temp_path(path)
+    return [output for output in _find_files(path) if not output.startswith(temp_path)]
+
+
+def _temp_path(path):
+    root, ext = os.path.splitext(path)
+    return '{}.partial{}'.format(root, ext)
+
+
+def _find_files(path):
+    """Return the file at `path` (if it exists) and the files with an extension appended."""
+    return glob.glob(glob.escape(path)) + glob.glob(glob.escape(path) + '.*')
+
+
+def _remove_files(path):
+    for file in _find_files(path):
+        os.remove(file)
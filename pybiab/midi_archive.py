@@ -0,0 +1,376 @@
+"""A sharded, deduplicated and compressed archive of rendered files.
+
+Millions of small files are slow to list, copy and store. An archive is a directory with a few
+large *shard* files (`shard-00000.pack`, ...) holding the data and an SQLite index
+(`index.sqlite`) with the entries, each of which has a name (normally the path of the file
+relative to the output directory) and optionally the song, style, key and suffix of its job, so
+that the entries can be found by those.
+
+A standard MIDI file is split into its header chunk, which is kept in the index, and its track
+chunks, which are stored as *blobs* identified by their SHA-256 digest. A track which is
+identical in several renders (e.g. the conductor track, or the drums of a style in songs of the
+same length) is thus stored only once. Any other file is stored as a single blob. Blobs are
+compressed with zlib unless that does not make them smaller.
+
+A shard is a sequence of records, each a header (`_RECORD`: a magic number, the digest, the
+codec, the size and the stored length) followed by the stored blob, and is only ever appended
+to. Shards are filled up to `shard_size` and then a new one is started. `iter_shard` reads the
+entries added while a shard was being filled by reading the shard sequentially.
+
+Additions are made in a transaction which is only committed by `commit` (or `close`), after the
+shard is flushed to disk, so an interrupted run leaves the archive as it was at the last commit.
+Several processes can add to the same archive; their transactions are serialized by the index's
+write lock, and each transaction starts by cutting off whatever an interrupted writer appended
+after the last commit. Blobs are never removed, so adding an entry under an existing name
+replaces the entry but not its data.
+"""
+
+import collections
+import hashlib
+import os
+import sqlite3
+import struct
+import zlib
+
+from .job_ledger import write_atomic
+
+DEFAULT_SHARD_SIZE = 1 << 30
+INDEX_NAME = 'index.sqlite'
+
+_SHARD_NAME = 'shard-{:05d}.pack'
+_MAGIC = b'PBAR'
+_RECORD = struct.Struct('<4s32sBII')  # magic, digest, codec, size, stored length
+_RAW, _ZLIB = 0, 1
+_DIGEST_SIZE = 32
+_CACHE_SIZE = 1024
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS shards (
+    id INTEGER PRIMARY KEY,
+    size INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS blobs (
+    digest BLOB PRIMARY KEY,
+    shard INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    codec INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS entries (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    song TEXT,
+    style TEXT,
+    key TEXT,
+    suffix TEXT,
+    shard INTEGER NOT NULL,
+    header BLOB NOT NULL,
+    digests BLOB NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_job ON entries (song, style, key, suffix);
+CREATE INDEX IF NOT EXISTS entries_shard ON entries (shard, id);
+"""
+
+_ENTRY_COLUMNS = 'name, song, style, key, suffix, size'
+
+ArchiveEntry = collections.namedtuple('ArchiveEntry',
+                                      ['name', 'song', 'style', 'key', 'suffix', 'size'])
+
+
+def split_chunks(data):
+    """Split a file into the header kept in the index and the payloads to store as blobs.
+
+    A standard MIDI file is split into its header chunk and one payload per track chunk. Any
+    other file, including a MIDI file with a truncated chunk or trailing bytes, has an empty
+    header and a single payload. The header and the payloads concatenated give back the file.
+    """
+    if data[:4] == b'MThd':
+        chunks, pos = [], 0
+        while pos + 8 <= len(data):
+            end = pos + 8 + int.from_bytes(data[pos+4:pos+8], 'big')
+            if end > len(data):
+                break
+            chunks.append(bytes(data[pos:end]))
+            pos = end
+        if pos == len(data):
+            return chunks[0], chunks[1:]
+    return b'', [bytes(data)]
+
+
+def normalize_name(name):
+    """Return the name under which a relative path is stored, with `/` as the separator."""
+    if os.altsep:
+        name = name.replace(os.sep, os.altsep)
+    return name
+
+
+class MidiArchive:
+    """An archive in the given directory, opened for reading (`mode='r'`) or for adding
+    (`mode='a'`, creating the archive if needed).
+
+    `shard_size` is the size in bytes from which a new shard is started and `level` the zlib
+    compression level.
+    """
+
+    def __init__(self, path, mode='r', shard_size=DEFAULT_SHARD_SIZE, level=6, timeout=60):
+        if mode not in ('r', 'a'):
+            raise ValueError('invalid mode {!r}'.format(mode))
+        index_path = os.path.join(path, INDEX_NAME)
+        if mode == 'a':
+            os.makedirs(path, exist_ok=True)
+        elif not os.path.exists(index_path):
+            raise FileNotFoundError('no archive in {}'.format(path))
+        self.path = path
+        self.mode = mode
+        self.shard_size = shard_size
+        self.level = level
+        self._conn = sqlite3.connect(index_path, timeout=timeout, isolation_level=None)
+        if mode == 'a':
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.executescript(_SCHEMA)
+        self._writer = None
+        self._shard = self._size = None
+        self._readers = {}
+        self._cache = collections.OrderedDict()
+
+    def _shard_path(self, shard):
+        return os.path.join(self.path, _SHARD_NAME.format(shard))
+
+    def _begin(self):
+        """Start a transaction if none is running, and open the last shard for appending."""
+        if self._conn.in_transaction:
+            return
+        if self.mode != 'a':
+            raise ValueError('archive not opened for adding')
+        self._conn.execute('BEGIN IMMEDIATE')
+        row = self._conn.execute('SELECT id, size FROM shards ORDER BY id DESC LIMIT 1').fetchone()
+        if row is None:
+            row = 0, 0
+            self._conn.execute('INSERT INTO shards (id, size) VALUES (?, ?)', row)
+        self._open_shard(*row)
+
+    def _open_shard(self, shard, size):
+        """Open a shard for appending at `size`, cutting off anything written after it."""
+        if self._writer is not None and self._shard != shard:
+            self._writer.close()
+            self._writer = None
+        if self._writer is None:
+            self._writer = open(self._shard_path(shard), 'ab')
+        self._writer.flush()
+        self._writer.truncate(size)
+        self._shard, self._size = shard, size
+
+    def _write_blob(self, digest, payload):
+        if self._size >= self.shard_size:
+            self._conn.execute('INSERT INTO shards (id, size) VALUES (?, 0)', (self._shard + 1,))
+            self._open_shard(self._shard + 1, 0)
+        stored = zlib.compress(payload, self.level)
+        codec = _ZLIB
+        if len(stored) >= len(payload):
+            stored, codec = payload, _RAW
+        offset = self._size + _RECORD.size
+        self._writer.write(_RECORD.pack(_MAGIC, digest, codec, len(payload), len(stored)))
+        self._writer.write(stored)
+        self._size = offset + len(stored)
+        self._conn.execute('INSERT INTO blobs (digest, shard, offset, length, size, codec) '
+                           'VALUES (?, ?, ?, ?, ?, ?)',
+                           (digest, self._shard, offset, len(stored), len(payload), codec))
+        self._conn.execute('UPDATE shards SET size = ? WHERE id = ?', (self._size, self._shard))
+
+    def add(self, name, data, song=None, style=None, key=None, suffix=None):
+        """Add a file's contents under the given name, replacing any entry with the same name.
+
+        The addition is part of the current transaction, see `commit`.
+        """
+        name = normalize_name(name)
+        header, payloads = split_chunks(data)
+        self._begin()
+        self._conn.execute('SAVEPOINT entry')
+        try:
+            digests = []
+            for payload in payloads:
+                digest = hashlib.sha256(payload).digest()
+                if self._conn.execute('SELECT 1 FROM blobs WHERE digest = ?',
+                                      (digest,)).fetchone() is None:
+                    self._write_blob(digest, payload)
+                digests.append(digest)
+            self._conn.execute(
+                'INSERT OR REPLACE INTO entries '
+                '(name, song, style, key, suffix, shard, header, digests, size) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (name, song, style, key, suffix, self._shard, header, b''.join(digests),
+                 len(data)))
+        except BaseException:
+            self._conn.execute('ROLLBACK TO entry')
+            self._conn.execute('RELEASE entry')
+            self._open_shard(*self._conn.execute(
+                'SELECT id, size FROM shards ORDER BY id DESC LIMIT 1').fetchone())
+            raise
+        self._conn.execute('RELEASE entry')
+
+    def add_file(self, name, path, **info):
+        """Add the file at `path` under the given name (see `add`)."""
+        with open(path, 'rb') as f:
+            self.add(name, f.read(), **info)
+
+    def commit(self):
+        """Flush the shard to disk and commit the entries added since the last commit."""
+        if not self._conn.in_transaction:
+            return
+        self._writer.flush()
+        os.fsync(self._writer.fileno())
+        self._conn.execute('COMMIT')
+
+    def __contains__(self, name):
+        return self._conn.execute('SELECT 1 FROM entries WHERE name = ?',
+                                  (normalize_name(name),)).fetchone() is not None
+
+    def __len__(self):
+        return self._conn.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+
+    def find(self, song=None, style=None, key=None, suffix=None):
+        """Return the `ArchiveEntry`s with the given song, style, key and suffix, sorted by name.
+
+        The fields which are `None` match any value.
+        """
+        fields = [(field, value) for field, value in
+                  [('song', song), ('style', style), ('key', key), ('suffix', suffix)]
+                  if value is not None]
+        where = ' AND '.join('{} = ?'.format(field) for field, _ in fields) or '1'
+        return [ArchiveEntry(*row) for row in self._conn.execute(
+            'SELECT {} FROM entries WHERE {} ORDER BY name'.format(_ENTRY_COLUMNS, where),
+            [value for _, value in fields])]
+
+    def entries(self):
+        """Return all `ArchiveEntry`s in the order in which they were added."""
+        return [ArchiveEntry(*row) for row in self._conn.execute(
+            'SELECT {} FROM entries ORDER BY id'.format(_ENTRY_COLUMNS))]
+
+    def shards(self):
+        """Return the numbers of the shards."""
+        return [shard for shard, in self._conn.execute('SELECT id FROM shards ORDER BY id')]
+
+    def read(self, name):
+        """Return the contents of the entry with the given name. Raises `KeyError` if there is
+        none."""
+        row = self._conn.execute('SELECT header, digests FROM entries WHERE name = ?',
+                                 (normalize_name(name),)).fetchone()
+        if row is None:
+            raise KeyError(name)
+        header, digests = row
+        return header + b''.join(self._read_blob(digest) for digest in _split_digests(digests))
+
+    def _read_blob(self, digest):
+        """Read a blob by seeking to it, keeping the most recently read blobs in memory."""
+        try:
+            self._cache.move_to_end(digest)
+            return self._cache[digest]
+        except KeyError:
+            pass
+        shard, offset, length, codec = self._conn.execute(
+            'SELECT shard, offset, length, codec FROM blobs WHERE digest = ?',
+            (digest,)).fetchone()
+        if self._writer is not None:
+            # The blob may have just been written
+            self._writer.flush()
+        if shard not in self._readers:
+            self._readers[shard] = open(self._shard_path(shard), 'rb')
+        reader = self._readers[shard]
+        reader.seek(offset)
+        data = _decode(reader.read(length), codec)
+        self._cache[digest] = data
+        if len(self._cache) > _CACHE_SIZE:
+            self._cache.popitem(last=False)
+        return data
+
+    def iter_shard(self, shard):
+        """Yield an `(ArchiveEntry, data)` pair for each entry added while the given shard was
+        being filled, in the order in which they were added.
+
+        The shard is read sequentially; only blobs which were already stored elsewhere (and
+        deduplicated) are read by seeking.
+        """
+        if self._writer is not None:
+            self._writer.flush()
+        rows = self._conn.execute(
+            'SELECT {}, header, digests FROM entries WHERE shard = ? ORDER BY id'.format(
+                _ENTRY_COLUMNS), (shard,)).fetchall()
+        with open(self._shard_path(shard), 'rb', buffering=1 << 20) as f:
+            pos = 0
+            for row in rows:
+                header, digests = row[-2:]
+                parts = [header]
+                for digest in _split_digests(digests):
+                    blob_shard, offset, length, codec = self._conn.execute(
+                        'SELECT shard, offset, length, codec FROM blobs WHERE digest = ?',
+                        (digest,)).fetchone()
+                    if blob_shard == shard and offset >= pos:
+                        if offset != pos:
+                            f.seek(offset)
+                        parts.append(_decode(f.read(length), codec))
+                        pos = offset + length
+                    else:
+                        parts.append(self._read_blob(digest))
+                yield ArchiveEntry(*row[:-2]), b''.join(parts)
+
+    def __iter__(self):
+        """Yield an `(ArchiveEntry, data)` pair for each entry, one shard after the other."""
+        for shard in self.shards():
+            yield from self.iter_shard(shard)
+
+    def extract(self, output_dir, names=None):
+        """Write entries to files under `output_dir` at the paths given by their names (all
+        entries, streamed shard by shard, if `names` is `None`). Returns the number of files."""
+        if names is None:
+            items = ((entry.name, data) for entry, data in self)
+        else:
+            items = ((name, self.read(name)) for name in names)
+        count = 0
+        for name, data in items:
+            path = os.path.join(output_dir, *name.split('/'))
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            write_atomic(path, data)
+            count += 1
+        return count
+
+    def stats(self):
+        """Return a dict with the numbers of entries, blobs and shards, the total size of the
+        entries and the size of the stored data (the shards and the headers in the index)."""
+        stats = {}
+        stats['entries'], stats['size'], headers = self._conn.execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(LENGTH(header)), 0) '
+            'FROM entries').fetchone()
+        stats['blobs'], = self._conn.execute('SELECT COUNT(*) FROM blobs').fetchone()
+        stats['shards'], shard_size = self._conn.execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM shards').fetchone()
+        stats['stored'] = shard_size + headers
+        return stats
+
+    def format(self):
+        """Return the statistics as a human-readable line."""
+        stats = self.stats()
+        return 'Archive: {} entries, {:.1f} MiB stored in {} shards for {:.1f} MiB of files'.format(
+            stats['entries'], stats['stored'] / 1024 ** 2, stats['shards'],
+            stats['size'] / 1024 ** 2)
+
+    def close(self):
+        """Commit any additions and close the archive."""
+        self.commit()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        for reader in self._readers.values():
+            reader.close()
+        self._readers.clear()
+        self._conn.close()
+
+
+def _split_digests(digests):
+    return [digests[i:i+_DIGEST_SIZE] for i in range(0, len(digests), _DIGEST_SIZE)]
+
+
+def _decode(stored, codec):
+    return zlib.decompress(stored) if codec == _ZLIB else stored
@@ -0,0 +1,232 @@
+"""Quality checks and statistics for a corpus of RealBand MIDI files.
+
+`file_stats` reads one file and returns a dict with its statistics: the number of tracks and the
+notes in each, the notes played by each program (with the drum channel counted separately), the
+programs used on each channel (including the drum kits), the number of invalid key signatures
+and the length in bars. A `CorpusStats` collects these into fixed-size aggregates while the
+per-file records are streamed to a JSONL file, so the memory needed does not grow with the size
+of the corpus. After all files are added, the records are read back once more to flag outliers
+against the aggregates.
+
+A file is flagged as
+
+- `unreadable` if it cannot be parsed (e.g. it is truncated),
+- `empty` if it contains no notes,
+- `invalid_metas` if it contains invalid key signatures (which `fix_rb_midi` removes),
+- `short` if it is shorter than the expected number of bars (if known),
+- `missing_tracks` if it has fewer tracks than most files in the corpus, and
+- `few_notes` or `many_notes` if its number of notes is an outlier (more than `z_threshold`
+  standard deviations from the mean on a log scale).
+"""
+
+import collections
+import json
+import math
+import multiprocessing
+import os
+
+import mido
+import numpy as np
+
+from .midi_utils import fix_track, patch_mido
+
+DRUM_CHANNEL = 9
+DRUMS = 128  # The program index used for the drum channel
+NUM_PROGRAMS = 129
+MAX_BARS = 1024  # Longer files are counted in the last bin of the length histogram
+
+
+def file_stats(path, expected_bars=None):
+    """Compute the statistics of a MIDI file.
+
+    mido must have been patched with `patch_mido`. Unreadable files are reported with the status
+    `'unreadable'` instead of raising an exception.
+    """
+    stats = {'path': path, 'expected_bars': expected_bars}
+    try:
+        midi_file = mido.MidiFile(path)
+    except (OSError, EOFError, ValueError, KeyError, IndexError) as e:
+        stats.update(status='unreadable', error='{}: {}'.format(type(e).__name__, e))
+        return stats
+
+    beats_per_bar = None
+    track_names, track_notes = [], []
+    program_notes = collections.Counter()
+    channel_programs = collections.defaultdict(set)
+    num_invalid = 0
+    length = 0
+    for track in midi_file.tracks:
+        info = fix_track(track)
+        num_invalid += info.num_invalid
+        programs = {}  # channel -> current program
+        num_notes = 0
+        ticks = 0
+        for msg in track:
+            ticks += msg.time
+            if msg.type == 'note_on' and msg.velocity:
+                num_notes += 1
+                program = programs.get(msg.channel, 0)
+                program_notes[DRUMS if msg.channel == DRUM_CHANNEL else program] += 1
+                channel_programs[msg.channel].add(program)
+            elif msg.type == 'program_change':
+                programs[msg.channel] = msg.program
+            elif msg.type == 'time_signature' and beats_per_bar is None:
+                beats_per_bar = msg.numerator * 4 / msg.denominator
+        track_names.append(track.name)
+        track_notes.append(num_notes)
+        length = max(length, ticks)
+
+    stats.update(
+        status='ok' if sum(track_notes) else 'empty',
+        num_tracks=len(midi_file.tracks),
+        track_names=track_names,
+        track_notes=track_notes,
+        num_notes=sum(track_notes),
+        program_notes={str(program): count for program, count in sorted(program_notes.items())},
+        channel_programs={str(channel): sorted(programs)
+                          for channel, programs in sorted(channel_programs.items())},
+        num_invalid=num_invalid,
+        bars=length / (midi_file.ticks_per_beat * (beats_per_bar or 4)),
+    )
+    return stats
+
+
+def _stats_worker(task):
+    path, expected_bars = task
+    return file_stats(path, expected_bars)
+
+
+def compute_stats(tasks, num_workers=None, chunksize=16, batch_size=10000):
+    """Compute the statistics of many MIDI files using a pool of worker processes.
+
+    `tasks` is an iterable of `(path, expected_bars)` pairs; it is consumed in batches of
+    `batch_size`, so it can be a generator over a corpus of any size. Yields the statistics of the
+    files in the order in which they are finished.
+    """
+    tasks = iter(tasks)
+    with multiprocessing.Pool(num_workers, initializer=patch_mido) as pool:
+        while True:
+            batch = [task for _, task in zip(range(batch_size), tasks)]
+            if not batch:
+                return
+            yield from pool.imap_unordered(_stats_worker, batch, chunksize=chunksize)
+
+
+class _RunningMean:
+    """Welford's running mean and variance."""
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.
+        self._m2 = 0.
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+
+    @property
+    def std(self):
+        return math.sqrt(self._m2 / (self.count - 1)) if self.count > 1 else 0.
+
+
+class CorpusStats:
+    """Aggregates the statistics of files (see `file_stats`), streaming the per-file records to
+    `files.jsonl` in `output_dir`.
+
+    The aggregates are saved by `close` as `summary.npz` (the notes per program, the number of
+    files using each program on each channel and histograms of the length in bars and the
+    number of tracks) and `summary.json` (counts of the files by status and flag and the
+    statistics used to find outliers), and the flagged files are listed in `flagged.tsv`.
+    """
+
+    def __init__(self, output_dir, z_threshold=3., bar_tolerance=1.):
+        self.output_dir = output_dir
+        self.z_threshold = z_threshold
+        self.bar_tolerance = bar_tolerance
+        os.makedirs(output_dir, exist_ok=True)
+        self._records = open(os.path.join(output_dir, 'files.jsonl'), 'w', encoding='utf-8')
+
+        self.status_counts = collections.Counter()
+        self.program_notes = np.zeros(NUM_PROGRAMS, dtype=np.int64)
+        self.channel_programs = np.zeros((16, NUM_PROGRAMS), dtype=np.int64)
+        self.bar_histogram = np.zeros(MAX_BARS + 1, dtype=np.int64)
+        self.track_counts = collections.Counter()
+        self.num_invalid = 0
+        self._log_notes = _RunningMean()
+
+    def add(self, stats):
+        """Add the statistics of a file."""
+        print(json.dumps(stats), file=self._records)
+        self.status_counts[stats['status']] += 1
+        if stats['status'] == 'unreadable':
+            return
+        for program, count in stats['program_notes'].items():
+            self.program_notes[int(program)] += count
+        for channel, programs in stats['channel_programs'].items():
+            self.channel_programs[int(channel), programs] += 1
+        self.bar_histogram[min(int(stats['bars']), MAX_BARS)] += 1
+        self.track_counts[stats['num_tracks']] += 1
+        self.num_invalid += stats['num_invalid']
+        if stats['status'] == 'ok':
+            self._log_notes.add(math.log1p(stats['num_notes']))
+
+    def flags(self, stats):
+        """Return the list of flags of a file (see the module docstring)."""
+        if stats['status'] == 'unreadable':
+            return ['unreadable']
+        flags = []
+        if stats['status'] == 'empty':
+            flags.append('empty')
+        if stats['num_invalid']:
+            flags.append('invalid_metas')
+        expected_bars = stats['expected_bars']
+        if expected_bars is not None and stats['bars'] < expected_bars - self.bar_tolerance:
+            flags.append('short')
+        if self.track_counts and stats['num_tracks'] < self.track_counts.most_common(1)[0][0]:
+            flags.append('missing_tracks')
+        if stats['status'] == 'ok' and self._log_notes.std > 0:
+            z = (math.log1p(stats['num_notes']) - self._log_notes.mean) / self._log_notes.std
+            if z < -self.z_threshold:
+                flags.append('few_notes')
+            elif z > self.z_threshold:
+                flags.append('many_notes')
+        return flags
+
+    def close(self):
+        """Flag the outliers and save the summary. Returns the summary as a dict."""
+        self._records.close()
+        flag_counts = collections.Counter()
+        with open(os.path.join(self.output_dir, 'files.jsonl'), encoding='utf-8') as records, \
+                open(os.path.join(self.output_dir, 'flagged.tsv'), 'w', encoding='utf-8') as f:
+            for line in records:
+                stats = json.loads(line)
+                flags = self.flags(stats)
+                flag_counts.update(flags)
+                if flags:
+                    print(stats['path'], ','.join(flags), stats.get('error') or '', sep='\t',
+                          file=f)
+
+        track_histogram = np.zeros(max(self.track_counts, default=0) + 1, dtype=np.int64)
+        for num_tracks, count in self.track_counts.items():
+            track_histogram[num_tracks] = count
+        np.savez_compressed(os.path.join(self.output_dir, 'summary.npz'),
+                            program_notes=self.program_notes,
+                            channel_programs=self.channel_programs,
+                            bar_histogram=self.bar_histogram, track_histogram=track_histogram)
+
+        summary = {
+            'num_files': sum(self.status_counts.values()),
+            'status_counts': dict(self.status_counts),
+            'flag_counts': dict(flag_counts),
+            'num_invalid': self.num_invalid,
+            'num_notes': int(self.program_notes.sum()),
+            'usual_num_tracks': (self.track_counts.most_common(1)[0][0]
+                                 if self.track_counts else None),
+            'log_notes_mean': self._log_notes.mean,
+            'log_notes_std': self._log_notes.std,
+        }
+        with open(os.path.join(self.output_dir, 'summary.json'), 'w', encoding='utf-8') as f:
+            json.dump(summary, f, indent=2)
+        return summary
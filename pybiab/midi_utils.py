@@ -0,0 +1,575 @@
+"""Utilities for working with RealBand-generated MIDI files."""
+
+import collections
+import heapq
+import itertools
+import mmap
+import operator
+import os
+import struct
+import sys
+
+import mido
+
+from .track_select import TrackSelector
+
+
+class MetaSpec_key_signature(mido.midifiles.meta.MetaSpec_key_signature):
+
+    def decode(self, message, data):
+        try:
+            super().decode(message, data)
+        except mido.midifiles.meta.KeySignatureError:
+            message.key = None
+
+    def check(self, name, value):
+        if value is not None:
+            super().check(name, value)
+
+
+def patch_mido():
+    """Make mido decode invalid key signatures as `key=None` instead of raising an error."""
+    mido.midifiles.meta.add_meta_spec(MetaSpec_key_signature)
+
+
+_CHANNEL_MESSAGE_TYPES = frozenset(['note_on', 'note_off', 'polytouch', 'control_change',
+                                    'program_change', 'aftertouch', 'pitchwheel'])
+
+_NOTE_TYPES = frozenset(['note_on', 'note_off'])
+_NON_PROGRAM_CHANNEL_TYPES = _CHANNEL_MESSAGE_TYPES - {'program_change'}
+
+TrackInfo = collections.namedtuple('TrackInfo', ['channels', 'num_invalid', 'has_notes'])
+
+
+def fix_track(track):
+    """Fix a RealBand MIDI track in place.
+
+    Invalid key signatures are removed and every program change is duplicated into all the
+    other channels which appear in the track.
+
+    Returns a `TrackInfo` with the sorted channels of the track, the number of removed messages
+    and whether the track contains any notes.
+    """
+    info, edits = _scan_track(track)
+    _edit_track(track, info.channels, edits)
+    return info
+
+
+def _scan_track(track):
+    """Find what `fix_track` needs to change in a track, in a single pass over its messages.
+
+    Returns the `TrackInfo` of the track and a list of `(position, program change to duplicate,
+    or None to remove the message at the position)` edits, in order.
+    """
+    channels = set()
+    has_notes = False
+    edits = []
+    program_changes = []
+    for position, message in enumerate(track):
+        message_type = message.type
+        if message_type in _NON_PROGRAM_CHANNEL_TYPES:
+            channels.add(message.channel)
+            if not has_notes:
+                has_notes = message_type in _NOTE_TYPES
+        elif message_type == 'program_change':
+            channels.add(message.channel)
+            program_changes.append((position, message))
+        elif message_type == 'key_signature' and message.key is None:
+            edits.append((position, None))
+    channels = sorted(channels)
+
+    num_invalid = len(edits)
+    if len(channels) > 1 and program_changes:
+        edits = list(heapq.merge(edits, program_changes, key=operator.itemgetter(0)))
+    return TrackInfo(channels, num_invalid, has_notes), edits
+
+
+def _edit_track(track, channels, edits):
+    """Apply the edits found by `_scan_track` to a track."""
+    if not edits:
+        return
+    # The unchanged messages are taken from an iterator over the track rather than from slices,
+    # which would copy them (twice for a MidiTrack)
+    messages = iter(track)
+    fixed = []
+    start = 0
+    for position, message in edits:
+        fixed.extend(itertools.islice(messages, position - start))
+        next(messages)
+        if message is not None:
+            fixed.append(message)
+            fixed.extend(
+                mido.Message('program_change', program=message.program, channel=channel, time=0)
+                for channel in channels if channel != message.channel)
+        start = position + 1
+    fixed.extend(messages)
+    track[:] = fixed
+
+
+class UnsupportedMidiError(Exception):
+    """Raised by `fix_midi_bytes` on input which it cannot rewrite exactly like mido would."""
+
+
+RawTrack = collections.namedtuple('RawTrack', ['name', 'data', 'info'])
+
+# Payload lengths of the meta messages which mido would re-encode differently if they were
+# shorter or longer
+_META_LENGTHS = {0x00: 2, 0x20: 1, 0x21: 1, 0x51: 3, 0x54: 5, 0x58: 4}
+
+# Meta message types known to mido; it reads all the others with a delta time of 0
+_KNOWN_META_TYPES = frozenset([0x00, 0x01, 0x02, 0x03, 0x04, 0x05, 0x06, 0x07, 0x09, 0x20, 0x21,
+                               0x2f, 0x51, 0x54, 0x58, 0x59, 0x7f])
+
+
+def _encode_variable_int(value):
+    return bytes(mido.midifiles.meta.encode_variable_int(value))
+
+
+def fix_midi_bytes(data, selector=None, rule_counts=None, ignore_if_empty=False):
+    """Fix a RealBand MIDI file given as bytes (or a memory map) without decoding it with mido.
+
+    The tracks are fixed like with `fix_track` and the events which need no change are copied
+    as they are; the result is byte-identical to loading the file with mido, fixing it and
+    saving it. `UnsupportedMidiError` is raised if this cannot be guaranteed (e.g. the file is
+    malformed or contains events which mido would normalize), in which case the caller should
+    fall back to mido.
+
+    If a `TrackSelector` is given, the tracks it removes are skipped before they are fixed (only
+    their name, and the channels and programs if the selector needs them, are read) and the
+    rules matching each track are counted in `rule_counts` if given. With `ignore_if_empty`, no
+    track is fixed and the list of tracks is empty if none of the kept tracks contains notes.
+
+    Returns the format type, the ticks per beat and a list of `RawTrack`s holding the name, the
+    contents of the MTrk chunk and the `TrackInfo` of each kept track.
+    """
+    try:
+        if data[:4] != b'MThd':
+            raise UnsupportedMidiError('MThd not found')
+        size, midi_type, num_tracks, ticks_per_beat = struct.unpack('>Lhhh', data[4:14])
+        if size < 6:
+            raise UnsupportedMidiError('MThd too short')
+
+        tracks = []
+        pos = 8 + size
+        for i in range(num_tracks):
+            name, size = struct.unpack('>4sL', data[pos:pos+8])
+            if name != b'MTrk':
+                raise UnsupportedMidiError('no MTrk header at start of track')
+            pos += 8 + size
+            if pos > len(data):
+                raise UnsupportedMidiError('truncated track')
+            if selector:
+                first = midi_type == 1 and i == 0
+                name, channels, programs = _summarize_track_bytes(
+                    data, pos - size, pos, selector.needs_messages or first)
+                keep, matched = selector.select(name, channels, programs,
+                                                conductor=first and not channels)
+                if rule_counts is not None:
+                    selector.count_matches(rule_counts, matched)
+                if not keep:
+                    continue
+            tracks.append((pos - size, pos))
+        if ignore_if_empty and not any(_has_notes_bytes(data, start, end)
+                                       for start, end in tracks):
+            return midi_type, ticks_per_beat, []
+        tracks = [_fix_track_bytes(data, start, end) for start, end in tracks]
+    except (IndexError, struct.error) as e:
+        raise UnsupportedMidiError('truncated file') from e
+
+    return midi_type, ticks_per_beat, tracks
+
+
+def write_midi_bytes(file, midi_type, ticks_per_beat, tracks):
+    """Write a MIDI file from the output of `fix_midi_bytes` to a binary file object."""
+    file.write(b'MThd' + struct.pack('>Lhhh', 6, midi_type, len(tracks), ticks_per_beat))
+    for track in tracks:
+        file.write(b'MTrk' + struct.pack('>L', len(track.data)))
+        file.write(track.data)
+
+
+def _summarize_track_bytes(data, start, end, channel_messages=True):
+    """Read the name of the track in `data[start:end]` and, if `channel_messages` is set, the
+    channels and the programs (of the program changes) used in it.
+
+    Returns a `(name, channels, programs)` tuple. Without `channel_messages`, the scan stops at
+    the first track name and the channels and programs are empty.
+    """
+    name = None
+    channels = set()
+    programs = set()
+    status = None
+    pos = start
+    while pos < end:
+        while data[pos] & 0x80:  # Delta time
+            pos += 1
+        pos += 1
+
+        if data[pos] & 0x80:
+            status = data[pos]
+            pos += 1
+        elif status is None or status >= 0xf0:
+            raise UnsupportedMidiError('unexpected running status')
+
+        if status < 0xf0:
+            if channel_messages:
+                channels.add(status & 0x0f)
+                if status & 0xf0 == 0xc0:
+                    programs.add(data[pos])
+            pos += 1 if 0xc0 <= status < 0xe0 else 2
+            continue
+
+        if status == 0xff:
+            meta_type = data[pos]
+            pos += 1
+        elif status != 0xf0 and status != 0xf7:
+            raise UnsupportedMidiError('unsupported status byte 0x{:02x}'.format(status))
+        length = 0
+        while True:
+            byte = data[pos]
+            pos += 1
+            length = (length << 7) | (byte & 0x7f)
+            if not byte & 0x80:
+                break
+        if status == 0xff and meta_type == 0x03 and name is None:
+            name = bytes(data[pos:pos+length]).decode('latin1')
+            if not channel_messages:
+                break
+        pos += length
+        status = None  # Meta and sysex events cancel running status
+
+    return name or '', channels, programs
+
+
+def _has_notes_bytes(data, start, end):
+    """Return whether the track in `data[start:end]` contains any note_on or note_off events,
+    stopping at the first one."""
+    status = None
+    pos = start
+    while pos < end:
+        while data[pos] & 0x80:  # Delta time
+            pos += 1
+        pos += 1
+
+        if data[pos] & 0x80:
+            status = data[pos]
+            pos += 1
+        elif status is None or status >= 0xf0:
+            raise UnsupportedMidiError('unexpected running status')
+
+        if status < 0xa0:
+            return True
+        if status < 0xf0:
+            pos += 1 if 0xc0 <= status < 0xe0 else 2
+            continue
+
+        if status == 0xff:
+            pos += 1
+        elif status != 0xf0 and status != 0xf7:
+            raise UnsupportedMidiError('unsupported status byte 0x{:02x}'.format(status))
+        length = 0
+        while True:
+            byte = data[pos]
+            pos += 1
+            length = (length << 7) | (byte & 0x7f)
+            if not byte & 0x80:
+                break
+        pos += length
+        status = None  # Meta and sysex events cancel running status
+    return False
+
+
+def _fix_track_bytes(data, start, end):
+    """Fix the events in `data[start:end]` and return a `RawTrack`.
+
+    This mirrors reading the track with mido, `fix_track` and writing it with mido: invalid key
+    signatures are dropped with their delta time, end_of_track messages are dropped and their
+    delta time is carried over to the next event, running status is used for consecutive channel
+    messages with the same status byte and a single end_of_track is added at the end.
+    """
+    out = bytearray()
+    name = None
+    channels = set()
+    num_invalid = 0
+    has_notes = False
+    program_changes = []  # [offset in out, program, channel, status fix-up of the next event]
+    last_program_change = None
+
+    copy_from = start  # Input bytes from here up to the current event are yet to be copied
+    in_status = None  # Running status of the input
+    out_status = None  # Running status of the output
+    accum = 0  # Delta time carried over from dropped end_of_track messages
+    pos = start
+    while pos < end:
+        event_start = pos
+
+        byte = data[pos]
+        pos += 1
+        canonical = byte != 0x80  # mido writes the shortest encoding
+        delta = byte & 0x7f
+        while byte & 0x80:
+            byte = data[pos]
+            pos += 1
+            delta = (delta << 7) | (byte & 0x7f)
+
+        status = data[pos]
+        if status < 0x80:
+            explicit = False
+            status = in_status
+            if status is None or status >= 0xf0:
+                raise UnsupportedMidiError('unexpected running status')
+        else:
+            explicit = True
+            pos += 1
+            if status != 0xff:
+                in_status = status
+
+        if status < 0xf0:
+            # Channel message
+            data_start = pos
+            if 0xc0 <= status < 0xe0:
+                pos += 1
+                byte = data[data_start]
+            else:
+                pos += 2
+                byte = data[data_start] | data[data_start+1]
+            if byte & 0x80:
+                raise UnsupportedMidiError('data byte must be in range 0..127')
+            channel = status & 0x0f
+            channels.add(channel)
+            if status < 0xa0:
+                has_notes = True
+
+            write_status = status != out_status
+            if canonical and not accum and write_status == explicit:
+                status_offset = len(out) + data_start - explicit - copy_from
+            else:
+                out += data[copy_from:event_start]
+                out += _encode_variable_int(delta + accum)
+                status_offset = len(out)
+                if write_status:
+                    out.append(status)
+                out += data[data_start:pos]
+                copy_from = pos
+                accum = 0
+            out_status = status
+
+            if last_program_change is not None:
+                # The program change copies inserted before this event may change the running
+                # status, so remember where its status byte is or would be
+                last_program_change[3] = (status_offset, status, write_status)
+            if status & 0xf0 == 0xc0:
+                last_program_change = [len(out) + pos - copy_from, data[data_start], channel, None]
+                program_changes.append(last_program_change)
+            else:
+                last_program_change = None
+            continue
+
+        if status != 0xff and status != 0xf0 and status != 0xf7:
+            raise UnsupportedMidiError('unsupported status byte 0x{:02x}'.format(status))
+
+        if status == 0xff:
+            meta_type = data[pos]
+            pos += 1
+        byte = data[pos]
+        pos += 1
+        canonical = canonical and byte != 0x80
+        length = byte & 0x7f
+        while byte & 0x80:
+            byte = data[pos]
+            pos += 1
+            length = (length << 7) | (byte & 0x7f)
+        data_start = pos
+        pos += length
+        if pos > end:
+            raise UnsupportedMidiError('event crosses the end of the track')
+
+        if status != 0xff:
+            # Sysex; mido strips the start and end bytes and always writes it as F0 ... F7
+            payload = data[data_start:pos]
+            if payload[:1] == b'\xf0':
+                payload = payload[1:]
+            if payload[-1:] == b'\xf7':
+                payload = payload[:-1]
+            if any(byte & 0x80 for byte in payload):
+                raise UnsupportedMidiError('sysex data byte must be in range 0..127')
+            if not (canonical and not accum and status == 0xf0
+                    and data[pos-1] == 0xf7 and (length == 1 or data[data_start] != 0xf0)):
+                out += data[copy_from:event_start]
+                out += _encode_variable_int(delta + accum)
+                out.append(0xf0)
+                out += _encode_variable_int(len(payload) + 1)
+                out += payload
+                out.append(0xf7)
+                copy_from = pos
+                accum = 0
+            out_status = None
+            last_program_change = None
+            continue
+
+        if meta_type == 0x2f:
+            # Drop end_of_track, it is added back at the end
+            out += data[copy_from:event_start]
+            copy_from = pos
+            accum += delta
+            continue
+        if meta_type == 0x59:
+            if length < 2:
+                raise UnsupportedMidiError('key_signature too short')
+            key = data[data_start]
+            if not (key <= 7 or key >= 0x100 - 7) or data[data_start+1] > 1:
+                # Detect and remove invalid messages
+                out += data[copy_from:event_start]
+                copy_from = pos
+                num_invalid += 1
+                continue
+            if length != 2:
+                raise UnsupportedMidiError('key_signature too long')
+        elif meta_type in _META_LENGTHS:
+            if length != _META_LENGTHS[meta_type]:
+                raise UnsupportedMidiError('invalid length of meta message 0x{:02x}'
+                                           .format(meta_type))
+            if meta_type == 0x54 and (data[data_start] >> 5 > 3 or data[data_start+1] > 59
+                                      or data[data_start+2] > 59 or data[data_start+4] > 99):
+                raise UnsupportedMidiError('invalid smpte_offset')
+        elif meta_type == 0x03 and name is None:
+            name = bytes(data[data_start:pos]).decode('latin1')
+        elif meta_type not in _KNOWN_META_TYPES and delta:
+            delta = 0
+            canonical = False
+
+        if not (canonical and not accum):
+            out += data[copy_from:event_start]
+            out += _encode_variable_int(delta + accum)
+            out += bytes([0xff, meta_type])
+            out += _encode_variable_int(length)
+            out += data[data_start:pos]
+            copy_from = pos
+            accum = 0
+        out_status = None
+        last_program_change = None
+
+    if pos != end:
+        raise UnsupportedMidiError('event crosses the end of the track')
+    out += data[copy_from:end]
+    out += _encode_variable_int(accum)
+    out += b'\xff\x2f\x00'
+
+    channels = sorted(channels)
+
+    # Duplicate program changes into all channels in the track, fixing up the status byte of the
+    # following event which might now be (or no longer be) covered by running status.
+    if len(channels) > 1 and program_changes:
+        pieces = []
+        last = 0
+        for offset, program, channel, next_status in program_changes:
+            pieces.append(out[last:offset])
+            copy_status = None
+            for other in channels:
+                if other != channel:
+                    copy_status = 0xc0 | other
+                    pieces.append(bytes([0, copy_status, program]))
+            last = offset
+            if next_status is not None:
+                status_offset, status, written = next_status
+                if (status != copy_status) != written:
+                    pieces.append(out[last:status_offset])
+                    if written:
+                        last = status_offset + 1
+                    else:
+                        pieces.append(bytes([status]))
+                        last = status_offset
+        pieces.append(out[last:])
+        out = b''.join(pieces)
+
+    return RawTrack(name or '', bytes(out), TrackInfo(channels, num_invalid, has_notes))
+
+
+def _load_raw(input_file, selector, rule_counts, ignore_if_empty):
+    with open(input_file, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise UnsupportedMidiError('empty file')
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return fix_midi_bytes(data, selector, rule_counts, ignore_if_empty)
+
+
+def _select_tracks(midi_file, selector, rule_counts):
+    """Return the tracks of a mido `MidiFile` which the selector keeps."""
+    kept = []
+    for i, track in enumerate(midi_file.tracks):
+        first = midi_file.type == 1 and i == 0
+        channels, programs = set(), set()
+        if selector.needs_messages or first:
+            for msg in track:
+                if msg.type == 'program_change':
+                    programs.add(msg.program)
+                if not msg.is_meta and msg.type != 'sysex':
+                    channels.add(msg.channel)
+        keep, matched = selector.select(track.name, channels, programs,
+                                        conductor=first and not channels)
+        if rule_counts is not None:
+            selector.count_matches(rule_counts, matched)
+        if keep:
+            kept.append(track)
+    return kept
+
+
+def fix_midi_file(input_file, output_file, remove_re=(), remove=(), ignore_if_empty=False,
+                  engine='mido', selector=None, rule_counts=None):
+    """Fix a RealBand MIDI file and save it.
+
+    With `engine='raw'`, the file is rewritten directly from its bytes using `fix_midi_bytes`,
+    falling back to mido if this is not possible. The output is the same with both engines.
+
+    The tracks are selected with a `TrackSelector` (to which the track names in `remove` and the
+    regular expressions in `remove_re` are added) before they are fixed, so removed tracks cost
+    next to nothing. The rules matching each track are counted in the `Counter` `rule_counts`
+    if given.
+
+    Returns `False` if the file was ignored because it was empty, `True` otherwise.
+    """
+    if remove_re or remove:
+        selector = TrackSelector((selector.rules if selector else []) +
+                                 TrackSelector.from_args(remove_re=remove_re, remove=remove).rules)
+
+    raw = None
+    if engine == 'raw':
+        # Count the rules separately, so that they are not counted twice if the file has to be
+        # read again with mido
+        raw_counts = collections.Counter()
+        try:
+            raw = _load_raw(input_file, selector, raw_counts, ignore_if_empty)
+        except UnsupportedMidiError as e:
+            print(f'Falling back to mido for {input_file}: {e}', file=sys.stderr)
+        else:
+            if rule_counts is not None:
+                rule_counts.update(raw_counts)
+    elif engine != 'mido':
+        raise ValueError(f'Unknown engine {engine!r}')
+
+    if raw is not None:
+        midi_type, ticks_per_beat, tracks = raw
+        infos = [track.info for track in tracks]
+    else:
+        midi_file = mido.MidiFile(input_file)
+        if selector:
+            midi_file.tracks[:] = _select_tracks(midi_file, selector, rule_counts)
+        scans = [_scan_track(track) for track in midi_file.tracks]
+        infos = [info for info, _ in scans]
+
+    # If all kept tracks are empty (contain no notes), ignore the file before fixing anything
+    if ignore_if_empty and not any(info.has_notes for info in infos):
+        print(f'Ignoring empty file {input_file}', file=sys.stderr)
+        return False
+
+    num_invalid = sum(info.num_invalid for info in infos)
+    if num_invalid:
+        print(f'Removed {num_invalid} invalid messages', file=sys.stderr)
+
+    if raw is not None:
+        with open(output_file, 'wb') as f:
+            write_midi_bytes(f, midi_type, ticks_per_beat, tracks)
+    else:
+        for track, (info, edits) in zip(midi_file.tracks, scans):
+            _edit_track(track, info.channels, edits)
+        midi_file.save(output_file)
+    return True
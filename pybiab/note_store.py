@@ -0,0 +1,187 @@
+"""A columnar, memory-mappable store of the notes in a corpus of RealBand MIDI files.
+
+A store is a directory holding one NumPy array per column (see `COLUMNS`) with the notes of all
+files and tracks concatenated, sorted by track, onset and pitch within each file. It also holds
+`track_offsets.npy` with the index of the first note of each track (and the total number of notes
+at the end), `file_offsets.npy` with the index of the first track of each file in
+`track_offsets` (and the total number of tracks at the end) and `index.json` with the paths,
+ticks per beat and track names of the files.
+"""
+
+import bisect
+import collections
+import json
+import os
+
+import mido
+import numpy as np
+
+from .midi_utils import fix_track
+
+COLUMNS = [
+    ('onset', np.int64),
+    ('duration', np.int64),
+    ('pitch', np.uint8),
+    ('velocity', np.uint8),
+    ('channel', np.uint8),
+    ('program', np.uint8),
+    ('track', np.uint16),
+]
+
+SongNotes = collections.namedtuple('SongNotes',
+                                   ['columns', 'track_counts', 'ticks_per_beat', 'track_names'])
+
+
+def extract_notes(midi_file):
+    """Extract the notes from a `mido.MidiFile` as a `SongNotes`.
+
+    The tracks are fixed in place with `fix_track` first, so that every note is assigned the
+    program it plays under even if RealBand only put the program change in another channel of
+    the track. Program changes apply to their channel in all tracks, in the order in which they
+    would be played back. Notes which are still on at the end of their track end with it.
+    """
+    tracks = midi_file.tracks
+    for track in tracks:
+        fix_track(track)
+
+    program_changes = [[] for _ in range(16)]  # For each channel, a list of (key, program)
+    notes = []  # (onset, duration, pitch, velocity, channel, track index, key)
+    for track_idx, track in enumerate(tracks):
+        tick = 0
+        sounding = collections.defaultdict(collections.deque)
+        for pos, message in enumerate(track):
+            tick += message.time
+            msg_type = message.type
+            if msg_type == 'note_on' and message.velocity > 0:
+                # The key orders events from all tracks like in the merged track
+                sounding[message.channel, message.note].append(
+                    (tick, message.velocity, (tick, track_idx, pos)))
+            elif msg_type == 'note_off' or msg_type == 'note_on':
+                started = sounding.get((message.channel, message.note))
+                if started:
+                    onset, velocity, key = started.popleft()
+                    notes.append((onset, tick - onset, message.note, velocity, message.channel,
+                                  track_idx, key))
+            elif msg_type == 'program_change':
+                program_changes[message.channel].append(((tick, track_idx, pos), message.program))
+
+        for (channel, pitch), started in sounding.items():
+            for onset, velocity, key in started:
+                notes.append((onset, tick - onset, pitch, velocity, channel, track_idx, key))
+
+    for changes in program_changes:
+        changes.sort()
+    change_keys = [[key for key, _ in changes] for changes in program_changes]
+
+    notes.sort(key=lambda note: (note[5], note[0], note[2]))
+    programs = []
+    for note in notes:
+        channel, key = note[4], note[6]
+        i = bisect.bisect_right(change_keys[channel], key)
+        programs.append(program_changes[channel][i - 1][1] if i else 0)
+
+    columns = {}
+    for i, name in enumerate(['onset', 'duration', 'pitch', 'velocity', 'channel']):
+        columns[name] = np.array([note[i] for note in notes], dtype=dict(COLUMNS)[name])
+    columns['program'] = np.array(programs, dtype=np.uint8)
+    columns['track'] = np.array([note[5] for note in notes], dtype=np.uint16)
+    track_counts = np.bincount(columns['track'], minlength=len(tracks))
+
+    return SongNotes(columns, track_counts, midi_file.ticks_per_beat,
+                     [track.name for track in tracks])
+
+
+def read_notes(path):
+    """Read a MIDI file and extract its notes as a `SongNotes`."""
+    return extract_notes(mido.MidiFile(path))
+
+
+def write_note_store(output_dir, songs):
+    """Write a note store from an iterable of `(path, SongNotes)` pairs.
+
+    The columns are streamed to disk as the songs come in, so the whole corpus never needs to
+    be held in memory.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    paths, ticks_per_beat, track_names = [], [], []
+    track_offsets, file_offsets = [0], [0]
+
+    tmp_paths = {name: os.path.join(output_dir, name + '.tmp') for name, _ in COLUMNS}
+    tmp_files = {name: open(tmp_paths[name], 'wb') for name, _ in COLUMNS}
+    try:
+        for path, song in songs:
+            for name, dtype in COLUMNS:
+                song.columns[name].astype(dtype, copy=False).tofile(tmp_files[name])
+            paths.append(path)
+            ticks_per_beat.append(song.ticks_per_beat)
+            track_names.append(song.track_names)
+            for count in song.track_counts:
+                track_offsets.append(track_offsets[-1] + int(count))
+            file_offsets.append(len(track_offsets) - 1)
+    finally:
+        for f in tmp_files.values():
+            f.close()
+
+    num_notes = track_offsets[-1]
+    for name, dtype in COLUMNS:
+        output_path = os.path.join(output_dir, name + '.npy')
+        if num_notes:
+            array = np.lib.format.open_memmap(output_path, mode='w+', dtype=dtype,
+                                              shape=(num_notes,))
+            array[:] = np.memmap(tmp_paths[name], dtype=dtype, mode='r', shape=(num_notes,))
+            array.flush()
+            del array
+        else:
+            np.save(output_path, np.empty(0, dtype=dtype))
+        os.remove(tmp_paths[name])
+
+    np.save(os.path.join(output_dir, 'track_offsets.npy'), np.array(track_offsets, dtype=np.int64))
+    np.save(os.path.join(output_dir, 'file_offsets.npy'), np.array(file_offsets, dtype=np.int64))
+    with open(os.path.join(output_dir, 'index.json'), 'w', encoding='utf-8') as f:
+        json.dump({'paths': paths, 'ticks_per_beat': ticks_per_beat,
+                   'track_names': track_names}, f)
+
+
+class NoteStore:
+    """A note store opened for reading. The arrays are memory-mapped by default."""
+
+    def __init__(self, path, mmap_mode='r'):
+        with open(os.path.join(path, 'index.json'), encoding='utf-8') as f:
+            index = json.load(f)
+        self.paths = index['paths']
+        self.ticks_per_beat = index['ticks_per_beat']
+        self.track_names = index['track_names']
+        self._path_index = {p: i for i, p in enumerate(self.paths)}
+
+        self.columns = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode)
+                        for name, _ in COLUMNS}
+        self.track_offsets = np.load(os.path.join(path, 'track_offsets.npy'))
+        self.file_offsets = np.load(os.path.join(path, 'file_offsets.npy'))
+
+    def __len__(self):
+        return len(self.paths)
+
+    def file_index(self, path):
+        """Return the index of the file with the given path."""
+        return self._path_index[path]
+
+    def num_tracks(self, file):
+        """Return the number of tracks of a file, given by its index or path."""
+        if isinstance(file, str):
+            file = self.file_index(file)
+        return int(self.file_offsets[file + 1] - self.file_offsets[file])
+
+    def notes(self, file, track=None):
+        """Return the notes of a file (or one of its tracks) as a dict of array slices.
+
+        The file is given by its index or path. No data is read until the slices are accessed.
+        """
+        if isinstance(file, str):
+            file = self.file_index(file)
+        first_track, end_track = self.file_offsets[file], self.file_offsets[file + 1]
+        if track is not None:
+            if not 0 <= track < end_track - first_track:
+                raise IndexError('track index out of range')
+            first_track, end_track = first_track + track, first_track + track + 1
+        start, end = self.track_offsets[first_track], self.track_offsets[end_track]
+        return {name: column[start:end] for name, column in self.columns.items()}
@@ -0,0 +1,190 @@
+"""Post-processing rendered MIDI files while the rendering is still running.
+
+A `PostProcessor` fixes each file submitted to it (see `midi_utils.fix_midi_file`) in a pool of
+worker processes and can also read the notes of the fixed files into a note store (see
+`note_store`). The files are passed to the workers through a bounded queue, so `submit` blocks
+when the workers fall behind instead of letting the backlog grow without limit. Rendering a file
+takes seconds while fixing it takes milliseconds, so in practice the post-processing finishes
+right after the last file is rendered.
+"""
+
+import collections
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import traceback
+
+from .midi_archive import MidiArchive
+from .midi_utils import fix_midi_file, patch_mido
+
+
+def _worker_main(worker_id, task_queue, result_queue, fix_kwargs, read):
+    patch_mido()
+    if read:
+        from .note_store import read_notes
+    while True:
+        task = task_queue.get()
+        if task is None:
+            result_queue.put(('exit', worker_id))
+            return
+        input_file, output_file, path, overwrite = task
+        notes = None
+        try:
+            if overwrite or not os.path.exists(output_file):
+                os.makedirs(os.path.dirname(output_file) or '.', exist_ok=True)
+                status = 'done' if fix_midi_file(input_file, output_file, **fix_kwargs) else 'empty'
+            else:
+                status = 'exists'
+            if read and status != 'empty':
+                notes = read_notes(output_file)
+            error = None
+        except Exception as e:
+            traceback.print_exc(file=sys.stderr)
+            status, error = 'failed', '{}: {}'.format(type(e).__name__, e)
+        result_queue.put(('result', worker_id, path, status, error, notes))
+
+
+class PostProcessor:
+    """Fixes (and optionally indexes) MIDI files in worker processes as they are submitted.
+
+    The fixed files are saved in `output_dir` under the relative paths they are submitted with.
+    If `index_dir` is given, their notes are written to a note store there (this requires
+    NumPy). If `archive_dir` is given, the fixed files are then moved into a `MidiArchive` there,
+    named by their relative paths, and if `remove_inputs` is true, each submitted file is removed
+    once its fixed version is in the archive. The other keyword arguments are passed to
+    `fix_midi_file`.
+
+    Each finished file is reported on stderr together with the progress of the whole pipeline.
+    The counts of the statuses (see `fix_midi_files`) are kept in `counts`.
+    """
+
+    def __init__(self, output_dir, index_dir=None, num_workers=None, queue_size=64,
+                 overwrite=False, archive_dir=None, remove_inputs=False, **fix_kwargs):
+        if index_dir is not None:
+            from .note_store import write_note_store
+        self._output_dir = output_dir
+        self._overwrite = overwrite
+        self._archive_dir = archive_dir
+        self._remove_inputs = remove_inputs
+        self._archive_info = {}  # path -> (input file, keyword arguments of MidiArchive.add)
+        self.counts = collections.Counter()
+        self.num_submitted = 0
+
+        self._task_queue = multiprocessing.Queue(queue_size)
+        self._result_queue = multiprocessing.Queue()
+        self._workers = {}
+        for worker_id in range(num_workers or os.cpu_count() or 1):
+            process = multiprocessing.Process(
+                target=_worker_main,
+                args=(worker_id, self._task_queue, self._result_queue, fix_kwargs,
+                      index_dir is not None),
+                daemon=True)
+            process.start()
+            self._workers[worker_id] = process
+
+        if index_dir is not None:
+            target, args = write_note_store, (index_dir, self._collect())
+        else:
+            target, args = collections.deque, (self._collect(), 0)
+        self._collector = threading.Thread(target=target, args=args, daemon=True)
+        self._collector.start()
+
+    def submit(self, input_file, path, **archive_info):
+        """Queue a file for post-processing, blocking while the queue is full.
+
+        `path` is the path of the output relative to the output directory, which is also used to
+        identify the file in the note store and the archive. The keyword arguments are passed to
+        `MidiArchive.add` (e.g. the song and style).
+        """
+        output_file = os.path.join(self._output_dir, path)
+        self.num_submitted += 1
+        if self._archive_dir is not None:
+            self._archive_info[path] = input_file, archive_info
+        if not self._put((input_file, output_file, path, self._overwrite)):
+            raise RuntimeError('all post-processing workers died')
+
+    def _put(self, task):
+        """Put a task in the queue, blocking while it is full as long as any worker is alive.
+
+        Returns whether the task was queued.
+        """
+        while True:
+            try:
+                self._task_queue.put(task, timeout=1)
+                return True
+            except queue.Full:
+                if not any(process.is_alive() for process in self._workers.values()):
+                    # Do not wait for the queued tasks to be flushed when exiting
+                    self._task_queue.cancel_join_thread()
+                    return False
+
+    def _collect(self):
+        """Receive the results from the workers, yielding `(path, notes)` pairs to index."""
+        # The archive is only used in the collector thread
+        archive = MidiArchive(self._archive_dir, 'a') if self._archive_dir is not None else None
+        try:
+            yield from self._receive(archive)
+        finally:
+            if archive is not None:
+                archive.close()
+
+    def _receive(self, archive):
+        running = set(self._workers)
+        num_finished = 0
+        while running:
+            try:
+                message = self._result_queue.get(timeout=1)
+            except queue.Empty:
+                for worker_id in list(running):
+                    if not self._workers[worker_id].is_alive():
+                        print('Post-processing worker {} died with exit code {}'.format(
+                            worker_id, self._workers[worker_id].exitcode), file=sys.stderr)
+                        running.discard(worker_id)
+                continue
+            if message[0] == 'exit':
+                running.discard(message[1])
+                continue
+
+            _, _, path, status, error, notes = message
+            if archive is not None:
+                status, error = self._archive(archive, path, status, error)
+            num_finished += 1
+            self.counts[status] += 1
+            print('post', '{}/{}'.format(num_finished, self.num_submitted), status, path,
+                  *([error] if error else []), sep='\t', file=sys.stderr)
+            if notes is not None:
+                yield path, notes
+
+    def _archive(self, archive, path, status, error):
+        """Move a fixed file into the archive, returning the status and error of the file."""
+        input_file, info = self._archive_info.pop(path, (None, {}))
+        output_file = os.path.join(self._output_dir, path)
+        if status not in ('done', 'exists') or not os.path.exists(output_file):
+            return status, error
+        try:
+            archive.add_file(path, output_file, **info)
+            archive.commit()
+            os.remove(output_file)
+            if self._remove_inputs and input_file is not None and os.path.exists(input_file):
+                os.remove(input_file)
+        except Exception as e:
+            traceback.print_exc(file=sys.stderr)
+            return 'failed', '{}: {}'.format(type(e).__name__, e)
+        return status, error
+
+    def close(self):
+        """Wait for all submitted files to be processed and stop the workers."""
+        for _ in self._workers:
+            if not self._put(None):
+                break
+        self._collector.join()
+        for process in self._workers.values():
+            process.join()
+
+    def format(self):
+        """Return the counts of the statuses as a human-readable line."""
+        return 'Post-processing: ' + ', '.join(
+            '{} {}'.format(self.counts[status], status)
+            for status in ['done', 'empty', 'exists', 'failed'])
@@ -0,0 +1,93 @@
+"""Validating a whole list of render jobs before rendering any of them.
+
+Problems with a job (a malformed line, a missing song or style file, a key which `set_key` does
+not accept, an output path which collides with another job) would otherwise only show up when
+the renderer gets to it, possibly hours into a run and at the cost of restarting RealBand. The
+song and style directories are listed once each instead of checking every path separately.
+"""
+
+import collections
+import os
+
+from .controller import RenderController
+from .render_farm import parse_job_line
+
+VALID_KEYS = frozenset(RenderController.KEYS)
+
+Rejection = collections.namedtuple('Rejection', ['line_number', 'line', 'reason'])
+PreflightResult = collections.namedtuple('PreflightResult', ['jobs', 'rejected'])
+
+
+def list_files(root):
+    """Return the set of paths of all files under `root`, relative to it and normalized with
+    `normalize_path`."""
+    paths = set()
+    for dirpath, _, filenames in os.walk(root):
+        rel_dir = os.path.relpath(dirpath, root)
+        for fname in filenames:
+            paths.add(normalize_path(os.path.join(rel_dir, fname)))
+    return paths
+
+
+def normalize_path(path):
+    """Normalize a relative path for comparison with the output of `list_files`."""
+    return os.path.normcase(os.path.normpath(path))
+
+
+def preflight_jobs(song_style_file, song_dir, style_dir, output_dir, suffix=None,
+                   valid_keys=VALID_KEYS, key_in_name=False):
+    """Read and validate render jobs from a TSV file (see `read_jobs`).
+
+    Returns a `PreflightResult` with the valid `RenderJob`s and a list of `Rejection`s. A job
+    whose output path is the same as that of an earlier job is rejected unless it is an exact
+    duplicate, which is left for `plan_jobs` to drop.
+    """
+    song_files = list_files(song_dir)
+    style_files = list_files(style_dir)
+
+    jobs, rejected = [], []
+    outputs = {}  # normalized output path -> (line number, job)
+    with open(song_style_file, encoding='utf-8') as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.rstrip('\r\n')
+            if not line.strip():
+                continue
+            try:
+                job = parse_job_line(line, output_dir, suffix, key_in_name)
+            except ValueError as e:
+                rejected.append(Rejection(line_number, line, 'malformed line: {}'.format(e)))
+                continue
+
+            reasons = []
+            if not _exists(job.song, song_files):
+                reasons.append('song file not found')
+            if not _exists(job.style, style_files):
+                reasons.append('style file not found')
+            if job.key is not None and job.key not in valid_keys:
+                reasons.append('invalid key {!r}'.format(job.key))
+
+            output = normalize_path(job.output_path)
+            if output in outputs and outputs[output][1] != job:
+                reasons.append('output {} collides with line {}'.format(
+                    os.path.basename(job.output_path), outputs[output][0]))
+
+            if reasons:
+                rejected.append(Rejection(line_number, line, '; '.join(reasons)))
+                continue
+            outputs.setdefault(output, (line_number, job))
+            jobs.append(job)
+    return PreflightResult(jobs, rejected)
+
+
+def _exists(path, listed_files):
+    if os.path.isabs(path):
+        # Not under the listed directory
+        return os.path.isfile(path)
+    return normalize_path(path) in listed_files
+
+
+def write_rejects(file, rejected):
+    """Write rejected lines as TSV, each preceded by its line number and followed by the reason
+    for the rejection."""
+    for rejection in rejected:
+        print(rejection.line_number, rejection.line, rejection.reason, sep='\t', file=file)
@@ -0,0 +1,55 @@
+"""Tracking the processes of a controlled application so that they can be killed precisely."""
+
+import sys
+
+import psutil
+
+
+class ProcessTracker:
+    """Keeps track of a process and its descendants.
+
+    The descendants are recorded whenever `update` is called, so that they can still be killed
+    after the main process has died and they have been orphaned. Killing them does not require
+    scanning all processes on the system.
+    """
+
+    def __init__(self, pid):
+        self._main = psutil.Process(pid)
+        self._processes = {}
+        self._add(self._main)
+        self.update()
+
+    def _add(self, proc):
+        # psutil.Process compares its creation time, so a reused PID is not mistaken for it
+        self._processes.setdefault(proc.pid, proc)
+
+    def update(self):
+        """Record the current descendants of the tracked processes."""
+        for proc in list(self._processes.values()):
+            try:
+                for child in proc.children(recursive=True):
+                    self._add(child)
+            except psutil.Error:
+                pass
+
+    @property
+    def pids(self):
+        return sorted(self._processes)
+
+    def is_running(self):
+        """Return whether the main process is still running."""
+        try:
+            return self._main.is_running() and self._main.status() != psutil.STATUS_ZOMBIE
+        except psutil.Error:
+            return False
+
+    def kill(self):
+        """Kill all tracked processes which are still running."""
+        self.update()
+        for proc in self._processes.values():
+            try:
+                if proc.is_running():
+                    print('Killing', proc, file=sys.stderr)
+                    proc.kill()
+            except psutil.NoSuchProcess:
+                pass
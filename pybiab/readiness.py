@@ -0,0 +1,264 @@
+"""Waiting for the controlled applications with adaptive polling and adaptive timeouts.
+
+Instead of polling at a fixed interval, the conditions are first checked after a few
+milliseconds and then less and less often. The time spent in each kind of wait can be recorded
+with a `WaitRecorder`.
+
+Instead of a fixed timeout, a wait can take its timeout from a `TimeoutPolicy`, which learns how
+long each kind of wait takes (optionally per context, e.g. per style file) and sets the timeout
+at a high percentile of the recent durations plus a margin. A hung application is then detected
+after a few seconds, while waits which are known to take long (e.g. generating a big style) are
+given the time they need. The timeout grows after each timeout in a row, so that a wait which is
+merely slower than usual succeeds when it is retried. The policy can be saved and loaded, so that
+what it learned carries over to the next run.
+"""
+
+import collections
+import json
+import math
+import os
+import time
+
+from .job_ledger import write_atomic
+
+INITIAL_INTERVAL = 0.005
+MAX_INTERVAL = 0.25
+BACKOFF = 1.5
+
+DEFAULT_NUM_TRIALS = 3
+
+
+class WaitTimeout(RuntimeError):
+    """Raised when a wait times out.
+
+    This is a `RuntimeError` like pywinauto's `TimeoutError`, so it is handled the same way.
+    """
+
+
+class WaitRecorder:
+    """Records how long each kind of wait took.
+
+    The last `max_waits` waits are also kept in the order in which they were recorded, so that
+    they can be passed on to another recorder with `replay` (e.g. the waits for the application
+    to start, before the controller is instrumented).
+    """
+
+    def __init__(self, max_waits=100):
+        self.counts = collections.Counter()
+        self.totals = collections.defaultdict(float)
+        self.maxima = {}
+        self.attempts = collections.Counter()
+        self.timeouts = collections.Counter()
+        self._waits = collections.deque(maxlen=max_waits)
+
+    def record(self, name, seconds, timed_out=False, attempts=1, context=None):
+        self.counts[name] += 1
+        self.totals[name] += seconds
+        self.maxima[name] = max(self.maxima.get(name, seconds), seconds)
+        self.attempts[name] += attempts
+        if timed_out:
+            self.timeouts[name] += 1
+        self._waits.append((name, seconds, timed_out, attempts, context))
+
+    def replay(self, recorder):
+        """Record the waits kept so far in another recorder (e.g. a `RunLog`) and forget them."""
+        for name, seconds, timed_out, attempts, context in self._waits:
+            recorder.record(name, seconds, timed_out=timed_out, attempts=attempts,
+                            context=context)
+        self._waits.clear()
+
+    def summary(self):
+        """Return a dict mapping each wait name to its count, total, mean and max duration, the
+        number of times the condition was checked and the number of timeouts."""
+        return {name: dict(count=count, total=self.totals[name],
+                           mean=self.totals[name] / count, max=self.maxima[name],
+                           attempts=self.attempts[name], timeouts=self.timeouts[name])
+                for name, count in self.counts.items()}
+
+
+class TimeoutPolicy:
+    """Sets the timeouts of waits from the durations observed so far.
+
+    The durations of the last `window` successful waits are kept per wait name and per `(name,
+    context)`. Once there are `min_samples` of them, the timeout is the `percentile` of the
+    durations times `factor` plus `margin`, clamped to `min_timeout` and `max_timeout`; the
+    context's durations are used if there are enough of them, otherwise those of all contexts.
+    Before that, the default timeout given by the caller is used. After `n` timeouts in a row,
+    the timeout is multiplied by `backoff ** n` (up to `max_timeout`, or the default if that is
+    longer).
+
+    The policy also holds the number of attempts which `Renderer` makes at each job. If `path`
+    is given and exists, the durations are loaded from it; `save` writes them back.
+    """
+
+    def __init__(self, path=None, percentile=99., factor=1.5, margin=2., min_samples=10,
+                 window=100, min_timeout=5., max_timeout=600., backoff=2.,
+                 num_trials=DEFAULT_NUM_TRIALS):
+        self.path = path
+        self.percentile = percentile
+        self.factor = factor
+        self.margin = margin
+        self.min_samples = min_samples
+        self.window = window
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.backoff = backoff
+        self.num_trials = num_trials
+        self._durations = {}  # (name, context) -> deque of durations
+        self._timeouts_in_row = collections.Counter()  # (name, context) -> count
+        if path is not None and os.path.exists(path):
+            self.load(path)
+
+    def timeout(self, name, default, context=None):
+        """Return the timeout of a wait for which the caller would use `default`."""
+        key = (name, context)
+        durations = self._durations.get(key, ())
+        if len(durations) < self.min_samples:
+            durations = self._durations.get((name, None), ())
+        if len(durations) < self.min_samples:
+            timeout = default
+        else:
+            durations = sorted(durations)
+            rank = max(math.ceil(self.percentile / 100 * len(durations)), 1)
+            timeout = min(max(durations[rank - 1] * self.factor + self.margin, self.min_timeout),
+                          self.max_timeout)
+        timeouts_in_row = max(self._timeouts_in_row[key], self._timeouts_in_row[name, None])
+        if timeouts_in_row:
+            timeout = min(timeout * self.backoff ** timeouts_in_row,
+                          max(self.max_timeout, default))
+        return timeout
+
+    def record(self, name, seconds, timed_out=False, attempts=1, context=None):
+        """Record the duration of a wait (the signature is that of `WaitRecorder.record`)."""
+        keys = [(name, None)] + ([(name, context)] if context is not None else [])
+        for key in keys:
+            if timed_out:
+                # The duration is only a lower bound, so it is not added
+                self._timeouts_in_row[key] += 1
+                continue
+            self._timeouts_in_row.pop(key, None)
+            durations = self._durations.get(key)
+            if durations is None:
+                durations = self._durations[key] = collections.deque(maxlen=self.window)
+            durations.append(seconds)
+
+    def add(self, event):
+        """Record a `'wait'` event of a `RunLog` (e.g. one logged by another process)."""
+        if event.get('event') == 'wait':
+            self.record(event['name'], event['duration'], event['timed_out'],
+                        context=event.get('context'))
+
+    def load(self, path):
+        """Add the durations saved in a file by `save`."""
+        with open(path, encoding='utf-8') as f:
+            saved = json.load(f)
+        for entry in saved['durations']:
+            durations = self._durations.setdefault(
+                (entry['name'], entry['context']), collections.deque(maxlen=self.window))
+            durations.extend(entry['durations'])
+
+    def save(self, path=None):
+        """Save the durations (to `path` or the path given to the constructor)."""
+        path = path or self.path
+        entries = [dict(name=name, context=context, durations=list(durations))
+                   for (name, context), durations in sorted(
+                       self._durations.items(), key=lambda item: (item[0][0], item[0][1] or ''))]
+        write_atomic(path, json.dumps(dict(durations=entries), indent=1).encode('utf-8'))
+
+    def summary(self):
+        """Return a dict mapping each wait name (with the context, if any, after a colon) to the
+        number of durations and the timeout which would be used now with a default of 0."""
+        return {name if context is None else '{}:{}'.format(name, context):
+                dict(count=len(durations), timeout=self.timeout(name, 0., context))
+                for (name, context), durations in self._durations.items()}
+
+
+def wait_until(condition, timeout, name=None, recorder=None, exceptions=(),
+               initial_interval=INITIAL_INTERVAL, max_interval=MAX_INTERVAL, policy=None,
+               context=None):
+    """Wait until `condition()` returns a true value and return it.
+
+    The condition is checked immediately and then at intervals growing from `initial_interval`
+    to `max_interval`. Exceptions of the given types raised by the condition count as a false
+    value. Raises `WaitTimeout` after `timeout` seconds, or after the timeout which `policy`
+    (a `TimeoutPolicy`) sets for the wait `name` in the given `context`, using `timeout` as the
+    default. The duration of the wait is recorded in `recorder` and `policy`.
+    """
+    if policy is not None:
+        timeout = policy.timeout(name, timeout, context)
+    start = time.perf_counter()
+    interval = initial_interval
+    error = None
+    attempts = 0
+    while True:
+        attempts += 1
+        try:
+            result = condition()
+        except exceptions as e:
+            result, error = None, e
+        elapsed = time.perf_counter() - start
+        if result:
+            _record(name, elapsed, False, attempts, context, recorder, policy)
+            return result
+        if elapsed >= timeout:
+            _record(name, elapsed, True, attempts, context, recorder, policy)
+            raise WaitTimeout('Timed out after {:.1f} s waiting for {}'.format(
+                elapsed, name or condition)) from error
+        time.sleep(min(interval, timeout - elapsed))
+        interval = min(interval * BACKOFF, max_interval)
+
+
+def _record(name, elapsed, timed_out, attempts, context, recorder, policy):
+    if recorder is not None:
+        if context is None:
+            recorder.record(name, elapsed, timed_out=timed_out, attempts=attempts)
+        else:
+            recorder.record(name, elapsed, timed_out=timed_out, attempts=attempts,
+                            context=context)
+    if policy is not None and policy is not recorder:
+        policy.record(name, elapsed, timed_out=timed_out, attempts=attempts, context=context)
+
+
+def wait_until_passes(func, timeout, exceptions, name=None, recorder=None, **kwargs):
+    """Call `func()` until it does not raise any of `exceptions` and return its result."""
+    result = []
+
+    def condition():
+        result.append(func())
+        return True
+
+    wait_until(condition, timeout, name=name, recorder=recorder, exceptions=exceptions, **kwargs)
+    return result[-1]
+
+
+def wait_for_file(path, timeout, previous_stat=None, stable_time=0.1, name=None, recorder=None,
+                  **kwargs):
+    """Wait until a file exists, differs from `previous_stat` and stops growing.
+
+    The file is considered complete once its size has not changed for `stable_time` seconds.
+    """
+    last = [None, None]  # size, time of the last size change
+
+    def is_complete():
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return False
+        if previous_stat is not None and (stat.st_mtime, stat.st_size) == (
+                previous_stat.st_mtime, previous_stat.st_size):
+            return False
+        now = time.perf_counter()
+        if stat.st_size != last[0]:
+            last[:] = stat.st_size, now
+            return False
+        return now - last[1] >= stable_time
+
+    return wait_until(is_complete, timeout, name=name or 'file', recorder=recorder, **kwargs)
+
+
+def stat_or_none(path):
+    """Return `os.stat(path)`, or `None` if the file does not exist."""
+    try:
+        return os.stat(path)
+    except FileNotFoundError:
+        return None
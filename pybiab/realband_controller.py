@@ -1,23 +1,53 @@
 import os
 import re
 import sys
-import traceback
 
-from pywinauto import Application
-from pywinauto.application import ProcessNotFoundError
-from pywinauto.base_wrapper import ElementNotEnabled
-from pywinauto.findwindows import ElementNotFoundError
-from pywinauto.findbestmatch import MatchError
-from pywinauto.timings import wait_until_passes, TimeoutError
-import psutil
-import win32com.client
-
-
-class RealBandController:
-    """An object for controlling RealBand."""
+try:
+    from pywinauto import Application
+    from pywinauto.application import ProcessNotFoundError
+    from pywinauto.base_wrapper import ElementNotEnabled
+    from pywinauto.findwindows import ElementNotFoundError
+    from pywinauto.findbestmatch import MatchError
+    from pywinauto.timings import TimeoutError
+    import win32com.client
+except ImportError as e:
+    # Not on Windows; fail only when the controller is used
+    _import_error = e
+else:
+    _import_error = None
+
+from .controller import RenderController
+from .processes import ProcessTracker
+from .readiness import (TimeoutPolicy, WaitRecorder, stat_or_none, wait_for_file, wait_until,
+                        wait_until_passes)
+
+DEFAULT_BINARY_PATH = r'C:\RealBand\RealBand.exe'
+
+
+class RealBandController(RenderController):
+    """An object for controlling RealBand.
+
+    The timeouts of the waits are set by the `TimeoutPolicy` in `timeouts`; the loading of a
+    style and the generation are timed per style file.
+    """
     _TARGET_VERSION = '2018.0.2.5'
 
-    def __init__(self, binary_path=r'C:\RealBand\RealBand.exe', try_connect=True):
+    def __init__(self, binary_path=DEFAULT_BINARY_PATH, try_connect=True, isolated=False,
+                 timeouts=None):
+        """Connect to RealBand or start it.
+
+        With `isolated=True`, RealBand is started in the directory of `binary_path`, so that
+        several installations of RealBand can be controlled side by side. `kill` only kills the
+        processes of this instance in any case.
+        """
+        self._install_dir = os.path.dirname(os.path.abspath(binary_path)) if isolated else None
+        if _import_error is not None:
+            raise ImportError('{} requires pywinauto and pywin32 (Windows only)'
+                              .format(type(self).__name__)) from _import_error
+        self.wait_stats = WaitRecorder()
+        self.timeouts = timeouts or TimeoutPolicy()
+        self._style = None  # Name of the style file loaded last, if any
+        self._metadata = {}  # Cached song metadata, cleared when a song or style is loaded
         self.realband_version = _get_exe_version(binary_path)
         if self.realband_version != self._TARGET_VERSION:
             print('This code was written for RealBand {}, your version is {}. '
@@ -31,12 +61,24 @@ class RealBandController:
             except ProcessNotFoundError:
                 try_connect = False
         if not try_connect:
-            self._app.start(binary_path)
+            self._app.start(binary_path, work_dir=self._install_dir)
+        # Remember the processes of this instance (including bbw2.exe) to kill them precisely
+        self._processes = ProcessTracker(self._app.process)
+        try:
+            self._wait_startup(try_connect)
+        except Exception:
+            if not try_connect:
+                # Do not leave a half-started instance behind
+                self._processes.kill()
+            raise
+
+    def _wait_startup(self, connected):
+        if not connected:
             self._app.wait_cpu_usage_lower(threshold=5)
 
         def get_ready():
             rb_window = self._app.window(class_name='RealBand')
-            if rb_window.exists() and rb_window.is_visible() and rb_window.is_enabled():
+            if rb_window.exists(timeout=0) and rb_window.is_visible() and rb_window.is_enabled():
                 return
 
             # Reject attempts to recover from a crash
@@ -50,7 +92,8 @@ class RealBandController:
 
         wait_until_passes(func=get_ready,
                           exceptions=(ElementNotFoundError, TimeoutError),
-                          timeout=15, retry_interval=1)
+                          timeout=15, name='startup', recorder=self.wait_stats,
+                          policy=self.timeouts)
 
         self._song_pane = self._app.RealBand.children(
             class_name='TPanelWithCanvas')[10]
@@ -60,19 +103,28 @@ class RealBandController:
         return self._app
 
     def kill(self):
-        self._app.kill()
-        for proc in psutil.process_iter():
-            if proc.name() in ['bbw2.exe', 'RealBand.exe']:
-                print('Killing', proc, file=sys.stderr)
-                try:
-                    proc.kill()
-                except psutil.NoSuchProcess:
-                    traceback.print_exc(file=sys.stderr)
+        self._processes.kill()
+
+    def is_alive(self):
+        return self._processes.is_running()
+
+    def recover(self, timeout=5):
+        """Close any dialogs and wait for the main window to become ready."""
+        try:
+            for dialog in self._app.windows(class_name='#32770', visible_only=True):
+                dialog.close()
+            self.wait_ready(timeout=timeout, name='recover')
+        except (RuntimeError, ElementNotFoundError, MatchError):
+            return False
+        return True
 
     def load_song(self, path):
         """Load a song from the given file."""
+        self._metadata.clear()
+        self._style = None
+        self._processes.update()
         self._menu_select('File->Open')
-        self._open_file(path)
+        self._open_file(path, 'load_song')
         try:
             # Get the annoying Comments window out of the way
             self._app.Comments.minimize()
@@ -81,6 +133,8 @@ class RealBandController:
 
     def load_style(self, path):
         """Load a style from the given file."""
+        # The style determines the meter (and may change the tempo)
+        self._metadata.clear()
         self.wait_ready()
 
         def open_dialog():
@@ -91,15 +145,18 @@ class RealBandController:
 
         wait_until_passes(func=open_dialog,
                           exceptions=ElementNotFoundError,
-                          timeout=120, retry_interval=0.4)
-        self._open_file(path)
-
-    def _open_file(self, path):
-        """Input a path in the file open dialog."""
+                          timeout=120, name='style_menu', recorder=self.wait_stats,
+                          policy=self.timeouts)
+        self._style = os.path.basename(path)
+        self._open_file(path, 'load_style', context=self._style)
+
+    def _open_file(self, path, name, context=None):
+        """Input a path in the file open dialog and wait for the file to load (a wait called
+        `name`)."""
         path = os.path.normpath(os.path.abspath(path))
         while True:
             dialog = self._app.window(class_name='#32770')
-            dialog.wait('ready')
+            self.wait_window_ready(dialog, name='open_dialog')
 
             # If asked whether to save changes, say no
             try:
@@ -113,68 +170,93 @@ class RealBandController:
 
         dialog.Edit1.set_edit_text(path)
         dialog.Edit1.send_keystrokes('{ENTER}')
-        self.wait_ready(timeout=60)
+        # The file has been accepted once the dialog is gone
+        wait_until(lambda: not dialog.exists(timeout=0), timeout=60,
+                   name='open_dialog_close', recorder=self.wait_stats, policy=self.timeouts)
+        self.wait_ready(timeout=60, name=name, context=context)
 
     def save_song(self, path, filetype='MIDI File (.MID) (*.MID)'):
         """Save the current song under the given filename."""
         path = os.path.normpath(os.path.abspath(path))
+        previous_stat = stat_or_none(path)
 
         self._menu_select('File->Save As')
         file_dialog = self._app.window(class_name='#32770')
-        file_dialog.wait('ready')
-        file_dialog.ComboBox2.select(filetype)
+        self.wait_window_ready(file_dialog, name='save_dialog')
+        if file_dialog.ComboBox2.selected_text() != filetype:
+            # The dialog keeps the type saved last, so only select it when it changes
+            file_dialog.ComboBox2.select(filetype)
         file_dialog.Edit1.set_edit_text(path)
         file_dialog.Edit1.send_keystrokes('{ENTER}')
+
+        # RealBand may add its own extension to the file name; only wait for the file if it
+        # already has the right one
+        extension = re.search(r'\(\*(\.[^)]*)\)$', filetype)
+        if extension and path.lower().endswith(extension.group(1).lower()):
+            wait_for_file(path, timeout=60, previous_stat=previous_stat,
+                          name='save_file', recorder=self.wait_stats, policy=self.timeouts,
+                          context=filetype)
         self.wait_ready()
 
     def generate_all(self):
         """Generate all Band-in-a-Box tracks."""
         self._menu_select('Generate->Generate All BB Tracks')
-        self.wait_ready()
+        self.wait_ready(name='generate', context=self._style)
+        self._processes.update()
 
     def set_key(self, key, transpose=False):
-        """Set the key of the song."""
+        """Set the key of the song to one of `KEYS`."""
+        if key not in self.KEYS:
+            raise ValueError('invalid key {!r}'.format(key))
         if transpose:
             raise NotImplementedError('transpose not implemented')
 
         self._menu_select('Edit->Key Signature')
 
         key_dialog = self._app.window(class_name='TKEY')
-        key_dialog.wait('ready')
+        self.wait_window_ready(key_dialog, name='key_dialog')
         key_dialog.TComboBox1.select(key)
         key_dialog.TRadioButton4.click()  # No Transpose
         key_dialog.TButton3.click()  # OK
         self.wait_ready()
+        self._metadata['key_signature'] = key
 
     @property
     def key_signature(self):
         """The key signature of the song."""
-        text = self._get_menu_item_text('Edit->Key Signature')
-        return re.search(r'\[([A-G].?)\]$', text).group(1)
+        return self._get_metadata('key_signature', 'Edit->Key Signature', r'\[([A-G].?)\]$')
 
     @property
     def time_signature(self):
         """The time signature (meter) of the song."""
-        text = self._get_menu_item_text('Edit->Meter (Time Signature)')
-        return re.search(r'\[([0-9]+/[0-9]+)\]$', text).group(1)
+        return self._get_metadata('time_signature', 'Edit->Meter (Time Signature)',
+                                  r'\[([0-9]+/[0-9]+)\]$')
 
     @property
     def tempo(self):
         """The tempo of the song."""
-        text = self._get_menu_item_text('Edit->Tempo')
-        return float(re.search(r'\[([0-9.,]+)\]$', text).group(1))
+        return float(self._get_metadata('tempo', 'Edit->Tempo', r'\[([0-9.,]+)\]$'))
+
+    def _get_metadata(self, name, menu_path, regex):
+        """Read a value from the label of a menu item, caching it until the next song or style
+        is loaded."""
+        if name not in self._metadata:
+            text = self._get_menu_item_text(menu_path)
+            self._metadata[name] = re.search(regex, text).group(1)
+        return self._metadata[name]
 
-    def _get_menu_item_text(self, path, timeout=10, retry_interval=0.5):
+    def _get_menu_item_text(self, path, timeout=10):
         def get_text():
             return self._app.RealBand.menu_item(path).text()
 
         return wait_until_passes(func=get_text,
                                  exceptions=(ElementNotEnabled, RuntimeError),
                                  timeout=timeout,
-                                 retry_interval=retry_interval)
+                                 name='menu_item', recorder=self.wait_stats,
+                                 policy=self.timeouts)
 
 
-    def _menu_select(self, path, timeout=10, retry_interval=0.5):
+    def _menu_select(self, path, timeout=10):
         self.wait_ready()
 
         def select_option():
@@ -183,10 +265,33 @@ class RealBandController:
         wait_until_passes(func=select_option,
                           exceptions=(ElementNotEnabled, RuntimeError),
                           timeout=timeout,
-                          retry_interval=retry_interval)
+                          name='menu_select', recorder=self.wait_stats, policy=self.timeouts)
+
+    def wait_ready(self, timeout=30, name='ready', context=None):
+        """Wait until the main window is visible and enabled."""
+        self.wait_window_ready(self._app.RealBand, timeout=timeout, name=name, context=context)
+
+    def wait_window_ready(self, window, timeout=10, name=None, context=None):
+        """Wait until a window is visible and enabled, polling adaptively.
+
+        `timeout` is the default for the `TimeoutPolicy`, which times the wait under `name` and
+        `context`.
+        """
+        def is_ready():
+            wrapper = window.wrapper_object()
+            return wrapper.is_visible() and wrapper.is_enabled()
+
+        wait_until(is_ready, timeout, name=name, recorder=self.wait_stats,
+                   exceptions=(ElementNotFoundError, MatchError), policy=self.timeouts,
+                   context=context)
+
 
-    def wait_ready(self, timeout=30):
-        self._app.RealBand.wait('ready', timeout=timeout)
+def get_realband_version(binary_path=DEFAULT_BINARY_PATH):
+    """Return the version of a RealBand executable without starting it."""
+    if _import_error is not None:
+        raise ImportError(
+            'Reading the RealBand version requires pywin32 (Windows only)') from _import_error
+    return _get_exe_version(binary_path)
 
 
 def _get_exe_version(path):
@@ -0,0 +1,186 @@
+"""A content-addressed cache of rendered outputs.
+
+An output is identified by a hash of the bytes of the song and style files, the target key, the
+output format and the version of RealBand, so that it is found again no matter under which path
+or in which manifest the same job appears. The cache directory holds the outputs under
+`objects/` and an SQLite database with the entries and hit/miss statistics. Outputs are hard-linked
+into place when possible (and copied otherwise), so a cached output must not be modified in
+place.
+
+The cache can be limited to a maximum size, in which case the least recently used outputs are
+evicted.
+"""
+
+import hashlib
+import os
+import shutil
+import sqlite3
+import time
+
+from .job_ledger import atomic_output
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    last_used REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used);
+CREATE TABLE IF NOT EXISTS stats (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+) WITHOUT ROWID;
+"""
+
+_STATS = ['hits', 'misses', 'stores', 'evictions']
+
+
+class RenderCache:
+    """A render cache in the given directory.
+
+    If `max_size` (in bytes) is given, the least recently used outputs are evicted whenever the
+    cache grows larger.
+    """
+
+    def __init__(self, cache_dir, max_size=None):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(os.path.join(cache_dir, 'objects'), exist_ok=True)
+        self._conn = sqlite3.connect(os.path.join(cache_dir, 'cache.sqlite'), timeout=60)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(_SCHEMA)
+        self._digests = {}
+
+    def job_key(self, song_path, style_path, key, output_format, version):
+        """Return the cache key of a render job.
+
+        The digests of the song and style files are memoized as long as the files do not change,
+        so each file is only read once even if it appears in many jobs.
+        """
+        h = hashlib.sha256()
+        for field in [self._file_digest(song_path), self._file_digest(style_path), key or '',
+                      output_format, version or '']:
+            h.update(field.encode('utf-8'))
+            h.update(b'\0')
+        return h.hexdigest()
+
+    def _file_digest(self, path):
+        stat = os.stat(path)
+        memo_key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+        digest = self._digests.get(memo_key)
+        if digest is None:
+            h = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    h.update(block)
+            digest = self._digests[memo_key] = h.hexdigest()
+        return digest
+
+    def _object_path(self, key):
+        return os.path.join(self.cache_dir, 'objects', key[:2], key)
+
+    def fetch(self, key, output_path):
+        """Put the cached output with the given key at `output_path`.
+
+        Returns `True` on a cache hit and `False` on a miss.
+        """
+        object_path = self._object_path(key)
+        with self._conn:
+            found = self._conn.execute(
+                'UPDATE entries SET last_used = ?, hits = hits + 1 WHERE key = ?',
+                (time.time(), key)).rowcount
+            if found and not os.path.exists(object_path):
+                # The object was deleted behind our back
+                self._conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+                found = False
+            self._increment('hits' if found else 'misses')
+        if found:
+            os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+            with atomic_output(output_path) as temp_path:
+                _link_or_copy(object_path, temp_path)
+        return bool(found)
+
+    def store(self, key, output_path):
+        """Add a rendered output to the cache under the given key."""
+        object_path = self._object_path(key)
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        with atomic_output(object_path) as temp_path:
+            _link_or_copy(output_path, temp_path)
+        now = time.time()
+        with self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO entries (key, size, created, last_used) '
+                'VALUES (?, ?, ?, ?)', (key, os.path.getsize(object_path), now, now))
+            self._increment('stores')
+        if self.max_size is not None:
+            self.evict(self.max_size)
+
+    def evict(self, max_size):
+        """Evict the least recently used outputs until the cache is at most `max_size` bytes.
+
+        Returns the number of evicted outputs.
+        """
+        size = self.size()
+        num_evicted = 0
+        while size > max_size:
+            with self._conn:
+                rows = self._conn.execute(
+                    'SELECT key, size FROM entries ORDER BY last_used LIMIT 100').fetchall()
+                if not rows:
+                    break
+                evicted = []
+                for key, entry_size in rows:
+                    if size <= max_size:
+                        break
+                    try:
+                        os.remove(self._object_path(key))
+                    except FileNotFoundError:
+                        pass
+                    evicted.append((key,))
+                    size -= entry_size
+                self._conn.executemany('DELETE FROM entries WHERE key = ?', evicted)
+                self._increment('evictions', len(evicted))
+                num_evicted += len(evicted)
+        return num_evicted
+
+    def size(self):
+        """Return the total size of the cached outputs in bytes."""
+        return self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+
+    def stats(self):
+        """Return a dict with the number of entries, their total size and the counts of hits,
+        misses, stores and evictions since the cache was created."""
+        stats = dict.fromkeys(_STATS, 0)
+        stats.update(self._conn.execute('SELECT name, value FROM stats'))
+        stats['entries'], stats['size'] = self._conn.execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.
+        return stats
+
+    def _increment(self, name, count=1):
+        self._conn.execute(
+            'INSERT INTO stats (name, value) VALUES (?, ?) '
+            'ON CONFLICT (name) DO UPDATE SET value = value + excluded.value', (name, count))
+
+    def close(self):
+        self._conn.close()
+
+
+def parse_size(text):
+    """Parse a size in bytes with an optional K, M, G or T suffix (powers of 1024)."""
+    text = text.strip().upper().rstrip('B')
+    for exponent, suffix in enumerate('KMGT', start=1):
+        if text.endswith(suffix):
+            return int(float(text[:-1]) * 1024 ** exponent)
+    return int(text)
+
+
+def _link_or_copy(source, destination):
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
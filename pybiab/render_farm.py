@@ -0,0 +1,395 @@
+"""Rendering songs with one or more RealBand instances.
+
+The rendering code only talks to the controllers through a *controller factory*, a picklable
+callable taking a `try_connect` keyword argument and returning a `RenderController`. This makes it
+possible to run the scheduler against a `SimulatedController`.
+"""
+
+import collections
+import multiprocessing
+import os
+import queue
+import re
+import sys
+import time
+import traceback
+
+from .instrumentation import InstrumentedController, RunLog
+from .job_ledger import JobLedger, atomic_output
+from .readiness import TimeoutPolicy
+from .song_file import SongFileError, read_song_info
+from .supervisor import ControllerSupervisor
+
+RenderJob = collections.namedtuple('RenderJob', ['song', 'style', 'key', 'output_path'])
+
+DEFAULT_FORMAT = 'MIDI File (.MID) (*.MID)'
+_FORMAT_EXTENSION_RE = re.compile(r'\(\*(\.[^)]*)\)$')
+
+
+def parse_job_line(line, output_dir, suffix=None, key_in_name=False):
+    """Parse a line of a TSV file with render jobs as a `RenderJob`.
+
+    The line contains the path to a song file and the path to a style file and optionally the
+    key to which the song should be transposed; any further fields are ignored. The output file
+    is named `SONG.STYLE[.SUFFIX].mid`, or `SONG.STYLE[.KEY][.SUFFIX].mid` with `key_in_name`,
+    so that the same song and style can be rendered in several keys. Raises `ValueError` if the
+    line is malformed.
+    """
+    fields = line.rstrip('\r\n').split('\t')
+    if len(fields) < 2:
+        raise ValueError('expected at least 2 tab-separated fields, got {}'.format(len(fields)))
+    song, style, key = fields[0], fields[1], fields[2] if len(fields) > 2 else None
+    if not song or not style:
+        raise ValueError('empty song or style path')
+
+    song_name, _ = os.path.splitext(song)
+    style_name, _ = os.path.splitext(style)
+    key = key or None
+    output_file = '{}.{}{}{}.mid'.format(song_name, style_name,
+                                         '.' + key if key and key_in_name else '',
+                                         '.' + suffix if suffix else '')
+    return RenderJob(song, style, key, os.path.join(output_dir, output_file))
+
+
+def format_output_paths(output_path, output_formats):
+    """Return the `(format, path)` pairs of the outputs of a job saved in several formats.
+
+    The first format is saved to `output_path` itself and the others to `output_path` with its
+    extension replaced by the (lowercase) extension of the format, e.g. `.wav` for
+    `'WAV File (*.WAV)'`. Raises `ValueError` if a format has no extension or two formats would
+    be saved to the same path.
+    """
+    outputs = [(output_formats[0], output_path)]
+    root, _ = os.path.splitext(output_path)
+    for output_format in output_formats[1:]:
+        extension = format_extension(output_format)
+        if extension is None:
+            raise ValueError('cannot tell the extension of format {!r}'.format(output_format))
+        outputs.append((output_format, root + extension))
+    paths = [path for _, path in outputs]
+    if len(set(paths)) < len(paths):
+        raise ValueError('several formats would be saved to {}'.format(output_path))
+    return outputs
+
+
+def format_extension(output_format):
+    """Return the (lowercase) extension of a format as shown in the Save As dialog, e.g.
+    `'.mid'` for `'MIDI File (.MID) (*.MID)'`, or None if it cannot be told."""
+    match = _FORMAT_EXTENSION_RE.search(output_format)
+    return match.group(1).lower() if match else None
+
+
+def read_jobs(song_style_file, output_dir, suffix=None, key_in_name=False):
+    """Read render jobs from a TSV file with one job per line (see `parse_job_line`)."""
+    with open(song_style_file, encoding='utf-8') as f:
+        return [parse_job_line(line, output_dir, suffix, key_in_name)
+                for line in f if line.strip()]
+
+
+def group_by_song(jobs):
+    """Group jobs by song, in the order of the first job of each song."""
+    groups = collections.OrderedDict()
+    for job in jobs:
+        groups.setdefault(job.song, []).append(job)
+    return list(groups.values())
+
+
+class Renderer:
+    """Renders jobs with a single controller, recovering or restarting it when it fails.
+
+    `output_format` can also be a list of formats, all of which are saved after generating the
+    song once (see `format_output_paths` for the names of the outputs). If `standby_factory` is
+    given, a standby controller is kept ready to replace the active one (see
+    `ControllerSupervisor`). If a `RunLog` is given, the controller operations, retries, restarts
+    and jobs are logged to it. If a `JobLedger` is given, every attempt at a job is recorded in
+    it, with an entry for each output. The outputs are written atomically in any case.
+
+    The `TimeoutPolicy` in `timeouts` is given to every controller to set the timeouts of its
+    waits, and sets the number of attempts made at each job.
+    """
+    APP_NAME = 'RealBand'
+
+    def __init__(self, controller_factory, song_dir, style_dir,
+                 output_format=DEFAULT_FORMAT, screenshot_dir=None, log=None,
+                 ledger=None, standby_factory=None, timeouts=None):
+        self._song_dir = song_dir
+        self._style_dir = style_dir
+        self._output_formats = ([output_format] if isinstance(output_format, str)
+                                else list(output_format))
+        self._screenshot_dir = screenshot_dir
+        self._log = log
+        self._ledger = ledger
+        self._timeouts = timeouts or TimeoutPolicy()
+
+        self._supervisor = ControllerSupervisor(controller_factory, standby_factory,
+                                                wrap=self._wrap_controller)
+        self._current_song = None
+        self._current_style = None
+        self._current_key = None
+        self._last_format = None
+
+    def _wrap_controller(self, controller):
+        if hasattr(controller, 'timeouts'):
+            controller.timeouts = self._timeouts
+        if self._log is not None:
+            controller = InstrumentedController(controller, self._log)
+        return controller
+
+    def output_paths(self, job):
+        """Return the `(format, path)` pairs of the outputs of a job."""
+        return format_output_paths(job.output_path, self._output_formats)
+
+    def render(self, job):
+        """Render a job, making up to `timeouts.num_trials` attempts."""
+        start = time.perf_counter()
+        keys = [JobLedger.key(path) for _, path in self.output_paths(job)]
+        num_trials = self._timeouts.num_trials
+        for trial_num in range(num_trials):
+            self._record(keys, 'start')
+            try:
+                self._render(job)
+                self._record(keys, 'finish')
+                self._log_job(job, start, 'done', trial_num + 1)
+                return
+            except NotImplementedError as e:
+                # Retrying cannot help
+                self._record(keys, 'fail', '{}: {}'.format(type(e).__name__, e))
+                self._log_job(job, start, 'failed', trial_num + 1, e)
+                raise
+            # pywinauto's TimeoutError is a RuntimeError
+            except (RuntimeError, OSError) as e:
+                self._record(keys, 'fail', '{}: {}'.format(type(e).__name__, e))
+                if trial_num == num_trials - 1:
+                    self._log_job(job, start, 'failed', trial_num + 1, e)
+                    raise e from None
+                traceback.print_exc(file=sys.stderr)
+                # The state of the song is unknown, so set everything up again
+                self._current_song = None
+                if self._supervisor.recover():
+                    print('Retrying', file=sys.stderr)
+                    if self._log is not None:
+                        self._log.log('retry', error='{}: {}'.format(type(e).__name__, e))
+                    continue
+                print('Restarting {}'.format(self.APP_NAME), file=sys.stderr)
+                if self._log is not None:
+                    self._log.log('restart', error='{}: {}'.format(type(e).__name__, e))
+                self.restart()
+
+    def _record(self, keys, method, *args):
+        if self._ledger is not None:
+            for key in keys:
+                getattr(self._ledger, method)(key, *args)
+
+    def _log_job(self, job, start, status, attempts, error=None):
+        if self._log is not None:
+            self._log.log('job', job=self._job_name(job), duration=time.perf_counter() - start,
+                          status=status, attempts=attempts,
+                          error=error and '{}: {}'.format(type(error).__name__, error))
+
+    def _job_name(self, job):
+        return '{}\t{}'.format(job.song, job.style)
+
+    def _render(self, job):
+        rb = self._supervisor.controller
+        if job.song != self._current_song:
+            song_path = os.path.join(self._song_dir, job.song)
+            rb.load_song(song_path)
+            self._current_song = job.song
+            self._current_style = None
+            self._current_key = _read_song_key(song_path)
+            rb.wait_ready()
+            if self._screenshot_dir:
+                rb.app.RealBand.capture_as_image().save(
+                    os.path.join(self._screenshot_dir, job.song.replace('/', '_') + '.png'))
+        if job.style != self._current_style:
+            rb.load_style(os.path.join(self._style_dir, job.style))
+            self._current_style = job.style
+        if job.key:
+            if self._current_key is None:
+                self._current_key = rb.key_signature
+            if job.key != self._current_key:
+                rb.set_key(job.key, transpose=True)
+                self._current_key = job.key
+        rb.generate_all()
+        os.makedirs(os.path.dirname(job.output_path) or '.', exist_ok=True)
+        # Start with the format saved last, which the Save As dialog still has selected
+        outputs = sorted(self.output_paths(job), key=lambda output: output[0] != self._last_format)
+        for output_format, path in outputs:
+            with atomic_output(path) as output_path:
+                rb.save_song(output_path, output_format)
+            self._last_format = output_format
+
+    def restart(self):
+        """Kill the controlled application and replace it."""
+        self._current_song = None
+        self._current_style = None
+        self._current_key = None
+        self._supervisor.restart()
+
+    def close(self):
+        """Kill the standby controller, if there is one."""
+        self._supervisor.close()
+
+
+def _read_song_key(path):
+    """Read the key of a song from its file, or return `None` if the file cannot be parsed."""
+    try:
+        return read_song_info(path).key
+    except (OSError, SongFileError):
+        return None
+
+
+def render_serial(jobs, controller_factory, renderer_class=Renderer, **kwargs):
+    """Render jobs in order with a single controller.
+
+    The jobs are executed by a `renderer_class` instance, which can be a subclass of `Renderer`
+    doing a different job with the same retries, ledger and logging (e.g. `SongEditor`).
+
+    Yields a `(job, status, error)` tuple after each job. An exception is raised if a job fails
+    repeatedly.
+    """
+    renderer = renderer_class(controller_factory, **kwargs)
+    try:
+        for job in jobs:
+            renderer.render(job)
+            yield job, 'done', None
+    finally:
+        renderer.close()
+
+
+def _worker_main(worker_id, controller_factory, standby_factory, renderer_class, renderer_kwargs,
+                 task_queue, result_queue, log_events, ledger_path):
+    if ledger_path is not None:
+        # Each process needs its own connection to the ledger
+        renderer_kwargs['ledger'] = JobLedger(ledger_path)
+    if log_events:
+        # Send the events to the main process, which owns the log
+        renderer_kwargs['log'] = RunLog(
+            sink=lambda event: result_queue.put(('event', worker_id, event)), worker=worker_id)
+    renderer = renderer_class(controller_factory, standby_factory=standby_factory,
+                              **renderer_kwargs)
+    result_queue.put(('ready', worker_id))
+    try:
+        while True:
+            jobs = task_queue.get()
+            if jobs is None:
+                return
+            for job in jobs:
+                try:
+                    renderer.render(job)
+                except Exception as e:
+                    traceback.print_exc(file=sys.stderr)
+                    error = '{}: {}'.format(type(e).__name__, e)
+                    result_queue.put(('result', worker_id, job, 'failed', error))
+                    # The job may have failed because of its song or style, so carry on with a
+                    # new instance; give up and let the other workers take the rest only if it
+                    # cannot be started
+                    if log_events:
+                        renderer_kwargs['log'].log('restart', error=error)
+                    try:
+                        renderer.restart()
+                    except Exception:
+                        traceback.print_exc(file=sys.stderr)
+                        sys.exit(1)
+                    continue
+                result_queue.put(('result', worker_id, job, 'done', None))
+            result_queue.put(('ready', worker_id))
+    finally:
+        renderer.close()
+
+
+def render_parallel(jobs, controller_factories, log=None, ledger=None, standby_factories=None,
+                    renderer_class=Renderer, **kwargs):
+    """Render jobs with one worker process per controller factory.
+
+    The jobs are grouped by song and each worker renders a whole group at a time, so that it only
+    needs to load the song once. A worker which fails a job restarts its controller and goes on
+    with the next job. When a worker dies (because its controller cannot be restarted), the jobs
+    it has not finished are handed over to the other workers. The events logged by the workers
+    are added to `log`. The workers record their attempts in the database of `ledger`. If given,
+    `standby_factories` are used to create the standby controllers of the respective workers
+    (see `Renderer`). The jobs are executed by `renderer_class` instances (see
+    `render_serial`). Each worker learns its timeouts with its own copy of the `timeouts` policy,
+    and the waits logged by all workers are also added to `timeouts` itself, so that it can be
+    saved.
+
+    Yields a `(job, status, error)` tuple after each job, where `status` is `'done'` or
+    `'failed'`, in the order in which the jobs are finished.
+    """
+    pending = collections.deque(group_by_song(jobs))
+    result_queue = multiprocessing.Queue()
+    workers = {}  # worker_id -> [process, task queue, unfinished jobs]
+    standby_factories = standby_factories or [None] * len(controller_factories)
+    for worker_id, (controller_factory, standby_factory) in enumerate(
+            zip(controller_factories, standby_factories)):
+        task_queue = multiprocessing.Queue()
+        process = multiprocessing.Process(
+            target=_worker_main,
+            args=(worker_id, controller_factory, standby_factory, renderer_class, kwargs,
+                  task_queue, result_queue, log is not None, ledger and ledger.path),
+            daemon=True)
+        process.start()
+        workers[worker_id] = [process, task_queue, []]
+
+    idle = set()
+    while workers:
+        while pending and idle:
+            worker_id = idle.pop()
+            group = pending.popleft()
+            workers[worker_id][2] = list(group)
+            workers[worker_id][1].put(group)
+        if not pending and len(idle) == len(workers):
+            break
+
+        try:
+            messages = [result_queue.get(timeout=1)]
+        except queue.Empty:
+            messages = []
+        # Checked on every iteration, since the events of the other workers can keep the queue
+        # busy for a long time
+        dead = [worker_id for worker_id, (process, _, _) in workers.items()
+                if not process.is_alive()]
+        if dead:
+            # A dead worker's messages are all in the queue by now; handle them before handing
+            # over its unfinished jobs
+            messages.extend(_drain(result_queue))
+        for message in messages:
+            if message[1] not in workers:
+                continue
+            if message[0] == 'ready':
+                idle.add(message[1])
+            elif message[0] == 'event':
+                log.add(message[2])
+                if kwargs.get('timeouts') is not None:
+                    kwargs['timeouts'].add(message[2])
+            else:
+                _, worker_id, job, status, error = message
+                workers[worker_id][2].remove(job)
+                yield job, status, error
+
+        for worker_id in dead:
+            process, _, unfinished = workers.pop(worker_id)
+            print('Worker {} died with exit code {}'.format(worker_id, process.exitcode),
+                  file=sys.stderr)
+            if unfinished:
+                pending.appendleft(unfinished)
+            idle.discard(worker_id)
+
+    for process, task_queue, _ in workers.values():
+        task_queue.put(None)
+    for process, _, _ in workers.values():
+        process.join()
+
+    for group in pending:
+        for job in group:
+            yield job, 'failed', 'no workers left'
+
+
+def _drain(result_queue):
+    """Return the messages waiting in a queue."""
+    messages = []
+    while True:
+        try:
+            messages.append(result_queue.get_nowait())
+        except queue.Empty:
+            return messages
@@ -0,0 +1,90 @@
+"""Planning the order in which render jobs are executed.
+
+Loading a song or a style in RealBand is slow, so the jobs are reordered to load each song only
+once and each style only once per song. This module does not need RealBand.
+"""
+
+import collections
+import os
+
+from .job_ledger import JobLedger
+
+RenderPlan = collections.namedtuple('RenderPlan', ['jobs', 'existing', 'duplicates'])
+LoadCounts = collections.namedtuple('LoadCounts', ['songs', 'styles'])
+
+
+def plan_jobs(jobs, skip_existing=True, done=None):
+    """Plan the execution of a list of `RenderJob`s.
+
+    The jobs are grouped by song and then by style, keeping the order in which the songs (and
+    the styles of each song) first appear. Jobs whose output already exists (if `skip_existing`
+    is set) and jobs with the same output as an earlier job are dropped. If `done` is given,
+    it is a set of `JobLedger` keys of finished jobs, which is used instead of checking whether
+    the outputs exist.
+
+    Returns a `RenderPlan` with the jobs to execute, the jobs with existing outputs and the
+    duplicate jobs.
+    """
+    groups = collections.OrderedDict()
+    seen_outputs = set()
+    existing, duplicates = [], []
+    for job in jobs:
+        if job.output_path in seen_outputs:
+            duplicates.append(job)
+            continue
+        seen_outputs.add(job.output_path)
+        if skip_existing and (os.path.exists(job.output_path) if done is None
+                              else JobLedger.key(job.output_path) in done):
+            existing.append(job)
+            continue
+        groups.setdefault(job.song, collections.OrderedDict()).setdefault(job.style, []).append(job)
+
+    planned = [job for styles in groups.values() for group in styles.values() for job in group]
+    return RenderPlan(planned, existing, duplicates)
+
+
+def count_loads(jobs):
+    """Count the song and style loads needed to execute jobs in the given order.
+
+    This follows `Renderer`, which reloads the song when it differs from the previous job's and
+    the style when the song was reloaded or the style differs.
+    """
+    songs = styles = 0
+    current_song = current_style = None
+    for job in jobs:
+        if job.song != current_song:
+            songs += 1
+            current_song, current_style = job.song, None
+        if job.style != current_style:
+            styles += 1
+            current_style = job.style
+    return LoadCounts(songs, styles)
+
+
+def write_plan(file, jobs):
+    """Write planned jobs as TSV lines with the song, style, key and output path."""
+    for job in jobs:
+        print(job.song, job.style, job.key or '', job.output_path, sep='\t', file=file)
+
+
+def plan_transpositions(jobs, base_jobs):
+    """Plan rendering songs in their original key and transposing them offline.
+
+    `base_jobs` maps each `(song, style)` pair to a job rendering it without a key. Every job in
+    `jobs` with a key is replaced by the base job of its song and style, which is planned once,
+    in place of the first job needing it.
+
+    Returns the jobs to render and a dict mapping each base job to the list of jobs to derive
+    from its output by transposition.
+    """
+    planned, derived = [], collections.OrderedDict()
+    seen = set()
+    for job in jobs:
+        if job.key is not None:
+            base_job = base_jobs[job.song, job.style]
+            derived.setdefault(base_job, []).append(job)
+            job = base_job
+        if job not in seen:
+            seen.add(job)
+            planned.append(job)
+    return planned, derived
@@ -0,0 +1,238 @@
+"""Apply a list of edits to Band-in-a-Box songs and save them.
+
+The edits are given as `--step action=value`, applied in order; see `pybiab.song_edit` for the
+available actions. For example, `--step tempo=120 --step ending=off --step substyle=33`.
+
+With `--direct`, the tempo, length and substyle steps are applied to the song files directly,
+without Band-in-a-Box, which takes microseconds per song instead of seconds.
+"""
+
+import argparse
+import functools
+import os
+import sys
+import time
+
+from ..instrumentation import RunLog
+from ..job_ledger import JobLedger, find_outputs
+from ..readiness import DEFAULT_NUM_TRIALS, TimeoutPolicy
+from ..render_farm import render_parallel, render_serial
+from ..song_edit import (SONG_FILE_RE, SongEditor, check_direct, edit_song_files,
+                         list_edit_jobs, parse_step)
+
+LEDGER_NAME = '.bb_edit.sqlite'
+_LEDGER_BATCH_SIZE = 1000
+
+
+def add_arguments(parser, ledger_name=LEDGER_NAME, direct=True):
+    """Add the arguments common to all song editing scripts to an `ArgumentParser`.
+
+    `--direct` is only added if `direct` is set.
+    """
+    parser.add_argument('input_dir')
+    parser.add_argument('output_dir')
+    parser.add_argument('--instance', type=str, action='append', default=[],
+                        help='path to the executable of a separate Band-in-a-Box installation to '
+                             'edit with; repeat to edit with several instances in parallel')
+    parser.add_argument('--standby', type=str, action='append', default=[],
+                        help='path to the executable of a further installation in which to keep '
+                             'a standby instance running; give one per --instance (or just one)')
+    parser.add_argument('--log', type=str, default=None,
+                        help='JSONL file to append timed events to')
+    parser.add_argument('--ledger', type=str, default=None,
+                        help='SQLite database recording the progress of the jobs, used to skip '
+                             'finished jobs when resuming; defaults to {} in the output '
+                             'directory'.format(ledger_name))
+    parser.add_argument('--timeouts', type=str, default=None,
+                        help='JSON file in which the durations of the waits are kept between '
+                             'runs to set the timeouts from; defaults to {} in the output '
+                             'directory'.format(_timeouts_name(ledger_name)))
+    parser.add_argument('--trials', type=int, default=DEFAULT_NUM_TRIALS,
+                        help='number of attempts at each song before giving up on it')
+    parser.add_argument('--simulate', type=float, nargs='?', const=1., default=None,
+                        metavar='TIME_SCALE',
+                        help='simulate Band-in-a-Box instead of controlling it (the outputs are '
+                             'dummy files), optionally scaling the simulated latencies; any '
+                             '--instance values only set the number of workers')
+    parser.add_argument('--simulate-profile', type=str, default=None, metavar='FILE',
+                        help='with --simulate, take the latencies and failure rates from a '
+                             'latency profile (see pybiab.simulated_controller.fit_profile)')
+    if direct:
+        parser.add_argument('--direct', action='store_true',
+                            help='edit the song files directly instead of with Band-in-a-Box; '
+                                 'only possible for tempo, length and substyle changes')
+        parser.add_argument('--compare-dir', type=str, default=None,
+                            help='with --direct, compare each output with the file of the same '
+                                 'name in this directory, e.g. saved by Band-in-a-Box after the '
+                                 'same edits, and report the first differing byte')
+
+
+def _timeouts_name(ledger_name):
+    return os.path.splitext(ledger_name)[0] + '.timeouts.json'
+
+
+def run(args, steps, pattern=SONG_FILE_RE, ledger_name=LEDGER_NAME):
+    """Apply edit steps to the files in `args.input_dir` matching `pattern`.
+
+    Exits with status 1 if any job failed.
+    """
+    direct = getattr(args, 'direct', False)
+    if args.standby and len(args.standby) != max(len(args.instance), 1):
+        sys.exit('give one --standby per --instance')
+    if direct:
+        try:
+            check_direct(steps)
+        except ValueError as e:
+            sys.exit(str(e))
+    compare_dir = getattr(args, 'compare_dir', None)
+    if compare_dir and not direct:
+        sys.exit('--compare-dir requires --direct')
+    if args.simulate_profile and args.simulate is None:
+        sys.exit('--simulate-profile requires --simulate')
+
+    input_dir = os.path.abspath(args.input_dir)
+    output_dir = os.path.abspath(args.output_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    jobs, ignored = list_edit_jobs(input_dir, output_dir, pattern)
+    for fname in ignored:
+        print(f'Ignoring {fname}', file=sys.stderr)
+
+    ledger = JobLedger(args.ledger or os.path.join(output_dir, ledger_name))
+    if ledger.is_new:
+        # Adopt the outputs of runs made before the ledger was used
+        ledger.mark_done(JobLedger.key(job.output_path) for job in jobs
+                         if find_outputs(job.output_path))
+    ledger.add(JobLedger.key(job.output_path) for job in jobs)
+    done = ledger.done()
+    todo = [job for job in jobs if JobLedger.key(job.output_path) not in done]
+    if len(todo) < len(jobs):
+        print('{} jobs already done'.format(len(jobs) - len(todo)), file=sys.stderr)
+
+    log = RunLog(args.log)
+    timeouts = TimeoutPolicy(
+        args.timeouts or os.path.join(output_dir, _timeouts_name(ledger_name)),
+        num_trials=args.trials)
+    if not todo:
+        results = []
+    elif direct:
+        results = _edit_direct(todo, steps, ledger, log)
+    else:
+        if args.simulate is not None:
+            from ..simulated_controller import SimulatedController, load_profile
+            profile = load_profile(args.simulate_profile) if args.simulate_profile else {}
+            factories = [functools.partial(SimulatedController, time_scale=args.simulate,
+                                           **profile)
+                         for _ in args.instance or [None]]
+            standby_factories = [functools.partial(SimulatedController,
+                                                   time_scale=args.simulate, **profile)
+                                 for _ in args.standby]
+        else:
+            # Only import the GUI automation libraries when they are needed
+            from ..biab_controller import BandInABoxController
+            factories = ([functools.partial(BandInABoxController, binary_path)
+                          for binary_path in args.instance] or [BandInABoxController])
+            standby_factories = [functools.partial(BandInABoxController, binary_path)
+                                 for binary_path in args.standby]
+        editor_kwargs = dict(renderer_class=SongEditor, steps=steps, log=log, ledger=ledger,
+                             timeouts=timeouts)
+        if len(factories) > 1:
+            results = render_parallel(todo, factories,
+                                      standby_factories=standby_factories or None,
+                                      **editor_kwargs)
+        else:
+            results = render_serial(
+                todo, factories[0],
+                standby_factory=standby_factories[0] if standby_factories else None,
+                **editor_kwargs)
+
+    num_failed = num_different = 0
+    try:
+        for i, (job, status, error) in enumerate(results):
+            fname = os.path.basename(job.song)
+            if status == 'failed':
+                num_failed += 1
+                print(i+1, fname, status, error, sep='\t', file=sys.stderr)
+            else:
+                print(i+1, fname, sep='\t', file=sys.stderr)
+                if compare_dir:
+                    difference = _compare(job, compare_dir)
+                    if difference is not None:
+                        num_different += 1
+                        print('different', fname, difference, sep='\t', file=sys.stderr)
+        if compare_dir:
+            print('{} outputs differ from {}'.format(num_different, compare_dir),
+                  file=sys.stderr)
+    finally:
+        log.close()
+        print(log.summary.format(), file=sys.stderr)
+        if not direct:
+            timeouts.save()
+        ledger.close()
+    if num_failed:
+        sys.exit(1)
+
+
+def _edit_direct(jobs, steps, ledger, log):
+    """Run `edit_song_files`, recording the finished jobs in the ledger in batches."""
+    done = []
+    try:
+        start = time.perf_counter()
+        for job, status, error in edit_song_files(jobs, steps):
+            key = JobLedger.key(job.output_path)
+            if status == 'done':
+                done.append(key)
+                if len(done) >= _LEDGER_BATCH_SIZE:
+                    ledger.mark_done(done)
+                    done = []
+            else:
+                ledger.fail(key, error)
+            now = time.perf_counter()
+            log.log('job', job=os.path.basename(job.song), duration=now - start, status=status,
+                    attempts=1, error=error)
+            start = now
+            yield job, status, error
+    finally:
+        ledger.mark_done(done)
+
+
+def _compare(job, compare_dir):
+    """Compare the output of a direct edit with the file of the same name in `compare_dir`.
+
+    Returns `None` if they are identical and a description of the difference otherwise.
+    """
+    _, ext = os.path.splitext(job.song)
+    output_path = job.output_path + ext
+    reference_path = os.path.join(compare_dir, os.path.basename(output_path))
+    try:
+        with open(output_path, 'rb') as f:
+            data = f.read()
+        with open(reference_path, 'rb') as f:
+            reference = f.read()
+    except OSError as e:
+        return '{}: {}'.format(type(e).__name__, e)
+    if data == reference:
+        return None
+    pos = next((i for i, (a, b) in enumerate(zip(data, reference)) if a != b),
+               min(len(data), len(reference)))
+    return 'first difference at byte {} ({} vs {} bytes)'.format(pos, len(data), len(reference))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    add_arguments(parser)
+    parser.add_argument('--step', type=str, action='append', default=[], required=True,
+                        help='edit step as action=value; repeat to apply several steps in order')
+    parser.add_argument('--pattern', type=str, default=SONG_FILE_RE,
+                        help='regular expression matching the names of the files to edit '
+                             '(default: song files)')
+    args = parser.parse_args()
+    try:
+        steps = [parse_step(step) for step in args.step]
+    except ValueError as e:
+        parser.error(str(e))
+    run(args, steps, args.pattern)
+
+
+if __name__ == '__main__':
+    main()
+
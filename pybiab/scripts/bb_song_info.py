@@ -0,0 +1,52 @@
+"""Print the metadata of Band-in-a-Box song files as TSV, without Band-in-a-Box.
+
+The columns are the path, title, key, tempo, style file, style number and number of bars.
+"""
+
+import argparse
+import os
+import re
+import sys
+
+from ..song_file import SongFileError, read_song_info
+
+_SONG_FILE_RE = re.compile(r'\.[SM]G.$', re.IGNORECASE)
+
+
+def list_song_files(input_dir):
+    """List all song files (.SGU, .MGU, ...) under the given directory, relative to it."""
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(input_dir):
+        dirnames.sort()
+        for fname in sorted(filenames):
+            if _SONG_FILE_RE.search(fname):
+                paths.append(os.path.relpath(os.path.join(dirpath, fname), input_dir))
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input', nargs='+', help='song files or directories of song files')
+    args = parser.parse_args()
+
+    num_failed = 0
+    for input_path in args.input:
+        if os.path.isdir(input_path):
+            paths = [os.path.join(input_path, path) for path in list_song_files(input_path)]
+        else:
+            paths = [input_path]
+        for path in paths:
+            try:
+                info = read_song_info(path)
+            except (OSError, SongFileError) as e:
+                num_failed += 1
+                print(path, '{}: {}'.format(type(e).__name__, e), sep='\t', file=sys.stderr)
+                continue
+            print(path, *['' if value is None else value for value in info], sep='\t')
+    if num_failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,83 +1,222 @@
 #!/usr/bin/env python3
-"""Fix a RealBand MIDI file."""
+"""Fix a RealBand MIDI file (or a whole directory of them)."""
 
 import argparse
-import re
+import collections
+import multiprocessing
+import os
+import shutil
 import sys
-
-import mido
-
-
-class MetaSpec_key_signature(mido.midifiles.meta.MetaSpec_key_signature):
-
-    def decode(self, message, data):
-        try:
-            super().decode(message, data)
-        except mido.midifiles.meta.KeySignatureError:
-            message.key = None
-
-    def check(self, name, value):
-        if value is not None:
-            super().check(name, value)
+import tempfile
+import traceback
+
+from ..midi_archive import MidiArchive
+from ..midi_utils import fix_midi_file, patch_mido
+from ..track_select import TrackSelector
+
+
+def _fix_worker(task):
+    input_file, output_file, kwargs = task
+    rule_counts = collections.Counter()
+    try:
+        os.makedirs(os.path.dirname(output_file), exist_ok=True)
+        status = ('done' if fix_midi_file(input_file, output_file, rule_counts=rule_counts,
+                                          **kwargs)
+                  else 'empty')
+        return input_file, status, None, rule_counts
+    except Exception as e:
+        traceback.print_exc(file=sys.stderr)
+        return input_file, 'failed', '{}: {}'.format(type(e).__name__, e), rule_counts
+
+
+def list_midi_files(input_dir):
+    """List all MIDI files under the given directory, relative to it."""
+    return list(iter_midi_files(input_dir))
+
+
+def iter_midi_files(input_dir):
+    """Like `list_midi_files`, but yield the paths while walking the directory."""
+    for dirpath, dirnames, filenames in os.walk(input_dir):
+        dirnames.sort()
+        for fname in sorted(filenames):
+            if fname.lower().endswith(('.mid', '.midi')):
+                yield os.path.relpath(os.path.join(dirpath, fname), input_dir)
+
+
+def read_manifest(manifest_file):
+    """Read a list of MIDI file paths, one per line, relative to the manifest's directory."""
+    return list(iter_manifest(manifest_file))
+
+
+def iter_manifest(manifest_file):
+    """Like `read_manifest`, but yield the paths while reading the file."""
+    with open(manifest_file, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield line.strip()
+
+
+def fix_midi_files(input_dir, paths, output_dir, num_workers=None, chunksize=16,
+                   overwrite=False, rule_counts=None, **kwargs):
+    """Fix many MIDI files using a pool of worker processes.
+
+    `paths` are relative to `input_dir` and the outputs are saved under the same relative paths
+    in `output_dir` (absolute paths are saved under their base name). Files whose output already
+    exists are skipped unless `overwrite` is set.
+
+    Yields an `(input_path, status, error)` tuple for each file, where `status` is one of
+    `'done'`, `'empty'`, `'exists'` and `'failed'`, in the order in which the files are finished.
+    The track selection rules matching the tracks of the processed files are counted in the
+    `Counter` `rule_counts` if given.
+    """
+    tasks = []
+    for path in paths:
+        input_file = os.path.join(input_dir, path)
+        output_file = os.path.join(output_dir, _output_name(path))
+        if not overwrite and os.path.exists(output_file):
+            yield input_file, 'exists', None
+            continue
+        tasks.append((input_file, output_file, kwargs))
+
+    if not tasks:
+        return
+
+    with multiprocessing.Pool(num_workers, initializer=patch_mido) as pool:
+        for input_file, status, error, counts in pool.imap_unordered(_fix_worker, tasks,
+                                                                     chunksize=chunksize):
+            if rule_counts is not None:
+                rule_counts.update(counts)
+            yield input_file, status, error
+
+
+def fix_midi_files_to_archive(input_dir, paths, archive, overwrite=False, batch_size=256,
+                              **kwargs):
+    """Like `fix_midi_files`, but pack the outputs into a `MidiArchive` instead of a directory.
+
+    The outputs are named by their relative paths like in `fix_midi_files`. They are written to
+    a staging directory inside the archive directory and packed (and removed) as soon as they
+    are finished, committing every `batch_size` files. Files which are already in the archive
+    are skipped unless `overwrite` is set.
+    """
+    todo = []
+    for path in paths:
+        if not overwrite and _output_name(path) in archive:
+            yield os.path.join(input_dir, path), 'exists', None
+        else:
+            todo.append(path)
+    if not todo:
+        return
+
+    names = {os.path.join(input_dir, path): _output_name(path) for path in todo}
+    staging_dir = tempfile.mkdtemp(prefix='.staging-', dir=archive.path)
+    try:
+        num_packed = 0
+        for input_file, status, error in fix_midi_files(input_dir, todo, staging_dir,
+                                                        overwrite=True, **kwargs):
+            if status == 'done':
+                output_file = os.path.join(staging_dir, names[input_file])
+                archive.add_file(names[input_file], output_file)
+                os.remove(output_file)
+                num_packed += 1
+                if num_packed % batch_size == 0:
+                    archive.commit()
+            yield input_file, status, error
+    finally:
+        archive.commit()
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+
+def _output_name(path):
+    """Return the path of the output of an input path, relative to the output directory."""
+    return os.path.basename(path) if os.path.isabs(path) else path
+
+
+def _print_rule_counts(selector, rule_counts):
+    for rule in selector.rules:
+        print('{} tracks matched: {}'.format(rule_counts[rule.text], rule.text), file=sys.stderr)
 
 
 def main():
     # Prevent KeySignatureError on invalid key signature
-    mido.midifiles.meta.add_meta_spec(MetaSpec_key_signature)
+    patch_mido()
 
     parser = argparse.ArgumentParser(description=__doc__)
-    parser.add_argument('input_file')
-    parser.add_argument('output_file')
-    parser.add_argument('--remove-re', type=str, action='append', default=[])
-    parser.add_argument('--remove', type=str, action='append', default=[])
+    parser.add_argument('input_file',
+                        help='input MIDI file, or a directory of MIDI files to process in batch')
+    parser.add_argument('output_file', help='output MIDI file, or output directory in batch mode')
+    parser.add_argument('--remove-re', type=str, action='append', default=[],
+                        help='remove the tracks whose name matches this regular expression')
+    parser.add_argument('--remove', type=str, action='append', default=[],
+                        help='remove the tracks with this name')
+    parser.add_argument('--rule', type=str, action='append', default=[],
+                        help='track selection rule such as "keep program 32-39" or "remove '
+                             'channel 9"; see pybiab.track_select for the syntax')
+    parser.add_argument('--rules', type=str, action='append', default=[],
+                        help='file with track selection rules, one per line')
     parser.add_argument('--ignore-if-empty', action='store_true')
+    parser.add_argument('--engine', choices=['mido', 'raw'], default='mido',
+                        help='how to process the files; raw rewrites the bytes directly without '
+                             'decoding every message and gives the same output much faster')
+    parser.add_argument('--manifest', action='store_true',
+                        help='batch mode; input_file is a text file listing MIDI files, one per '
+                             'line, relative to its directory')
+    parser.add_argument('--jobs', '-j', type=int, default=None,
+                        help='number of worker processes in batch mode (default: CPU count)')
+    parser.add_argument('--chunksize', type=int, default=16,
+                        help='number of files dispatched to a worker at a time in batch mode')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='in batch mode, process files whose output already exists')
+    parser.add_argument('--archive', action='store_true',
+                        help='in batch mode, pack the outputs into a deduplicated archive in '
+                             'output_file (see pybiab.midi_archive) instead of writing one file '
+                             'per input')
     args = parser.parse_args()
 
-    midi_file = mido.MidiFile(args.input_file)
-
-    num_invalid = 0
-    for track in midi_file.tracks:
-        # First, find which channels appear in the track
-        channels = set()
-        for message in track:
-            if isinstance(message, mido.Message):
-                channels.add(message.channel)
-        channels = sorted(channels)
-
-        messages = list(track)
-        track.clear()
-        for message in messages:
-            # Detect and remove invalid messages
-            if isinstance(message, mido.MetaMessage):
-                if message.type == 'key_signature' and message.key is None:
-                    num_invalid += 1
-                    continue
-
-            track.append(message)
-
-            # Duplicate program changes into all channels in the track
-            if message.type == 'program_change':
-                track.extend(
-                    mido.Message('program_change', program=message.program, channel=channel, time=0)
-                    for channel in channels if channel != message.channel)
-
-    if num_invalid:
-        print(f'Removed {num_invalid} invalid messages', file=sys.stderr)
-
-    # Remove tracks with the given name.
-    for track in list(midi_file.tracks):
-        if (any(re.search(regex, track.name) for regex in args.remove_re)
-                or any(track.name == name for name in args.remove)):
-            midi_file.tracks.remove(track)
-
-    if args.ignore_if_empty:
-        # If all tracks are empty (contain no notes), ignore the file
-        if not any(msg.type in ['note_on', 'note_off']
-                   for track in midi_file.tracks for msg in track):
-            print(f'Ignoring empty file {args.input_file}', file=sys.stderr)
-            return
-
-    midi_file.save(args.output_file)
+    try:
+        selector = TrackSelector.from_args(args.rule, args.rules, args.remove_re, args.remove)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    kwargs = dict(selector=selector, ignore_if_empty=args.ignore_if_empty, engine=args.engine)
+    rule_counts = collections.Counter()
+
+    if args.manifest:
+        input_dir = os.path.dirname(os.path.abspath(args.input_file))
+        paths = read_manifest(args.input_file)
+    elif os.path.isdir(args.input_file):
+        input_dir = args.input_file
+        paths = list_midi_files(input_dir)
+    else:
+        if args.archive:
+            parser.error('--archive requires batch mode')
+        fix_midi_file(args.input_file, args.output_file, rule_counts=rule_counts, **kwargs)
+        _print_rule_counts(selector, rule_counts)
+        return
+
+    counts = collections.Counter()
+    archive = None
+    kwargs.update(num_workers=args.jobs, chunksize=args.chunksize, overwrite=args.overwrite,
+                  rule_counts=rule_counts)
+    if args.archive:
+        archive = MidiArchive(args.output_file, 'a')
+        results = fix_midi_files_to_archive(input_dir, paths, archive, **kwargs)
+    else:
+        results = fix_midi_files(input_dir, paths, args.output_file, **kwargs)
+    try:
+        for i, (input_file, status, error) in enumerate(results):
+            counts[status] += 1
+            print(i+1, status, input_file, *([error] if error else []), sep='\t',
+                  file=sys.stderr)
+    finally:
+        if archive is not None:
+            results.close()
+            print(archive.format(), file=sys.stderr)
+            archive.close()
+
+    print(', '.join('{} {}'.format(counts[status], status)
+                    for status in ['done', 'empty', 'exists', 'failed']), file=sys.stderr)
+    _print_rule_counts(selector, rule_counts)
+    if counts['failed']:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""Index a directory of (fixed) RealBand MIDI files as a columnar note store.
+
+The store can be opened with `pybiab.note_store.NoteStore`, which memory-maps it so that the
+notes of any file can be sliced without parsing MIDI.
+"""
+
+import argparse
+import collections
+import multiprocessing
+import os
+import sys
+import traceback
+
+from ..midi_utils import patch_mido
+from ..note_store import read_notes, write_note_store
+from .fix_rb_midi import list_midi_files, read_manifest
+
+
+def _read_worker(task):
+    input_dir, path = task
+    try:
+        return path, read_notes(os.path.join(input_dir, path)), None
+    except Exception as e:
+        traceback.print_exc(file=sys.stderr)
+        return path, None, '{}: {}'.format(type(e).__name__, e)
+
+
+def read_midi_files(input_dir, paths, num_workers=None, chunksize=16):
+    """Read the notes of many MIDI files using a pool of worker processes.
+
+    Yields a `(path, notes, error)` tuple for each file in the order of `paths`, where `notes` is
+    a `SongNotes` or `None` if the file could not be read.
+    """
+    tasks = [(input_dir, path) for path in paths]
+    with multiprocessing.Pool(num_workers, initializer=patch_mido) as pool:
+        yield from pool.imap(_read_worker, tasks, chunksize=chunksize)
+
+
+def main():
+    patch_mido()
+
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input_dir', help='directory of MIDI files')
+    parser.add_argument('output_dir', help='output directory for the store')
+    parser.add_argument('--manifest', action='store_true',
+                        help='input_dir is a text file listing MIDI files, one per line, '
+                             'relative to its directory')
+    parser.add_argument('--jobs', '-j', type=int, default=None,
+                        help='number of worker processes (default: CPU count)')
+    parser.add_argument('--chunksize', type=int, default=16,
+                        help='number of files dispatched to a worker at a time')
+    args = parser.parse_args()
+
+    if args.manifest:
+        input_dir = os.path.dirname(os.path.abspath(args.input_dir))
+        paths = read_manifest(args.input_dir)
+    else:
+        input_dir = args.input_dir
+        paths = list_midi_files(input_dir)
+
+    counts = collections.Counter()
+
+    def songs():
+        results = read_midi_files(input_dir, paths, num_workers=args.jobs,
+                                  chunksize=args.chunksize)
+        for i, (path, notes, error) in enumerate(results):
+            status = 'done' if notes is not None else 'failed'
+            counts[status] += 1
+            print(i+1, status, path, *([error] if error else []), sep='\t', file=sys.stderr)
+            if notes is not None:
+                yield path, notes
+
+    write_note_store(args.output_dir, songs())
+
+    print(', '.join('{} {}'.format(counts[status], status)
+                    for status in ['done', 'failed']), file=sys.stderr)
+    if counts['failed']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
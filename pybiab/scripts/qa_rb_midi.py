@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""Check a corpus of RealBand MIDI files and summarize its statistics.
+
+Writes `files.jsonl` (the statistics of each file), `summary.npz` and `summary.json` (aggregate
+statistics) and `flagged.tsv` (the files which look broken or are outliers, with the reasons) to
+the output directory; see `pybiab.midi_qa`. Requires `pip install pybiab[index]`.
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import sys
+
+from ..midi_qa import CorpusStats, compute_stats
+from .fix_rb_midi import iter_manifest, iter_midi_files
+
+
+def iter_expected_bars(path):
+    """Read a TSV file with a MIDI file path (as listed in the corpus) and the expected number of
+    bars on each line, yielding the normalized path and the number of bars."""
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                midi_path, bars = line.rstrip('\r\n').split('\t')[:2]
+                yield os.path.normpath(midi_path), float(bars)
+
+
+class ExpectedBars:
+    """The expected numbers of bars from a TSV file (see `iter_expected_bars`).
+
+    The table is streamed into a temporary SQLite database rather than a dict, so that the memory
+    needed does not grow with the size of the corpus. Later lines override earlier ones.
+    """
+
+    def __init__(self, path):
+        # An empty name gives a private database on disk, deleted when it is closed
+        self._db = sqlite3.connect('')
+        self._db.execute('CREATE TABLE expected (path TEXT PRIMARY KEY, bars REAL NOT NULL)')
+        self._db.executemany('INSERT OR REPLACE INTO expected VALUES (?, ?)',
+                             iter_expected_bars(path))
+        self._db.commit()
+
+    def get(self, midi_path):
+        """Return the expected number of bars of a MIDI file, or None if it is not listed."""
+        row = self._db.execute('SELECT bars FROM expected WHERE path = ?',
+                               (os.path.normpath(midi_path),)).fetchone()
+        return row[0] if row else None
+
+    def close(self):
+        self._db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('input_dir', help='directory of MIDI files, or a manifest with --manifest')
+    parser.add_argument('output_dir')
+    parser.add_argument('--manifest', action='store_true',
+                        help='input_dir is a text file listing MIDI files, one per line, relative '
+                             'to its directory')
+    parser.add_argument('--expected-bars', type=str, default=None,
+                        help='TSV file with the path of a MIDI file and its expected length in '
+                             'bars on each line; shorter files are flagged')
+    parser.add_argument('--bar-tolerance', type=float, default=1.,
+                        help='number of bars by which a file may be shorter than expected')
+    parser.add_argument('--z-threshold', type=float, default=3.,
+                        help='number of standard deviations (of the log number of notes) beyond '
+                             'which a file is an outlier')
+    parser.add_argument('--jobs', '-j', type=int, default=None,
+                        help='number of worker processes (default: CPU count)')
+    parser.add_argument('--chunksize', type=int, default=16,
+                        help='number of files dispatched to a worker at a time')
+    args = parser.parse_args()
+
+    if args.manifest:
+        input_dir = os.path.dirname(os.path.abspath(args.input_dir))
+        paths = iter_manifest(args.input_dir)
+    else:
+        input_dir = args.input_dir
+        paths = iter_midi_files(input_dir)
+    expected = ExpectedBars(args.expected_bars) if args.expected_bars else None
+    tasks = ((os.path.join(input_dir, path), expected.get(path) if expected is not None else None)
+             for path in paths)
+
+    corpus = CorpusStats(args.output_dir, z_threshold=args.z_threshold,
+                         bar_tolerance=args.bar_tolerance)
+    try:
+        for i, stats in enumerate(compute_stats(tasks, num_workers=args.jobs,
+                                                chunksize=args.chunksize)):
+            corpus.add(stats)
+            if (i + 1) % 1000 == 0:
+                print(i + 1, 'files', file=sys.stderr)
+    finally:
+        if expected is not None:
+            expected.close()
+    summary = corpus.close()
+    print(json.dumps(summary, indent=2), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
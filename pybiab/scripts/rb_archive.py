@@ -0,0 +1,118 @@
+"""Inspect, query, extract or create an archive of outputs (see rb_render --archive)."""
+
+import argparse
+import os
+import sys
+
+from ..midi_archive import DEFAULT_SHARD_SIZE, MidiArchive
+from ..render_cache import parse_size
+from .fix_rb_midi import iter_midi_files
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('archive_dir', help='archive directory')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    subparsers.add_parser('stats', help='show the size of the archive and of its contents')
+
+    list_parser = subparsers.add_parser('list', help='list the entries (name, song, style, key, '
+                                                     'suffix and size) as TSV')
+    for field in ['song', 'style', 'key', 'suffix']:
+        list_parser.add_argument('--' + field, type=str, default=None,
+                                 help='only list the entries with this {}'.format(field))
+
+    cat_parser = subparsers.add_parser('cat', help='write an entry to stdout')
+    cat_parser.add_argument('name')
+
+    extract_parser = subparsers.add_parser('extract', help='extract entries into a directory')
+    extract_parser.add_argument('output_dir')
+    extract_parser.add_argument('names', nargs='*',
+                                help='names of the entries to extract (default: all)')
+
+    pack_parser = subparsers.add_parser('pack', help='add the files in a directory (e.g. the '
+                                                     'outputs of an earlier run) to the archive')
+    pack_parser.add_argument('input_dir')
+    pack_parser.add_argument('--all-files', action='store_true',
+                             help='add all files, not just MIDI files')
+    pack_parser.add_argument('--remove', action='store_true',
+                             help='remove each file once it is in the archive')
+    pack_parser.add_argument('--shard-size', type=parse_size, default=DEFAULT_SHARD_SIZE,
+                             help='size from which a new shard is started (e.g. 1G)')
+    args = parser.parse_args()
+
+    if args.command == 'pack':
+        _pack(args)
+        return
+
+    archive = MidiArchive(args.archive_dir)
+    try:
+        if args.command == 'stats':
+            stats = archive.stats()
+            print('entries: {}'.format(stats['entries']))
+            print('blobs:   {}'.format(stats['blobs']))
+            print('shards:  {}'.format(stats['shards']))
+            print('size:    {:.1f} MiB'.format(stats['size'] / 1024 ** 2))
+            print('stored:  {:.1f} MiB'.format(stats['stored'] / 1024 ** 2))
+            print('ratio:   {:.2f}x'.format(stats['size'] / max(stats['stored'], 1)))
+        elif args.command == 'list':
+            for entry in archive.find(args.song, args.style, args.key, args.suffix):
+                print(*['' if value is None else value for value in entry], sep='\t')
+        elif args.command == 'cat':
+            try:
+                data = archive.read(args.name)
+            except KeyError:
+                sys.exit('{} is not in the archive'.format(args.name))
+            sys.stdout.buffer.write(data)
+        else:
+            count = archive.extract(args.output_dir, args.names or None)
+            print('Extracted {} files'.format(count), file=sys.stderr)
+    finally:
+        archive.close()
+
+
+def _pack(args):
+    if args.all_files:
+        paths = _iter_files(args.input_dir, exclude=args.archive_dir)
+    else:
+        paths = iter_midi_files(args.input_dir)
+
+    archive = MidiArchive(args.archive_dir, 'a', shard_size=args.shard_size)
+    removable = []
+    try:
+        for i, path in enumerate(paths):
+            archive.add_file(path, os.path.join(args.input_dir, path))
+            removable.append(path)
+            if len(removable) >= 256:
+                archive.commit()
+                _remove(args, removable)
+            print(i+1, path, sep='\t', file=sys.stderr)
+        archive.commit()
+        _remove(args, removable)
+        print(archive.format(), file=sys.stderr)
+    finally:
+        archive.close()
+
+
+def _iter_files(input_dir, exclude):
+    """Yield the paths of the files under `input_dir` except hidden files and the files under
+    `exclude`, relative to `input_dir`."""
+    exclude = os.path.abspath(exclude)
+    for dirpath, dirnames, filenames in os.walk(input_dir):
+        dirnames[:] = sorted(dirname for dirname in dirnames
+                             if os.path.abspath(os.path.join(dirpath, dirname)) != exclude)
+        for fname in sorted(filenames):
+            if not fname.startswith('.'):
+                yield os.path.relpath(os.path.join(dirpath, fname), input_dir)
+
+
+def _remove(args, paths):
+    """Remove the packed files if requested, once they are committed."""
+    if args.remove:
+        for path in paths:
+            os.remove(os.path.join(args.input_dir, path))
+    paths.clear()
+
+
+if __name__ == '__main__':
+    main()
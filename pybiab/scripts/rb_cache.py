@@ -0,0 +1,33 @@
+"""Inspect or shrink a render cache created by rb_render --cache."""
+
+import argparse
+import sys
+
+from ..render_cache import RenderCache, parse_size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('cache_dir', help='render cache directory')
+    parser.add_argument('--evict', type=parse_size, default=None, metavar='SIZE',
+                        help='evict the least recently used outputs until the cache is at most '
+                             'SIZE (e.g. 20G) large')
+    args = parser.parse_args()
+
+    cache = RenderCache(args.cache_dir)
+    if args.evict is not None:
+        print('Evicted {} outputs'.format(cache.evict(args.evict)), file=sys.stderr)
+
+    stats = cache.stats()
+    cache.close()
+    print('entries:   {}'.format(stats['entries']))
+    print('size:      {:.1f} MiB'.format(stats['size'] / 1024 ** 2))
+    print('hits:      {}'.format(stats['hits']))
+    print('misses:    {}'.format(stats['misses']))
+    print('hit rate:  {:.1%}'.format(stats['hit_rate']))
+    print('stores:    {}'.format(stats['stores']))
+    print('evictions: {}'.format(stats['evictions']))
+
+
+if __name__ == '__main__':
+    main()
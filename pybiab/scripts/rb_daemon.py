@@ -0,0 +1,112 @@
+"""Keep RealBand running in a daemon process and send it render jobs.
+
+`rb_daemon serve` starts (or connects to) RealBand once and then renders the jobs sent to it
+with `rb_daemon render` (or `pybiab.daemon.DaemonClient`) until `rb_daemon stop`, so that each
+job costs only the rendering itself.
+"""
+
+import argparse
+import functools
+import sys
+
+from ..daemon import DaemonClient, serve
+
+
+def _serve(args):
+    # Only the daemon needs the renderer and controller
+    from ..instrumentation import RunLog
+    from ..job_ledger import JobLedger
+    from ..readiness import DEFAULT_NUM_TRIALS, TimeoutPolicy
+    from ..render_farm import DEFAULT_FORMAT, Renderer
+
+    if args.simulate is not None:
+        from ..simulated_controller import SimulatedController
+        factory = functools.partial(SimulatedController, time_scale=args.simulate)
+        standby_factory = (functools.partial(SimulatedController, time_scale=args.simulate)
+                           if args.standby else None)
+    else:
+        from ..realband_controller import DEFAULT_BINARY_PATH, RealBandController
+        factory = functools.partial(RealBandController, args.instance or DEFAULT_BINARY_PATH,
+                                    isolated=bool(args.standby))
+        standby_factory = (functools.partial(RealBandController, args.standby, isolated=True)
+                           if args.standby else None)
+
+    log = RunLog(args.log)
+    ledger = JobLedger(args.ledger) if args.ledger else None
+    timeouts = TimeoutPolicy(args.timeouts, num_trials=args.trials or DEFAULT_NUM_TRIALS)
+    renderer = Renderer(factory, song_dir=args.song_dir, style_dir=args.style_dir,
+                        output_format=args.format or [DEFAULT_FORMAT], log=log, ledger=ledger,
+                        standby_factory=standby_factory, timeouts=timeouts)
+    try:
+        serve(renderer, args.address)
+    finally:
+        renderer.close()
+        log.close()
+        print(log.summary.format(), file=sys.stderr)
+        if args.timeouts:
+            timeouts.save()
+        if ledger is not None:
+            ledger.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--address', type=str, default=None,
+                        help='Unix socket path or Windows named pipe to use (default: a '
+                             'per-machine default)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = subparsers.add_parser('serve', help='start the daemon')
+    serve_parser.add_argument('song_dir', help='directory with BIAB song files')
+    serve_parser.add_argument('style_dir', help='directory with BIAB style files')
+    serve_parser.add_argument('--format', '-f', type=str, action='append', default=[],
+                              help='file type to save; repeat to save several formats of each '
+                                   'job (see rb_render)')
+    serve_parser.add_argument('--instance', type=str, default=None,
+                              help='path to the RealBand executable')
+    serve_parser.add_argument('--standby', type=str, default=None,
+                              help='path to the RealBand executable of a further installation in '
+                                   'which to keep a standby instance running')
+    serve_parser.add_argument('--simulate', type=float, nargs='?', const=1., default=None,
+                              metavar='TIME_SCALE',
+                              help='simulate RealBand instead of controlling it')
+    serve_parser.add_argument('--log', type=str, default=None,
+                              help='JSONL file to append timed events to')
+    serve_parser.add_argument('--ledger', type=str, default=None,
+                              help='SQLite database to record the jobs in')
+    serve_parser.add_argument('--timeouts', type=str, default=None,
+                              help='JSON file in which the durations of the waits are kept between '
+                                   'runs to set the timeouts from')
+    serve_parser.add_argument('--trials', type=int, default=None,
+                              help='number of attempts at each job before giving up on it '
+                                   '(default: 3)')
+
+    render_parser = subparsers.add_parser('render', help='render a job with the daemon')
+    render_parser.add_argument('song', help='song file, relative to the daemon\'s song_dir')
+    render_parser.add_argument('style', help='style file, relative to the daemon\'s style_dir')
+    render_parser.add_argument('output_path')
+    render_parser.add_argument('--key', type=str, default=None)
+
+    subparsers.add_parser('ping', help='check that the daemon is running')
+    subparsers.add_parser('stop', help='stop the daemon')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        _serve(args)
+        return
+
+    with DaemonClient(args.address) as client:
+        if args.command == 'render':
+            status, error = client.render(args.song, args.style, args.output_path, args.key)
+        elif args.command == 'ping':
+            status, error = client.ping()
+        else:
+            status, error = client.stop()
+    if error:
+        print(error, file=sys.stderr)
+    if status == 'failed':
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,30 @@
 """Generate accompaniments using RealBand and save them."""
 
 import argparse
+import collections
+import functools
 import os
 import sys
-import time
-import traceback
 
-from pywinauto.timings import TimeoutError
+from ..instrumentation import RunLog
+from ..job_ledger import JobLedger
+from ..midi_archive import MidiArchive
+from ..pipeline import PostProcessor
+from ..preflight import preflight_jobs, write_rejects
+from ..readiness import DEFAULT_NUM_TRIALS, TimeoutPolicy
+from ..render_cache import RenderCache, parse_size
+from ..render_farm import (DEFAULT_FORMAT, format_extension, format_output_paths, parse_job_line,
+                           render_parallel, render_serial)
+from ..render_plan import count_loads, plan_jobs, plan_transpositions, write_plan
+from ..simulated_controller import SimulatedController, load_profile
+from ..song_file import SongFileError, read_song_info
+from ..track_select import TrackSelector
+from ..transpose import transpose_outputs
 
-from ..realband_controller import RealBandController
+LEDGER_NAME = '.rb_render.sqlite'
+TIMEOUTS_NAME = '.rb_render.timeouts.json'
+REJECT_FILE_NAME = 'rejected.tsv'
+UNTRANSPOSED_DIR_NAME = '.untransposed'
 
 
 def main():
@@ -20,58 +36,480 @@ def main():
                         help='TSV file containing on each line the path to a song file (relative '
                              'to song_dir) and the path to a style file (relative to style_dir) '
                              'and optionally the key to which the song should be transposed')
-    parser.add_argument('--format', '-f', type=str,
-                        default='MIDI File (.MID) (*.MID)')
+    parser.add_argument('--format', '-f', type=str, action='append', default=[],
+                        help='file type to save, as shown in the Save As dialog (default: {}); '
+                             'repeat to save several formats after generating each job once, '
+                             'the first under the job\'s output path and the others with the '
+                             'extension of their format'.format(DEFAULT_FORMAT))
     parser.add_argument('--suffix', type=str, default=None)
     parser.add_argument('--screenshot-dir', type=str, default=None)
+    parser.add_argument('--instance', type=str, action='append', default=[],
+                        help='path to the RealBand executable of a separate RealBand installation '
+                             'to render with; repeat to render with several instances in '
+                             'parallel, each in its own process')
+    parser.add_argument('--standby', type=str, action='append', default=[],
+                        help='path to the RealBand executable of a further installation in which '
+                             'to keep a standby instance running, which replaces a failed '
+                             'instance immediately; give one per --instance (or just one)')
+    parser.add_argument('--plan-only', action='store_true',
+                        help='only print the planned jobs (song, style, key and output path) as '
+                             'TSV, without starting RealBand or writing any files')
+    parser.add_argument('--log', type=str, default=None,
+                        help='JSONL file to append timed events (operations, waits, restarts and '
+                             'jobs) to; a summary is printed at the end in any case')
+    parser.add_argument('--simulate', type=float, nargs='?', const=1., default=None,
+                        metavar='TIME_SCALE',
+                        help='simulate RealBand instead of controlling it, optionally scaling the '
+                             'simulated latencies; any --instance values only set the number of '
+                             'workers')
+    parser.add_argument('--simulate-profile', type=str, default=None, metavar='FILE',
+                        help='with --simulate, take the latencies and failure rates of the '
+                             'simulated operations from a latency profile (see '
+                             'pybiab.simulated_controller.fit_profile)')
+    parser.add_argument('--ledger', type=str, default=None,
+                        help='SQLite database recording the progress of the jobs, used to skip '
+                             'finished jobs when resuming; defaults to {} in the output '
+                             'directory'.format(LEDGER_NAME))
+    parser.add_argument('--timeouts', type=str, default=None,
+                        help='JSON file in which the durations of the waits are kept between '
+                             'runs to set the timeouts from (see pybiab.readiness.TimeoutPolicy); '
+                             'defaults to {} in the output directory'.format(TIMEOUTS_NAME))
+    parser.add_argument('--trials', type=int, default=DEFAULT_NUM_TRIALS,
+                        help='number of attempts at each job before giving up on it')
+    parser.add_argument('--reject-file', type=str, default=None,
+                        help='TSV file to write the lines of song_style_file which fail the '
+                             'pre-flight checks to, with the reason; defaults to {} in the output '
+                             'directory'.format(REJECT_FILE_NAME))
+    parser.add_argument('--cache', type=str, default=None,
+                        help='render cache directory; jobs with the same song and style file '
+                             'contents, key, format and RealBand version as a cached output are '
+                             'not rendered again')
+    parser.add_argument('--cache-size', type=parse_size, default=None,
+                        help='maximum size of the render cache (e.g. 20G); the least recently '
+                             'used outputs are evicted')
+    parser.add_argument('--offline-transpose', action='store_true',
+                        help='render each song and style only once, in the original key, and '
+                             'produce the jobs with a key by transposing the MIDI output; the '
+                             'output in the original key is kept in {} in the output directory '
+                             'unless it is itself a job; implies --key-in-name'.format(
+                                 UNTRANSPOSED_DIR_NAME))
+    parser.add_argument('--key-in-name', action='store_true',
+                        help='include the key of each job in its output file name '
+                             '(SONG.STYLE.KEY.mid), so that the same song and style can be '
+                             'rendered in several keys; by default, the key is not part of the '
+                             'name')
+    parser.add_argument('--archive', type=str, default=None,
+                        help='move the outputs of the jobs into a deduplicated archive in this '
+                             'directory (see pybiab.midi_archive) as soon as they are done, '
+                             'instead of keeping one file per job; with --fix-dir, the fixed '
+                             'MIDI files are archived instead of the rendered ones, which are '
+                             'removed')
+
+    post_group = parser.add_argument_group(
+        'post-processing', 'fix the rendered MIDI files (as fix_rb_midi does) in parallel with '
+                           'the rendering, as soon as each file is saved')
+    post_group.add_argument('--fix-dir', type=str, default=None,
+                            help='output directory for the fixed files; enables post-processing of '
+                                 'the MIDI output (requires a MIDI --format)')
+    post_group.add_argument('--index-dir', type=str, default=None,
+                            help='also write the notes of the fixed files to a note store in this '
+                                 'directory (as index_rb_midi does)')
+    post_group.add_argument('--post-jobs', type=int, default=None,
+                            help='number of post-processing worker processes (default: CPU '
+                                 'count)')
+    post_group.add_argument('--queue-size', type=int, default=64,
+                            help='number of files which can wait for post-processing before the '
+                                 'rendering is paused')
+    post_group.add_argument('--remove-re', type=str, action='append', default=[])
+    post_group.add_argument('--remove', type=str, action='append', default=[])
+    post_group.add_argument('--ignore-if-empty', action='store_true')
+    post_group.add_argument('--engine', choices=['mido', 'raw'], default='raw')
     args = parser.parse_args()
+    if args.index_dir and not args.fix_dir:
+        parser.error('--index-dir requires --fix-dir')
+    try:
+        selector = TrackSelector.from_args(remove_re=args.remove_re, remove=args.remove)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.standby and len(args.standby) != max(len(args.instance), 1):
+        parser.error('give one --standby per --instance')
+    if args.simulate_profile and args.simulate is None:
+        parser.error('--simulate-profile requires --simulate')
+    if args.archive and args.offline_transpose:
+        parser.error('--archive does not work with --offline-transpose, which needs the '
+                     'rendered files')
+    formats = args.format or [DEFAULT_FORMAT]
+    try:
+        format_output_paths('job.mid', formats)
+    except ValueError as e:
+        parser.error(str(e))
+    if len(formats) > 1 and args.offline_transpose:
+        parser.error('--offline-transpose only works with a single (MIDI) --format')
+    if args.fix_dir and '.mid' not in map(format_extension, formats):
+        parser.error('--fix-dir requires a MIDI --format')
+
+    key_in_name = args.key_in_name or args.offline_transpose
+    all_jobs, rejected = preflight_jobs(args.song_style_file, args.song_dir, args.style_dir,
+                                        args.output_dir, args.suffix, key_in_name=key_in_name)
+    reject_file = args.reject_file or os.path.join(args.output_dir, REJECT_FILE_NAME)
+    ledger_path = args.ledger or os.path.join(args.output_dir, LEDGER_NAME)
+    if args.plan_only:
+        # Plan from the ledger and the archive if they exist, without creating or changing
+        # anything
+        if rejected:
+            print('Rejected {} lines'.format(len(rejected)), file=sys.stderr)
+        ledger = _open_if_exists(JobLedger, ledger_path, 'r')
+        archive = _open_if_exists(MidiArchive, args.archive, 'r') if args.archive else None
+    else:
+        os.makedirs(args.output_dir, exist_ok=True)
+        if rejected or os.path.exists(reject_file):
+            # Also overwrite the rejects of an earlier run
+            with open(reject_file, 'w', encoding='utf-8') as f:
+                write_rejects(f, rejected)
+        if rejected:
+            print('Rejected {} lines, see {}'.format(len(rejected), reject_file),
+                  file=sys.stderr)
+        ledger = JobLedger(ledger_path)
+        archive = MidiArchive(args.archive, 'a') if args.archive else None
+
+    done = ledger.done() if ledger is not None else set()
+    if ledger is None or ledger.is_new:
+        # Adopt the outputs of runs made before the ledger was used
+        done |= adopt_outputs(all_jobs, formats, args.output_dir, archive=archive,
+                              ledger=None if args.plan_only else ledger)
+    base_jobs = None
+    if args.offline_transpose:
+        base_jobs = make_base_jobs(all_jobs, args.output_dir, args.suffix)
+    if not args.plan_only:
+        ledger.add(key for job in all_jobs for key in output_keys(job, formats))
+        if base_jobs:
+            ledger.add(JobLedger.key(job.output_path) for job in base_jobs.values())
+
+    run = plan_render(all_jobs, formats, done, base_jobs)
+    if run.plan.existing:
+        print('{} jobs already done'.format(len(run.plan.existing)), file=sys.stderr)
+    for job in run.plan.duplicates:
+        print('Skipping duplicate job for {}'.format(
+            os.path.relpath(job.output_path, args.output_dir)), file=sys.stderr)
+    if args.offline_transpose:
+        print('{} jobs to derive by transposition'.format(
+            sum(len(derived_jobs) for derived_jobs in run.derived.values())), file=sys.stderr)
+    planned = set(run.plan.jobs)
+    naive_loads = count_loads(job for job in all_jobs if job in planned)
+    loads = count_loads(run.jobs)
+    print('{} jobs to render: {} song loads and {} style loads (instead of {} and {} in the '
+          'original order)'.format(len(run.jobs), loads.songs, loads.styles,
+                                   naive_loads.songs, naive_loads.styles), file=sys.stderr)
+    if args.plan_only:
+        write_plan(sys.stdout, run.jobs)
+        if ledger is not None:
+            ledger.close()
+        if archive is not None:
+            archive.close()
+        return
+    manifest_jobs = set(all_jobs)
+    jobs, ready = run.jobs, list(run.ready)
+
+    post_processor = None
+    if args.fix_dir:
+        post_processor = PostProcessor(
+            args.fix_dir, index_dir=args.index_dir, num_workers=args.post_jobs,
+            queue_size=args.queue_size, selector=selector, ignore_if_empty=args.ignore_if_empty,
+            engine=args.engine, archive_dir=args.archive,
+            # The render cache keeps its own link or copy of each rendered file (stored before
+            # the job is delivered), so the rendered files are not needed once archived
+            remove_inputs=args.archive is not None)
+    delivery = OutputDelivery(args.output_dir, formats, args.suffix,
+                              post_processor=post_processor, archive=archive)
+
+    cache, cache_keys = None, {}
+    if args.cache:
+        versions = _realband_versions(args)
+        if len(versions) > 1:
+            parser.error('--cache requires all instances to have the same RealBand version')
+        version, = versions
+
+        cache = RenderCache(args.cache, max_size=args.cache_size)
+        hits, jobs, cache_keys = lookup_cache(cache, jobs, formats, args.song_dir,
+                                              args.style_dir, version)
+        for job in hits:
+            ledger.mark_done(output_keys(job, formats))
+            if job in manifest_jobs:
+                delivery.deliver(job)
+            if job in run.derived:
+                ready.append(job)
+        print('{} cache hits, {} jobs left to render'.format(len(hits), len(jobs)),
+              file=sys.stderr)
+
+    log = RunLog(args.log)
+    timeouts = TimeoutPolicy(args.timeouts or os.path.join(args.output_dir, TIMEOUTS_NAME),
+                             num_trials=args.trials)
+    renderer_kwargs = dict(song_dir=args.song_dir, style_dir=args.style_dir,
+                           output_format=formats, screenshot_dir=args.screenshot_dir,
+                           log=log, ledger=ledger, timeouts=timeouts)
+    factories, standby_factories = _controller_factories(args)
+    if not jobs:
+        results = []
+    elif len(factories) > 1:
+        results = render_parallel(jobs, factories, standby_factories=standby_factories or None,
+                                  **renderer_kwargs)
+    else:
+        results = render_serial(jobs, factories[0],
+                                standby_factory=standby_factories[0] if standby_factories else None,
+                                **renderer_kwargs)
+    transpose = functools.partial(transpose_derived, song_dir=args.song_dir, ledger=ledger,
+                                  engine=args.engine)
+
+    num_failed = 0
+    try:
+        for i, (job, status, error) in enumerate(collect_results(
+                results, manifest_jobs, run.derived, ready, transpose, cache, cache_keys)):
+            song_name, _ = os.path.splitext(job.song)
+            style_name, _ = os.path.splitext(job.style)
+            name = [song_name, style_name] + ([job.key] if job.key else [])
+            if status == 'failed':
+                num_failed += 1
+                print(i+1, *name, status, error, sep='\t', file=sys.stderr)
+            else:
+                print(i+1, *name, sep='\t', file=sys.stderr)
+                delivery.deliver(job)
+        # Include the files rendered by earlier runs, so that the note store is complete and no
+        # output is left outside of the archive
+        delivery.deliver_existing(run.plan.existing)
+    finally:
+        if post_processor is not None:
+            post_processor.close()
+            print(post_processor.format(), file=sys.stderr)
+            num_failed += post_processor.counts['failed']
+        if cache is not None:
+            cache.close()
+        if archive is not None:
+            print(archive.format(), file=sys.stderr)
+            archive.close()
+        log.close()
+        print(log.summary.format(), file=sys.stderr)
+        timeouts.save()
+        print(', '.join('{} {}'.format(count, state)
+                        for state, count in sorted(ledger.counts().items())),
+              'jobs in the ledger', file=sys.stderr)
+        ledger.close()
+    if num_failed:
+        sys.exit(1)
+
+
+def output_keys(job, formats):
+    """Return the ledger keys of the outputs of a job, one per format."""
+    return [JobLedger.key(path) for _, path in format_output_paths(job.output_path, formats)]
+
+
+def adopt_outputs(jobs, formats, output_dir, archive=None, ledger=None):
+    """Return the ledger keys of the outputs of `jobs` which exist, as files or in the archive
+    (under their path relative to `output_dir`), marking them as done in `ledger` if given.
+
+    This adopts the outputs of runs made before the ledger was used.
+    """
+    adopted = {JobLedger.key(path) for job in jobs
+               for _, path in format_output_paths(job.output_path, formats)
+               if os.path.exists(path)
+               or (archive is not None and os.path.relpath(path, output_dir) in archive)}
+    if ledger is not None:
+        ledger.mark_done(adopted)
+    return adopted
+
+
+def make_base_jobs(jobs, output_dir, suffix=None):
+    """Return a dict mapping the song and style of each job to a job rendering them in the
+    original key, for `--offline-transpose`.
+
+    This is a job of `jobs` without a key if there is one, and otherwise a new job with its
+    output in the `UNTRANSPOSED_DIR_NAME` directory.
+    """
+    base_jobs = {}
+    for job in jobs:
+        if job.key is None:
+            base_jobs.setdefault((job.song, job.style), job)
+    for job in jobs:
+        if (job.song, job.style) not in base_jobs:
+            base_jobs[job.song, job.style] = parse_job_line(
+                '{}\t{}'.format(job.song, job.style),
+                os.path.join(output_dir, UNTRANSPOSED_DIR_NAME), suffix)
+    return base_jobs
+
+
+RenderRun = collections.namedtuple('RenderRun', ['plan', 'jobs', 'derived', 'ready'])
+
+
+def plan_render(all_jobs, formats, done, base_jobs=None):
+    """Plan a run from the ledger keys of the outputs which are `done`.
+
+    A job is only done once the outputs of all its formats are. With `base_jobs` (see
+    `make_base_jobs`), the jobs with a key are derived from the base jobs by transposition (see
+    `plan_transpositions`).
+
+    Returns a `RenderRun` with the `RenderPlan`, the jobs to render, a dict mapping each base job
+    to the jobs to derive from it and the base jobs whose output already exists but which have
+    jobs left to derive.
+    """
+    if len(formats) > 1:
+        done = {JobLedger.key(job.output_path) for job in all_jobs
+                if all(key in done for key in output_keys(job, formats))}
+    plan = plan_jobs(all_jobs, done=done)
+    if base_jobs is None:
+        return RenderRun(plan, plan.jobs, {}, [])
+    jobs, derived = plan_transpositions(plan.jobs, base_jobs)
+    ready = [job for job in jobs if job in derived and JobLedger.key(job.output_path) in done]
+    return RenderRun(plan, [job for job in jobs if job not in ready], derived, ready)
+
+
+def lookup_cache(cache, jobs, formats, song_dir, style_dir, version):
+    """Fetch the outputs of jobs from a `RenderCache`.
+
+    Returns the jobs whose outputs were all fetched, the jobs left to render and a dict mapping
+    each job left to render to the `(cache key, path)` pairs of its outputs, to store them once
+    they are rendered.
+    """
+    hits, misses, cache_keys = [], [], {}
+    for job in jobs:
+        try:
+            outputs = [(cache.job_key(os.path.join(song_dir, job.song),
+                                      os.path.join(style_dir, job.style),
+                                      job.key, output_format, version), path)
+                       for output_format, path in format_output_paths(job.output_path, formats)]
+        except OSError:
+            # Let the renderer report the missing file
+            misses.append(job)
+            continue
+        if all(cache.fetch(cache_key, path) for cache_key, path in outputs):
+            hits.append(job)
+        else:
+            cache_keys[job] = outputs
+            misses.append(job)
+    return hits, misses, cache_keys
+
+
+class OutputDelivery:
+    """Passes the outputs of finished jobs on to a `PostProcessor` and/or a `MidiArchive`.
+
+    The post-processor gets the MIDI output (and archives the fixed file). The other outputs are
+    added to the archive and removed. The outputs are archived under their path relative to
+    `output_dir`.
+    """
+
+    def __init__(self, output_dir, formats, suffix=None, post_processor=None, archive=None):
+        self._output_dir = output_dir
+        self._formats = formats
+        self._suffix = suffix
+        self._post_processor = post_processor
+        self._archive = archive
+        self._midi_index = next((i for i, output_format in enumerate(formats)
+                                 if format_extension(output_format) == '.mid'), None)
+        if post_processor is not None and self._midi_index is None:
+            raise ValueError('post-processing requires a MIDI format')
+
+    def archive_name(self, path):
+        return os.path.relpath(path, self._output_dir)
+
+    def deliver(self, job):
+        """Deliver the outputs of a finished job."""
+        paths = [path for _, path in format_output_paths(job.output_path, self._formats)]
+        info = dict(song=job.song, style=job.style, key=job.key, suffix=self._suffix)
+        if self._post_processor is not None:
+            midi_path = paths.pop(self._midi_index)
+            self._post_processor.submit(midi_path, self.archive_name(midi_path), **info)
+        if self._archive is not None:
+            paths = [path for path in paths if os.path.exists(path)]
+            for path in paths:
+                self._archive.add_file(self.archive_name(path), path, **info)
+            self._archive.commit()
+            for path in paths:
+                os.remove(path)
+
+    def deliver_existing(self, jobs):
+        """Deliver the outputs of jobs finished by earlier runs which are still to be
+        post-processed or archived."""
+        if self._post_processor is None and self._archive is None:
+            return
+        for job in jobs:
+            if (os.path.exists(job.output_path) and
+                    (self._archive is None
+                     or self.archive_name(job.output_path) not in self._archive)):
+                self.deliver(job)
+
+
+def transpose_derived(base_job, jobs, song_dir, ledger, engine='raw'):
+    """Derive `jobs` from the output of `base_job` by transposition, recording them in the
+    ledger. Yields a `(job, status, error)` tuple for each job."""
+    try:
+        song_key = read_song_info(os.path.join(song_dir, base_job.song)).key
+    except (OSError, SongFileError):
+        song_key = None  # Read it from the output
+    for job, status, error in transpose_outputs(base_job.output_path, jobs, song_key,
+                                                engine=engine):
+        if status == 'done':
+            ledger.mark_done([JobLedger.key(job.output_path)])
+        else:
+            ledger.fail(JobLedger.key(job.output_path), error)
+        yield job, status, error
+
+
+def collect_results(results, manifest_jobs, derived, ready, transpose, cache=None,
+                    cache_keys=None):
+    """Yield the `(job, status, error)` results of the jobs of the manifest.
+
+    The results of the rendered jobs are followed by those of the jobs derived from them with
+    `transpose(base_job, jobs)` (see `transpose_derived`), and the jobs derived from the `ready`
+    base jobs come first. The base jobs which are not in the manifest are only reported if they
+    fail. The outputs of the rendered jobs are stored in the cache under their `cache_keys` (see
+    `lookup_cache`).
+    """
+    for base_job in ready:
+        yield from transpose(base_job, derived[base_job])
+    for job, status, error in results:
+        if status == 'done' and cache_keys and job in cache_keys:
+            for cache_key, path in cache_keys[job]:
+                cache.store(cache_key, path)
+        if job in manifest_jobs or status == 'failed':
+            yield job, status, error
+        if job in derived:
+            if status == 'done':
+                yield from transpose(job, derived[job])
+            else:
+                for derived_job in derived[job]:
+                    yield derived_job, 'failed', 'the original key failed to render'
+
+
+def _realband_versions(args):
+    """Return the set of RealBand versions of the instances, for the render cache."""
+    if args.simulate is not None:
+        return {SimulatedController.realband_version}
+    # Only import the GUI automation libraries when they are needed
+    from ..realband_controller import DEFAULT_BINARY_PATH, get_realband_version
+    return {get_realband_version(binary_path)
+            for binary_path in (args.instance or [DEFAULT_BINARY_PATH]) + args.standby}
+
+
+def _controller_factories(args):
+    """Return the controller factories of the instances and of the standby instances."""
+    if args.simulate is not None:
+        profile = load_profile(args.simulate_profile) if args.simulate_profile else {}
+        factory = functools.partial(SimulatedController, time_scale=args.simulate, **profile)
+        return [factory for _ in args.instance or [None]], [factory for _ in args.standby]
+    from ..realband_controller import DEFAULT_BINARY_PATH, RealBandController
+    # Installations running side by side need to be isolated from each other
+    isolated = len(args.instance) > 1 or bool(args.standby)
+    factories = [functools.partial(RealBandController, binary_path, isolated=isolated)
+                 for binary_path in args.instance or [DEFAULT_BINARY_PATH]]
+    standby_factories = [functools.partial(RealBandController, binary_path, isolated=True)
+                         for binary_path in args.standby]
+    return factories, standby_factories
+
 
-    rb = RealBandController()
-
-    current_song = None
-    with open(args.song_style_file, encoding='utf-8') as f:
-        for i, line in enumerate(f):
-            fields = line.rstrip('\n').split('\t')
-            song, style, *fields = fields
-            key = fields[0] if fields else None
-
-            song_name, _ = os.path.splitext(song)
-            style_name, _ = os.path.splitext(style)
-            output_file = '{}.{}{}.mid'.format(
-                song_name, style_name, '.' + args.suffix if args.suffix else '')
-            output_path = os.path.join(args.output_dir, output_file)
-            if os.path.exists(output_path):
-                print('{} already exists'.format(output_file), file=sys.stderr)
-                continue
-
-            NUM_TRIALS = 3
-            for trial_num in range(NUM_TRIALS):
-                try:
-                    if song != current_song:
-                        rb.load_song(os.path.join(args.song_dir, song))
-                        current_song = song
-                        time.sleep(0.1)
-                        rb.wait_ready()
-                        if args.screenshot_dir:
-                            rb.app.RealBand.capture_as_image().save(
-                                os.path.join(args.screenshot_dir,
-                                             song.replace('/', '_') +'.png'))
-                    rb.load_style(os.path.join(args.style_dir, style))
-                    if key and key != rb.key_signature:
-                        rb.set_key(key, transpose=True)
-                    rb.generate_all()
-                    rb.save_song(output_path, args.format)
-                    break
-                except (TimeoutError, RuntimeError, OSError) as e:
-                    if trial_num == NUM_TRIALS - 1:
-                        raise e from None
-                    traceback.print_exc(file=sys.stderr)
-                    print('Restarting RealBand', file=sys.stderr)
-                    rb.kill()
-                    rb = RealBandController(try_connect=False)
-                    current_song = None
-
-            print(i+1, song_name, style_name, sep='\t', file=sys.stderr)
+def _open_if_exists(cls, path, mode):
+    """Open a `JobLedger` or `MidiArchive` at `path`, or return None if there is none."""
+    try:
+        return cls(path, mode)
+    except FileNotFoundError:
+        return None
 
 
 if __name__ == '__main__':
@@ -0,0 +1,214 @@
+"""A simulated controller for testing and benchmarking without Band-in-a-Box or RealBand.
+
+The latencies and failure rates of the simulation can be fitted to a real run with `fit_profile`
+(from the events of its `RunLog`) and saved as a JSON *latency profile*, which the scripts load
+with `--simulate-profile`.
+"""
+
+import collections
+import json
+import math
+import os
+import random
+import statistics
+import time
+
+from .controller import EditController, RenderController
+from .readiness import TimeoutPolicy, WaitRecorder
+
+# An empty type 1 MIDI file with a single track
+_EMPTY_MIDI = (b'MThd\x00\x00\x00\x06\x00\x01\x00\x01\x00\x78'
+               b'MTrk\x00\x00\x00\x04\x00\xff\x2f\x00')
+
+
+class SimulatedFailure(RuntimeError):
+    """Raised by `SimulatedController` when an operation fails.
+
+    This is a `RuntimeError` like pywinauto's `TimeoutError`, so it is handled the same way.
+    """
+
+
+class SimulatedController(RenderController, EditController):
+    """A controller which simulates the latency and failures of RealBand.
+
+    `latency` maps operation names (the method names and `'start'`) to the `(median, sigma)` of
+    a log-normal distribution of their duration in seconds, which is multiplied by `time_scale`.
+    `failure_rate` maps operation names to the probability that they raise `SimulatedFailure`.
+    Both update the defaults in `DEFAULT_LATENCY` and `DEFAULT_FAILURE_RATE`. Once an operation
+    has failed, the simulated application has crashed and all further operations fail too, until
+    a new controller is created. `transient_failure_rate` gives the probability of failures which
+    leave the application stuck in a dialog instead, until `recover` is called. `hang_rate` gives
+    the probability that an operation never finishes; like any operation taking longer than the
+    timeout set by the `TimeoutPolicy` in `timeouts` (by default `DEFAULT_TIMEOUT` times
+    `time_scale`), it then fails once the timeout has passed, leaving the application crashed.
+    The durations of the operations are recorded as waits in `wait_stats` and the policy (per
+    style for `load_style` and `generate_all`), like the waits of the real controllers.
+
+    `save_song` writes an empty MIDI file if `write_output` is set.
+    """
+    DEFAULT_LATENCY = {
+        'start': (5., .3),
+        'load_song': (1., .5),
+        'load_style': (1., .5),
+        'set_key': (.5, .3),
+        'generate_all': (8., .5),
+        'save_song': (.5, .3),
+        'recover': (.5, .3),
+        'change_song_settings': (1.5, .3),
+        'send_chord_sheet_keys': (.3, .3),
+    }
+    DEFAULT_FAILURE_RATE = {}
+    DEFAULT_TIMEOUT = 60.
+    realband_version = 'simulated'
+
+    def __init__(self, try_connect=True, latency=None, failure_rate=None, time_scale=1.,
+                 seed=None, write_output=True, transient_failure_rate=None, hang_rate=None,
+                 timeouts=None):
+        self.wait_stats = WaitRecorder()
+        self.timeouts = timeouts or TimeoutPolicy()
+        self._latency = dict(self.DEFAULT_LATENCY, **(latency or {}))
+        self._failure_rate = dict(self.DEFAULT_FAILURE_RATE, **(failure_rate or {}))
+        self._transient_failure_rate = transient_failure_rate or {}
+        self._hang_rate = hang_rate or {}
+        self._time_scale = time_scale
+        self._rng = random.Random(seed)
+        self._write_output = write_output
+        self._crashed = False
+        self._stuck = False
+
+        self.song = None
+        self.style = None
+        self._key = None
+
+        if not try_connect:
+            self._simulate('start')
+
+    def _simulate(self, operation, context=None):
+        if self._crashed:
+            raise SimulatedFailure('{} failed: the application has crashed'.format(operation))
+        if self._stuck:
+            raise SimulatedFailure('{} failed: a dialog is in the way'.format(operation))
+        median, sigma = self._latency.get(operation, (0., 0.))
+        duration = median * math.exp(sigma * self._rng.gauss(0., 1.)) * self._time_scale
+        if self._rng.random() < self._failure_rate.get(operation, 0.):
+            time.sleep(self._rng.random() * duration)
+            self._crashed = True
+            raise SimulatedFailure('{} failed'.format(operation))
+        if self._rng.random() < self._transient_failure_rate.get(operation, 0.):
+            time.sleep(self._rng.random() * duration)
+            self._stuck = True
+            raise SimulatedFailure('{} failed: an unexpected dialog appeared'.format(operation))
+        if operation in self._hang_rate and self._rng.random() < self._hang_rate[operation]:
+            duration = math.inf
+        timeout = self.timeouts.timeout(operation, self.DEFAULT_TIMEOUT * self._time_scale,
+                                        context)
+        if duration > timeout:
+            time.sleep(timeout)
+            self._record(operation, timeout, True, context)
+            self._crashed = True
+            raise SimulatedFailure('{} timed out after {:.1f} s'.format(operation, timeout))
+        time.sleep(duration)
+        self._record(operation, duration, False, context)
+
+    def _record(self, operation, duration, timed_out, context):
+        for recorder in [self.wait_stats, self.timeouts]:
+            recorder.record(operation, duration, timed_out=timed_out, context=context)
+
+    def load_song(self, path):
+        self._simulate('load_song')
+        self.song, self.style, self._key = path, None, 'C'
+
+    def load_style(self, path):
+        self._simulate('load_style', os.path.basename(path))
+        self.style = path
+
+    def save_song(self, path, filetype=None):
+        self._simulate('save_song')
+        if self._write_output:
+            with open(path, 'wb') as f:
+                f.write(_EMPTY_MIDI)
+
+    def change_song_settings(self, tempo=None, last_bar=None, **checkboxes):
+        self._simulate('change_song_settings')
+
+    def send_chord_sheet_keys(self, keys):
+        self._simulate('send_chord_sheet_keys')
+
+    def generate_all(self):
+        self._simulate('generate_all', self.style and os.path.basename(self.style))
+
+    def set_key(self, key, transpose=False):
+        if key not in self.KEYS:
+            raise ValueError('invalid key {!r}'.format(key))
+        self._simulate('set_key')
+        self._key = key
+
+    @property
+    def key_signature(self):
+        return self._key
+
+    @property
+    def time_signature(self):
+        return '4/4'
+
+    @property
+    def tempo(self):
+        return 120.
+
+    def wait_ready(self, timeout=30):
+        self._simulate('wait_ready')
+
+    def kill(self):
+        self._crashed = True
+
+    def is_alive(self):
+        return not self._crashed
+
+    def recover(self):
+        if self._crashed:
+            return False
+        self._stuck = False
+        self._simulate('recover')
+        return True
+
+
+def fit_profile(events):
+    """Fit a latency profile to the `'operation'` events of a `RunLog`.
+
+    Returns a dict with the `latency` (the median and the standard deviation of the logarithm
+    of the durations) and the `failure_rate` of each operation, which can be passed as keyword
+    arguments to `SimulatedController`.
+    """
+    durations = collections.defaultdict(list)
+    failures = collections.Counter()
+    for event in events:
+        if event.get('event') != 'operation':
+            continue
+        durations[event['operation']].append(event['duration'])
+        if not event['ok']:
+            failures[event['operation']] += 1
+
+    latency, failure_rate = {}, {}
+    for operation, values in sorted(durations.items()):
+        logs = [math.log(value) for value in values if value > 0]
+        if logs:
+            latency[operation] = (math.exp(statistics.median(logs)),
+                                  statistics.stdev(logs) if len(logs) > 1 else 0.)
+        if failures[operation]:
+            failure_rate[operation] = failures[operation] / len(values)
+    return dict(latency=latency, failure_rate=failure_rate)
+
+
+def save_profile(profile, path):
+    """Save a latency profile as JSON."""
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(profile, f, indent=2, sort_keys=True)
+
+
+def load_profile(path):
+    """Load a latency profile saved with `save_profile`."""
+    with open(path, encoding='utf-8') as f:
+        profile = json.load(f)
+    return dict(latency={operation: tuple(value)
+                         for operation, value in profile.get('latency', {}).items()},
+                failure_rate=profile.get('failure_rate', {}))
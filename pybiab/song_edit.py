@@ -0,0 +1,194 @@
+"""Applying the same edits to many Band-in-a-Box songs.
+
+An edit is a list of `EditStep`s, each written as `action=value` on the command line:
+
+- `tempo=N` sets the tempo
+- `length=N` sets the number of the last bar
+- `ending=on|off` turns the 2 bar ending on or off
+- `style_aliases=on|off` turns the automatic substitution of the style on or off
+- `substyle=N` toggles the substyle (part marker) at bar N, which must be at the start of a row
+  of the chord sheet (1, 5, 9, ...)
+- `keys=KEYS` sends keystrokes (in pywinauto's notation, e.g. `{DOWN}p`) to the chord sheet
+
+Consecutive steps changing song settings are applied in a single visit to the song settings
+dialog. The songs are edited by a `SongEditor`, which retries, recovers and restarts Band-in-a-Box
+and records the jobs in a ledger and log exactly like `Renderer`, so edits can be run with
+`render_serial` and `render_parallel`.
+
+The tempo, length and substyle steps can also be applied directly to the song files with
+`edit_song_files` (see `song_file.SongFile`), without Band-in-a-Box.
+"""
+
+import collections
+import os
+import re
+
+from .job_ledger import atomic_output, write_atomic
+from .render_farm import Renderer
+from .song_file import SongFile
+
+EditStep = collections.namedtuple('EditStep', ['action', 'value'])
+EditJob = collections.namedtuple('EditJob', ['song', 'output_path'])
+
+SONG_FILE_RE = r'\.[SM]G.$'
+
+# Actions which `edit_song_files` can apply without Band-in-a-Box
+DIRECT_ACTIONS = frozenset(['tempo', 'length', 'substyle'])
+
+_BARS_PER_ROW = 4
+
+
+def _parse_switch(text):
+    if text.lower() in ('on', 'true', 'yes', '1'):
+        return True
+    if text.lower() in ('off', 'false', 'no', '0'):
+        return False
+    raise ValueError('expected on or off, got {!r}'.format(text))
+
+
+def _parse_bar(text):
+    bar = int(text)
+    if bar < 1 or (bar - 1) % _BARS_PER_ROW:
+        raise ValueError('bar {} is not at the start of a row of the chord sheet'.format(bar))
+    return bar
+
+
+_STEP_PARSERS = {
+    'tempo': int,
+    'length': int,
+    'ending': _parse_switch,
+    'style_aliases': _parse_switch,
+    'substyle': _parse_bar,
+    'keys': str,
+}
+
+# Steps applied in the song settings dialog, with the corresponding keyword argument of
+# `BandInABoxController.change_song_settings`
+_SETTINGS = {'tempo': 'tempo', 'length': 'last_bar', 'ending': 'ending',
+             'style_aliases': 'style_aliases'}
+
+
+def parse_step(text):
+    """Parse an `action=value` string as an `EditStep`. Raises `ValueError` if it is invalid."""
+    action, sep, value = text.partition('=')
+    if not sep:
+        raise ValueError('expected action=value, got {!r}'.format(text))
+    action = action.strip()
+    if action not in _STEP_PARSERS:
+        raise ValueError('unknown action {!r}, expected one of {}'.format(
+            action, ', '.join(_STEP_PARSERS)))
+    return EditStep(action, _STEP_PARSERS[action](value if action == 'keys' else value.strip()))
+
+
+def group_steps(steps):
+    """Group the steps into calls to the controller.
+
+    Returns a list of `('settings', kwargs)` pairs, each for a single call of
+    `change_song_settings` with the settings of consecutive steps, and `('keys', keys)` pairs.
+    """
+    calls = []
+    for step in steps:
+        if step.action in _SETTINGS:
+            if not calls or calls[-1][0] != 'settings':
+                calls.append(('settings', {}))
+            calls[-1][1][_SETTINGS[step.action]] = step.value
+        elif step.action == 'substyle':
+            calls.append(('keys', '{HOME}' + '{DOWN}' * ((step.value - 1) // _BARS_PER_ROW)
+                          + 'p'))
+        else:
+            calls.append(('keys', step.value))
+    return calls
+
+
+def apply_steps(bb, steps):
+    """Apply edit steps to the current song of a `BandInABoxController`."""
+    for call, args in group_steps(steps):
+        if call == 'settings':
+            bb.change_song_settings(**args)
+        else:
+            bb.send_chord_sheet_keys(args)
+
+
+def list_edit_jobs(input_dir, output_dir, pattern=SONG_FILE_RE):
+    """List the files in `input_dir` whose names match the regular expression `pattern`
+    (case-insensitively) as `EditJob`s.
+
+    The output paths are in `output_dir` and have no extension, which Band-in-a-Box adds
+    depending on the song. Returns the jobs and the names of the ignored files.
+    """
+    jobs, ignored = [], []
+    regex = re.compile(pattern, re.IGNORECASE)
+    for fname in sorted(os.listdir(input_dir)):
+        if not regex.search(fname):
+            ignored.append(fname)
+            continue
+        jobs.append(EditJob(os.path.join(input_dir, fname),
+                            os.path.join(output_dir, os.path.splitext(fname)[0])))
+    return jobs, ignored
+
+
+class SongEditor(Renderer):
+    """Applies edit steps to songs with a `BandInABoxController` and saves them.
+
+    Takes `EditJob`s instead of `RenderJob`s, but is otherwise used like a `Renderer`.
+    """
+    APP_NAME = 'Band-in-a-Box'
+
+    def __init__(self, controller_factory, steps, log=None, ledger=None, standby_factory=None,
+                 timeouts=None):
+        super().__init__(controller_factory, song_dir=None, style_dir=None, log=log,
+                         ledger=ledger, standby_factory=standby_factory, timeouts=timeouts)
+        self._steps = list(steps)
+
+    def _job_name(self, job):
+        return os.path.basename(job.song)
+
+    def _render(self, job):
+        bb = self._supervisor.controller
+        bb.load_song(job.song)
+        bb.wait_ready(timeout=20)
+        apply_steps(bb, self._steps)
+        with atomic_output(job.output_path) as output_path:
+            bb.save_song(output_path)
+
+
+def check_direct(steps):
+    """Raise `ValueError` if any of the steps cannot be applied without Band-in-a-Box."""
+    unsupported = sorted({step.action for step in steps} - DIRECT_ACTIONS)
+    if unsupported:
+        raise ValueError('{} cannot be applied without Band-in-a-Box'.format(
+            ', '.join(unsupported)))
+
+
+def apply_steps_to_file(song, steps):
+    """Apply edit steps to a `SongFile`. Substyle steps toggle between substyles A and B, like
+    pressing P in the chord sheet."""
+    for step in steps:
+        if step.action == 'tempo':
+            song.tempo = step.value
+        elif step.action == 'length':
+            song.last_bar = step.value
+        elif step.action == 'substyle':
+            song.toggle_substyle(step.value)
+        else:
+            raise ValueError('{} cannot be applied without Band-in-a-Box'.format(step.action))
+
+
+def edit_song_files(jobs, steps):
+    """Apply edit steps to the song files of `EditJob`s directly, without Band-in-a-Box.
+
+    Each output gets the extension of its input, as if saved by Band-in-a-Box. Yields a
+    `(job, status, error)` tuple for each job, where `status` is `'done'` or `'failed'`.
+    """
+    check_direct(steps)
+    for job in jobs:
+        try:
+            song = SongFile.read(job.song)
+            apply_steps_to_file(song, steps)
+            _, ext = os.path.splitext(job.song)
+            write_atomic(job.output_path + ext, song.to_bytes())
+        # SongFileError is a ValueError
+        except (OSError, ValueError) as e:
+            yield job, 'failed', '{}: {}'.format(type(e).__name__, e)
+            continue
+        yield job, 'done', None
@@ -0,0 +1,243 @@
+"""Reading and editing Band-in-a-Box song files (.SGU, .MGU) without Band-in-a-Box.
+
+The format is undocumented; this follows the commonly reverse-engineered layout of the file
+header:
+
+- version (1 byte)
+- title length (1 byte) and title
+- 2 unknown bytes
+- style number (1 byte), for songs using one of the built-in styles
+- key (1 byte), 1-17 for the major keys and 18-34 for the minor keys (see `KEYS`)
+- tempo (2 bytes, little-endian)
+- start bar (1 byte)
+- run-length encoded style change markers (255 bars, 1 for substyle A and 2 for substyle B),
+  chord types and chord roots (4 per bar), where a 0 byte is followed by the number of empty
+  positions to skip
+- the first and last bar of the chorus and the number of choruses (1 byte each)
+
+The name of the style file (if any) comes later, as a length-prefixed string ending in `.STY`.
+The meter is not stored in the song, it is given by the style.
+
+Every field is checked, and a `SongFileError` is raised if the file does not look like a song,
+so callers can fall back to asking the application.
+
+`SongFile` can change the tempo, the last bar of the chorus and the substyle markers, which
+takes microseconds instead of a round trip through the Band-in-a-Box GUI. Everything else is
+kept byte for byte, so a file which is read and written without changes stays identical.
+"""
+
+import collections
+import re
+
+KEYS = ([None]
+        + ['C', 'Db', 'D', 'Eb', 'E', 'F', 'Gb', 'G', 'Ab', 'A', 'Bb', 'B',
+           'C#', 'D#', 'F#', 'G#', 'A#']
+        + ['Cm', 'Dbm', 'Dm', 'Ebm', 'Em', 'Fm', 'Gbm', 'Gm', 'Abm', 'Am', 'Bbm', 'Bm',
+           'C#m', 'D#m', 'F#m', 'G#m', 'A#m'])
+
+MAX_BARS = 255
+_BEATS_PER_BAR = 4
+
+_STYLE_EXT_RE = re.compile(rb'\.sty', re.IGNORECASE)
+
+SUBSTYLES = {1: 'a', 2: 'b'}
+
+SongInfo = collections.namedtuple('SongInfo',
+                                  ['title', 'key', 'tempo', 'style', 'style_number', 'num_bars'])
+
+
+class SongFileError(ValueError):
+    """Raised when a file cannot be parsed as a Band-in-a-Box song."""
+
+
+class _Reader:
+
+    def __init__(self, data):
+        self._data = data
+        self.pos = 0
+
+    def byte(self):
+        if self.pos >= len(self._data):
+            raise SongFileError('unexpected end of file at byte {}'.format(self.pos))
+        self.pos += 1
+        return self._data[self.pos - 1]
+
+    def bytes(self, length):
+        if self.pos + length > len(self._data):
+            raise SongFileError('unexpected end of file at byte {}'.format(self.pos))
+        self.pos += length
+        return self._data[self.pos - length:self.pos]
+
+    def rle(self, length):
+        """Read a run-length encoded array as a dict mapping the indices of the non-zero items
+        to their values."""
+        i, items = 0, {}
+        while i < length:
+            value = self.byte()
+            if value == 0:
+                i += self.byte()
+            else:
+                items[i] = value
+                i += 1
+        if i > length:
+            raise SongFileError('run-length encoded array overflows at byte {}'.format(self.pos))
+        return items
+
+
+def _encode_rle(items, length):
+    """Encode a dict of the non-zero items of an array as read by `_Reader.rle`."""
+    out = bytearray()
+    i = 0
+    for index in sorted(items):
+        while i < index:
+            skip = min(index - i, 255)
+            out += bytes([0, skip])
+            i += skip
+        out.append(items[index])
+        i += 1
+    while i < length:
+        skip = min(length - i, 255)
+        out += bytes([0, skip])
+        i += skip
+    return bytes(out)
+
+
+def parse_song_info(data):
+    """Parse the metadata of a song from the bytes of a song file as a `SongInfo`."""
+    return _parse(data)[0]
+
+
+def _parse(data):
+    """Parse a song file, returning a `SongInfo` and a dict with the positions of the editable
+    fields and the style change markers."""
+    reader = _Reader(data)
+    reader.byte()  # version
+    title = reader.bytes(reader.byte()).decode('latin-1')
+    if not title.isprintable():
+        raise SongFileError('invalid title {!r}'.format(title))
+    reader.bytes(2)
+    style_number = reader.byte()
+    key_number = reader.byte()
+    if not 1 <= key_number < len(KEYS):
+        raise SongFileError('invalid key number {}'.format(key_number))
+    layout = {'tempo': reader.pos}
+    tempo = int.from_bytes(reader.bytes(2), 'little')
+    if not 1 <= tempo <= 1000:
+        raise SongFileError('invalid tempo {}'.format(tempo))
+    reader.byte()  # start bar
+
+    layout['markers_start'] = reader.pos
+    layout['markers'] = reader.rle(MAX_BARS)
+    layout['markers_end'] = reader.pos
+    chords = reader.rle(MAX_BARS * _BEATS_PER_BAR)
+    last_chord = max(chords) if chords else None
+    reader.rle(MAX_BARS * _BEATS_PER_BAR)
+
+    reader.byte()  # first bar of the chorus
+    layout['end_bar'] = reader.pos
+    end_bar = reader.byte()
+    reader.byte()  # number of choruses
+    if not 1 <= end_bar <= MAX_BARS:
+        # Fall back to the bar of the last chord
+        end_bar = last_chord // _BEATS_PER_BAR + 1 if last_chord is not None else None
+
+    info = SongInfo(title=title, key=KEYS[key_number], tempo=tempo,
+                    style=_find_style_name(data, reader.pos), style_number=style_number,
+                    num_bars=end_bar)
+    return info, layout
+
+
+def _find_style_name(data, start):
+    """Find the first length-prefixed file name ending in `.STY` after `start`."""
+    for match in _STYLE_EXT_RE.finditer(data, start):
+        end = match.end()
+        for length in range(len(b'x.sty'), min(end - start, 256)):
+            name = data[end - length:end]
+            if not all(0x20 <= c < 0x7f for c in name):
+                break
+            if data[end - length - 1] == length:
+                return name.decode('ascii')
+    return None
+
+
+def read_song_info(path):
+    """Read the metadata of a song from a song file as a `SongInfo`."""
+    with open(path, 'rb') as f:
+        return parse_song_info(f.read())
+
+
+class SongFile:
+    """A song file loaded for editing from its bytes.
+
+    Raises `SongFileError` if the data cannot be parsed.
+    """
+
+    def __init__(self, data):
+        self._data = bytearray(data)
+        self.info, layout = _parse(self._data)
+        self._tempo_pos = layout['tempo']
+        self._end_bar_pos = layout['end_bar']
+        self._markers_span = layout['markers_start'], layout['markers_end']
+        self._markers = layout['markers']
+        self._markers_changed = False
+
+    @classmethod
+    def read(cls, path):
+        with open(path, 'rb') as f:
+            return cls(f.read())
+
+    @property
+    def tempo(self):
+        return int.from_bytes(self._data[self._tempo_pos:self._tempo_pos+2], 'little')
+
+    @tempo.setter
+    def tempo(self, tempo):
+        if not 1 <= tempo <= 1000:
+            raise ValueError('invalid tempo {}'.format(tempo))
+        self._data[self._tempo_pos:self._tempo_pos+2] = tempo.to_bytes(2, 'little')
+
+    @property
+    def last_bar(self):
+        """The number of the last bar of the chorus."""
+        return self._data[self._end_bar_pos]
+
+    @last_bar.setter
+    def last_bar(self, bar):
+        if not 1 <= bar <= MAX_BARS:
+            raise ValueError('invalid bar number {}'.format(bar))
+        self._data[self._end_bar_pos] = bar
+
+    def substyle(self, bar):
+        """Return the substyle (`'a'` or `'b'`) in effect at the given bar."""
+        marked = [index for index in self._markers if index < bar]
+        return SUBSTYLES.get(self._markers[max(marked)], 'a') if marked else 'a'
+
+    def set_substyle(self, bar, substyle):
+        """Put a marker switching to the given substyle (`'a'` or `'b'`) at a bar, or remove the
+        marker if `substyle` is `None`."""
+        if not 1 <= bar <= MAX_BARS:
+            raise ValueError('invalid bar number {}'.format(bar))
+        if substyle is None:
+            self._markers.pop(bar - 1, None)
+        else:
+            values = {name: value for value, name in SUBSTYLES.items()}
+            if substyle not in values:
+                raise ValueError('invalid substyle {!r}'.format(substyle))
+            self._markers[bar - 1] = values[substyle]
+        self._markers_changed = True
+
+    def toggle_substyle(self, bar):
+        """Switch between substyles A and B from the given bar on, like pressing P at that bar in
+        the chord sheet."""
+        self.set_substyle(bar, 'b' if self.substyle(bar) == 'a' else 'a')
+
+    def to_bytes(self):
+        if not self._markers_changed:
+            return bytes(self._data)
+        start, end = self._markers_span
+        return (bytes(self._data[:start]) + _encode_rle(self._markers, MAX_BARS)
+                + bytes(self._data[end:]))
+
+    def write(self, path):
+        with open(path, 'wb') as f:
+            f.write(self.to_bytes())
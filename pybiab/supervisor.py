@@ -0,0 +1,95 @@
+"""Keeping a controller running and recovering from its failures quickly.
+
+A `ControllerSupervisor` owns the active controller. When an operation fails, `recover` first
+tries to get the application back to a usable state (e.g. by closing a stray dialog), so that
+the operation can simply be retried. Only if the application has died or does not recover is it
+killed and replaced by `restart`.
+
+Starting RealBand takes tens of seconds. To avoid waiting for it on a restart, the supervisor can
+keep a standby instance of a second installation (RealBand cannot run twice from the same
+installation) started in the background, which takes over immediately. A new standby is then
+started from the installation of the killed instance.
+"""
+
+import concurrent.futures
+import sys
+import traceback
+
+
+def _start_controller(controller_factory):
+    try:
+        # The controllers use COM, which must be initialized in each thread
+        import pythoncom
+    except ImportError:
+        pass
+    else:
+        pythoncom.CoInitialize()
+    return controller_factory(try_connect=False)
+
+
+class ControllerSupervisor:
+    """Manages the controller created by `controller_factory`, with an optional standby.
+
+    If `standby_factory` is given, it must create a controller for a separate installation. The
+    controllers are passed through `wrap` (e.g. to instrument them) before being used.
+    """
+
+    def __init__(self, controller_factory, standby_factory=None, wrap=None):
+        self._factory = controller_factory
+        self._standby_factory = standby_factory
+        self._wrap = wrap or (lambda controller: controller)
+        self._executor = None
+        self._standby = None
+
+        self.controller = self._wrap(controller_factory(try_connect=True))
+        if standby_factory is not None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+            self._start_standby()
+
+    def _start_standby(self):
+        self._standby = self._executor.submit(_start_controller, self._standby_factory)
+
+    def recover(self):
+        """Try to get the active controller ready again after a failure.
+
+        Returns `True` if the failed operation can be retried with it, or `False` if it needs to
+        be restarted.
+        """
+        try:
+            return self.controller.is_alive() and self.controller.recover()
+        except Exception:
+            traceback.print_exc(file=sys.stderr)
+            return False
+
+    def restart(self):
+        """Kill the active controller and replace it, with the standby if there is one."""
+        try:
+            self.controller.kill()
+        except Exception:
+            traceback.print_exc(file=sys.stderr)
+
+        if self._standby is None:
+            self.controller = self._wrap(self._factory(try_connect=False))
+            return
+
+        standby, self._standby = self._standby, None
+        self._factory, self._standby_factory = self._standby_factory, self._factory
+        try:
+            controller = standby.result()
+        except Exception:
+            # The standby failed to start; start it again in the foreground
+            traceback.print_exc(file=sys.stderr)
+            controller = self._factory(try_connect=False)
+        self.controller = self._wrap(controller)
+        self._start_standby()
+
+    def close(self):
+        """Kill the standby, if there is one."""
+        if self._standby is not None:
+            try:
+                self._standby.result().kill()
+            except Exception:
+                traceback.print_exc(file=sys.stderr)
+            self._standby = None
+        if self._executor is not None:
+            self._executor.shutdown()
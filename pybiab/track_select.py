@@ -0,0 +1,170 @@
+"""Selecting which tracks of a MIDI file to keep.
+
+A `TrackSelector` holds a list of rules, each written as `ACTION FIELD VALUE`:
+
+- `ACTION` is `keep` or `remove`,
+- `FIELD` is `name` (the exact track name), `name-re` (a regular expression searched in the
+  track name), `program` (the programs set by the program changes in the track) or `channel`
+  (the channels used by the track), and
+- `VALUE` is the name or regular expression, or a list of numbers and ranges such as `0-7,32`
+  for programs and channels (both counted from 0 like in mido, so the drum channel is 9).
+
+A track is removed if it matches any `remove` rule or if there are `keep` rules and it matches
+none of them. The exception is the tempo track, i.e. the first track of a type 1 file if it
+contains no channel messages: it is not removed for failing to match a `keep` rule (only a
+`remove` rule can remove it).
+
+Rules can be given on the command line or in a rules file, one per line, with `#` starting a
+comment. The regular expressions are compiled once, and the decision for each combination of
+track name, channels and programs is cached, since the same tracks recur in every file of a
+corpus. The programs and channels are only collected when a rule needs them.
+"""
+
+import collections
+import re
+
+ACTIONS = ('keep', 'remove')
+FIELDS = ('name', 'name-re', 'program', 'channel')
+_RANGES = {'program': 128, 'channel': 16}
+
+_CACHE_SIZE = 4096
+
+TrackRule = collections.namedtuple('TrackRule', ['action', 'field', 'value', 'text'])
+
+
+def _parse_numbers(value, field):
+    numbers = set()
+    for part in value.split(','):
+        first, _, last = part.strip().partition('-')
+        try:
+            first = int(first)
+            last = int(last) if last else first
+        except ValueError:
+            raise ValueError('invalid {} {!r}'.format(field, part)) from None
+        if not 0 <= first <= last < _RANGES[field]:
+            raise ValueError('{} {!r} is out of range 0-{}'.format(
+                field, part, _RANGES[field] - 1))
+        numbers.update(range(first, last + 1))
+    return frozenset(numbers)
+
+
+def parse_rule(text):
+    """Parse a rule written as `ACTION FIELD VALUE` into a `TrackRule`.
+
+    Raises `ValueError` if the rule is invalid.
+    """
+    parts = text.split(None, 2)
+    if len(parts) != 3:
+        raise ValueError('expected ACTION FIELD VALUE, got {!r}'.format(text))
+    action, field, value = parts
+    if action not in ACTIONS:
+        raise ValueError('unknown action {!r} in {!r}'.format(action, text))
+    return TrackRule(action, field, _parse_value(field, value, text), text.strip())
+
+
+def _parse_value(field, value, text):
+    """Parse the value of a rule for the given field, raising `ValueError` with the rule `text`
+    if it is invalid."""
+    if field == 'name':
+        return value
+    if field == 'name-re':
+        try:
+            return re.compile(value)
+        except re.error as e:
+            raise ValueError('invalid regular expression in {!r}: {}'.format(text, e)) from None
+    if field in _RANGES:
+        return _parse_numbers(value, field)
+    raise ValueError('unknown field {!r} in {!r}'.format(field, text))
+
+
+def read_rules(rules_file):
+    """Read the rules in a rules file. Raises `ValueError` with the line number on invalid rules."""
+    rules = []
+    with open(rules_file, encoding='utf-8') as f:
+        for i, line in enumerate(f):
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            try:
+                rules.append(parse_rule(line))
+            except ValueError as e:
+                raise ValueError('{}:{}: {}'.format(rules_file, i + 1, e)) from None
+    return rules
+
+
+class TrackSelector:
+    """Decides which tracks to keep according to a list of `TrackRule`s."""
+
+    def __init__(self, rules=()):
+        self.rules = list(rules)
+        self.needs_messages = any(rule.field in _RANGES for rule in self.rules)
+        self._has_keep_rules = any(rule.action == 'keep' for rule in self.rules)
+        self._cache = {}
+
+    @classmethod
+    def from_args(cls, rules=(), rules_files=(), remove_re=(), remove=()):
+        """Create a selector from rules as text, rules files and the track names and regular
+        expressions of `fix_rb_midi`'s `--remove` and `--remove-re` options.
+
+        Raises `ValueError` if any of them is invalid.
+        """
+        parsed = []
+        for rules_file in rules_files:
+            parsed.extend(read_rules(rules_file))
+        parsed.extend(parse_rule(rule) for rule in rules)
+        # Parsed like rules, but without splitting, so that the names and regular expressions are
+        # kept exactly as given
+        for field, values in [('name-re', remove_re), ('name', remove)]:
+            for value in values:
+                text = 'remove {} {}'.format(field, value)
+                parsed.append(TrackRule('remove', field, _parse_value(field, value, text), text))
+        return cls(parsed)
+
+    def __bool__(self):
+        return bool(self.rules)
+
+    def __getstate__(self):
+        # The cache is rebuilt in each worker process
+        return {'rules': self.rules}
+
+    def __setstate__(self, state):
+        self.__init__(state['rules'])
+
+    def select(self, name, channels=(), programs=(), conductor=False):
+        """Decide whether to keep a track.
+
+        `channels` and `programs` are only used if `needs_messages` is set. `conductor` is set
+        for the tempo track (see the module docstring). Returns the decision and the indices of
+        the rules matching the track.
+        """
+        key = (name, frozenset(channels), frozenset(programs), conductor)
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+
+        matched = []
+        for i, rule in enumerate(self.rules):
+            if rule.field == 'name':
+                match = name == rule.value
+            elif rule.field == 'name-re':
+                match = rule.value.search(name) is not None
+            elif rule.field == 'program':
+                match = not rule.value.isdisjoint(programs)
+            else:
+                match = not rule.value.isdisjoint(channels)
+            if match:
+                matched.append(i)
+
+        actions = {self.rules[i].action for i in matched}
+        keep = 'remove' not in actions and (
+            'keep' in actions or not self._has_keep_rules or conductor)
+        result = keep, tuple(matched)
+        if len(self._cache) >= _CACHE_SIZE:
+            self._cache.clear()
+        self._cache[key] = result
+        return result
+
+    def count_matches(self, counts, matched):
+        """Add the rules in `matched` (see `select`) to a `Counter` keyed by rule text."""
+        counts.update(self.rules[i].text for i in matched)
@@ -0,0 +1,297 @@
+"""Transposing rendered MIDI files instead of having RealBand generate them in another key.
+
+Generating the accompaniment is by far the slowest step of rendering a job, so a song can be
+rendered once in its original key and transposed to the other keys afterwards. The note numbers
+of all channels except the drum channel are shifted by the interval between the keys (notes
+falling out of the MIDI range are moved by octaves back into it) and the key signatures are
+rewritten. Everything else, including the timing, is left as it is.
+
+Like `fix_midi_bytes`, `transpose_midi_bytes` works directly on the bytes of the file: the
+positions of the note numbers are collected in one pass over the events and all notes are then
+shifted at once (with NumPy if it is installed). Files which cannot be scanned this way are
+transposed with mido.
+"""
+
+import collections
+import os
+import struct
+import sys
+
+import mido
+
+from .job_ledger import atomic_output
+from .midi_utils import UnsupportedMidiError, patch_mido
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+DRUM_CHANNELS = frozenset([9])
+
+_PITCH_CLASSES = {'C': 0, 'D': 2, 'E': 4, 'F': 5, 'G': 7, 'A': 9, 'B': 11}
+_ACCIDENTALS = {'': 0, '#': 1, 'b': -1}
+
+# Key names by the number of sharps (negative for flats), as used by mido
+_MAJOR_KEYS = dict(zip(range(-7, 8), ['Cb', 'Gb', 'Db', 'Ab', 'Eb', 'Bb', 'F', 'C',
+                                      'G', 'D', 'A', 'E', 'B', 'F#', 'C#']))
+_MINOR_KEYS = dict(zip(range(-7, 8), ['Abm', 'Ebm', 'Bbm', 'Fm', 'Cm', 'Gm', 'Dm', 'Am',
+                                      'Em', 'Bm', 'F#m', 'C#m', 'G#m', 'D#m', 'A#m']))
+_SHARPS = {name: sharps for keys in [_MAJOR_KEYS, _MINOR_KEYS] for sharps, name in keys.items()}
+
+_NOTE_STATUSES = (0x80, 0x90, 0xa0)  # note_off, note_on, polytouch
+
+Comparison = collections.namedtuple('Comparison', ['num_notes', 'num_reference_notes', 'overlap'])
+
+
+def parse_key(key):
+    """Return the pitch class of the tonic of a key such as `'Eb'` or `'F#m'` and whether the key
+    is minor. Raises `ValueError` for an invalid key."""
+    minor = key.endswith('m')
+    name = key[:-1] if minor else key
+    if not name or name[0] not in _PITCH_CLASSES or name[1:] not in _ACCIDENTALS:
+        raise ValueError('invalid key {!r}'.format(key))
+    return (_PITCH_CLASSES[name[0]] + _ACCIDENTALS[name[1:]]) % 12, minor
+
+
+def transpose_interval(from_key, to_key):
+    """Return the number of semitones (between -6 and 5) by which to transpose a song from one key
+    to another."""
+    from_pitch, _ = parse_key(from_key)
+    to_pitch, _ = parse_key(to_key)
+    return (to_pitch - from_pitch + 6) % 12 - 6
+
+
+def _transpose_sharps(sharps, minor, semitones, key=None):
+    """Return the number of sharps of a key signature transposed by `semitones`, spelled like
+    `key` if it is given and in the same mode."""
+    # Each semitone up is 7 fifths up; spell with at most 6 flats or 5 sharps (7 for the key)
+    new_sharps = (sharps + 7 * semitones + 6) % 12 - 6
+    if key is not None:
+        name = key[:-1] if key.endswith('m') else key
+        key_sharps = _SHARPS.get(name + 'm' if minor else name)
+        if key_sharps is not None and (key_sharps - new_sharps) % 12 == 0:
+            new_sharps = key_sharps
+    return new_sharps
+
+
+def read_key(data):
+    """Return the key of the first valid key signature in a MIDI file given as bytes, or `None`.
+    """
+    try:
+        _, _, tracks = _scan_midi_bytes(data)
+    except UnsupportedMidiError:
+        return None
+    for _, key_positions in tracks:
+        for pos in key_positions:
+            sharps = struct.unpack('b', data[pos:pos+1])[0]
+            return (_MINOR_KEYS if data[pos+1] else _MAJOR_KEYS)[sharps]
+    return None
+
+
+def transpose_midi_bytes(data, semitones, key=None, drum_channels=DRUM_CHANNELS):
+    """Transpose a MIDI file given as bytes by `semitones`.
+
+    The notes in `drum_channels` are not transposed. The key signatures are rewritten, spelled
+    like `key` (the target key) if it is given. Raises `UnsupportedMidiError` if the file cannot be
+    scanned, in which case the caller should fall back to `transpose_midi_file` with mido.
+    """
+    _, _, tracks = _scan_midi_bytes(data, drum_channels)
+    out = bytearray(data)
+    note_positions = [pos for positions, _ in tracks for pos in positions]
+    if np is not None:
+        positions = np.array(note_positions, dtype=np.int64)
+        buffer = np.frombuffer(out, dtype=np.uint8)
+        buffer[positions] = _fold(buffer[positions].astype(np.int16) + semitones)
+    else:
+        for pos in note_positions:
+            out[pos] = _fold(out[pos] + semitones)
+
+    for _, key_positions in tracks:
+        for pos in key_positions:
+            sharps = struct.unpack('b', out[pos:pos+1])[0]
+            out[pos] = _transpose_sharps(sharps, out[pos+1], semitones, key) & 0xff
+    return bytes(out)
+
+
+def _fold(notes):
+    """Move notes outside of the MIDI range by octaves back into it (works on arrays too)."""
+    if np is not None and isinstance(notes, np.ndarray):
+        notes = np.where(notes < 0, notes % 12, notes)
+        return np.where(notes > 127, 116 + (notes - 116) % 12, notes).astype(np.uint8)
+    if notes < 0:
+        return notes % 12
+    if notes > 127:
+        return 116 + (notes - 116) % 12
+    return notes
+
+
+def transpose_midi_file(input_file, output_file, semitones, key=None, engine='raw',
+                        drum_channels=DRUM_CHANNELS):
+    """Transpose a MIDI file and save it (see `transpose_midi_bytes`).
+
+    With `engine='mido'`, or if the file cannot be scanned, the file is decoded with mido instead,
+    which gives the same messages but may encode them differently.
+    """
+    if engine not in ('raw', 'mido'):
+        raise ValueError(f'Unknown engine {engine!r}')
+    with open(input_file, 'rb') as f:
+        data = f.read()
+    if engine == 'raw':
+        try:
+            data = transpose_midi_bytes(data, semitones, key, drum_channels)
+        except UnsupportedMidiError as e:
+            print(f'Falling back to mido for {input_file}: {e}', file=sys.stderr)
+        else:
+            with open(output_file, 'wb') as f:
+                f.write(data)
+            return
+
+    patch_mido()
+    midi_file = mido.MidiFile(input_file)
+    for track in midi_file.tracks:
+        for msg in track:
+            if msg.type in ('note_on', 'note_off', 'polytouch'):
+                if msg.channel not in drum_channels:
+                    msg.note = _fold(msg.note + semitones)
+            elif msg.type == 'key_signature' and msg.key is not None:
+                minor = msg.key.endswith('m')
+                sharps = _transpose_sharps(_SHARPS[msg.key], minor, semitones, key)
+                msg.key = (_MINOR_KEYS if minor else _MAJOR_KEYS)[sharps]
+    midi_file.save(output_file)
+
+
+def _scan_midi_bytes(data, drum_channels=DRUM_CHANNELS):
+    """Find the note numbers and key signatures in a MIDI file given as bytes.
+
+    Returns the format type, the ticks per beat and, for each track, a list of positions of the
+    note numbers outside of `drum_channels` and a list of positions of the data of the valid
+    key signatures.
+    """
+    try:
+        if data[:4] != b'MThd':
+            raise UnsupportedMidiError('MThd not found')
+        size, midi_type, num_tracks, ticks_per_beat = struct.unpack('>Lhhh', data[4:14])
+        if size < 6:
+            raise UnsupportedMidiError('MThd too short')
+
+        tracks = []
+        pos = 8 + size
+        for _ in range(num_tracks):
+            name, size = struct.unpack('>4sL', data[pos:pos+8])
+            if name != b'MTrk':
+                raise UnsupportedMidiError('no MTrk header at start of track')
+            pos += 8 + size
+            if pos > len(data):
+                raise UnsupportedMidiError('truncated track')
+            tracks.append(_scan_track(data, pos - size, pos, drum_channels))
+    except (IndexError, struct.error) as e:
+        raise UnsupportedMidiError('truncated file') from e
+
+    return midi_type, ticks_per_beat, tracks
+
+
+def _scan_track(data, start, end, drum_channels):
+    note_positions = []
+    key_positions = []
+    status = None
+    pos = start
+    while pos < end:
+        while data[pos] & 0x80:  # Delta time
+            pos += 1
+        pos += 1
+
+        if data[pos] & 0x80:
+            status = data[pos]
+            pos += 1
+        elif status is None or status >= 0xf0:
+            raise UnsupportedMidiError('unexpected running status')
+
+        if status < 0xf0:
+            if status & 0xf0 in _NOTE_STATUSES and status & 0x0f not in drum_channels:
+                note_positions.append(pos)
+            pos += 1 if 0xc0 <= status < 0xe0 else 2
+            continue
+
+        if status == 0xff:
+            meta_type = data[pos]
+            pos += 1
+        elif status != 0xf0 and status != 0xf7:
+            raise UnsupportedMidiError('unsupported status byte 0x{:02x}'.format(status))
+        length = 0
+        while True:
+            byte = data[pos]
+            pos += 1
+            length = (length << 7) | (byte & 0x7f)
+            if not byte & 0x80:
+                break
+        if status == 0xff and meta_type == 0x59 and length == 2:
+            sharps = data[pos]
+            if (sharps <= 7 or sharps >= 0x100 - 7) and data[pos+1] <= 1:
+                key_positions.append(pos)
+        pos += length
+        status = None  # Meta and sysex events cancel running status
+
+    if pos != end:
+        raise UnsupportedMidiError('event crosses the end of the track')
+    return note_positions, key_positions
+
+
+def compare_transposition(path, reference_path, drum_channels=DRUM_CHANNELS):
+    """Compare the notes of a transposed MIDI file with those of a reference rendered by RealBand
+    in the target key.
+
+    Since RealBand generates the accompaniment anew in every key, the notes are not expected to be
+    identical. Instead, the pitch classes of the notes outside of `drum_channels` are compared:
+    `overlap` is the overlap (between 0 and 1) of their normalized histograms, which is close to 1
+    if both files are in the same key.
+    """
+    patch_mido()
+    histograms = []
+    for midi_path in [path, reference_path]:
+        histogram = collections.Counter(
+            msg.note % 12 for track in mido.MidiFile(midi_path).tracks for msg in track
+            if msg.type == 'note_on' and msg.velocity and msg.channel not in drum_channels)
+        histograms.append(histogram)
+
+    counts = [sum(histogram.values()) for histogram in histograms]
+    if not all(counts):
+        overlap = float(counts[0] == counts[1])
+    else:
+        overlap = sum(min(histograms[0][pitch] / counts[0], histograms[1][pitch] / counts[1])
+                      for pitch in range(12))
+    return Comparison(counts[0], counts[1], overlap)
+
+
+def transpose_outputs(base_path, jobs, song_key=None, engine='raw'):
+    """Produce the outputs of `RenderJob`s with a key by transposing the output of the same song
+    and style rendered in its original key.
+
+    The original key is `song_key` if given (e.g. as read from the song file) and otherwise the
+    first key signature in the base output. The outputs are written atomically.
+
+    Yields a `(job, status, error)` tuple for each job, where `status` is `'done'` or
+    `'failed'`.
+    """
+    try:
+        if song_key is None:
+            with open(base_path, 'rb') as f:
+                song_key = read_key(f.read())
+    except OSError as e:
+        song_key, error = None, '{}: {}'.format(type(e).__name__, e)
+    else:
+        error = 'the original key of {} is unknown'.format(base_path)
+
+    for job in jobs:
+        if song_key is None:
+            yield job, 'failed', error
+            continue
+        try:
+            os.makedirs(os.path.dirname(job.output_path) or '.', exist_ok=True)
+            with atomic_output(job.output_path) as output_path:
+                transpose_midi_file(base_path, output_path,
+                                    transpose_interval(song_key, job.key), job.key, engine)
+        except (OSError, ValueError, EOFError) as e:
+            yield job, 'failed', '{}: {}'.format(type(e).__name__, e)
+            continue
+        yield job, 'done', None
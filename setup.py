@@ -8,11 +8,14 @@ setuptools.setup(
     description='Band-in-a-Box/RealBand automation',
     url='https://github.com/cifkao/pybiab',
     packages=setuptools.find_packages(exclude=['tests', 'tests.*']),
-    python_requires='>=3.5',
+    python_requires='>=3.7',
     install_requires=[
-        'pywinauto',
-        'pywin32',
+        'pywinauto; platform_system == "Windows"',
+        'pywin32; platform_system == "Windows"',
         'psutil',
         'mido',
     ],
+    extras_require={
+        'index': ['numpy'],
+    },
 )
@@ -0,0 +1,11 @@
+import os
+
+import pytest
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+
+@pytest.fixture
+def data_path():
+    """Return the path of a file in tests/data."""
+    return lambda name: os.path.join(DATA_DIR, name)
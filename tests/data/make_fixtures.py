@@ -0,0 +1,88 @@
+"""Write the song file fixtures.
+
+No song files saved by Band-in-a-Box can be redistributed with the tests, so the fixtures are
+written field by field following the layout documented in `pybiab.song_file`, with an encoder
+independent of the one in that module. Each edited variant is written from scratch with the
+edited field, the way Band-in-a-Box saves the song after the same edit in the GUI, so that the
+tests do not compare `SongFile` with itself.
+
+Files saved by Band-in-a-Box can be dropped in instead; the tests only rely on the names.
+"""
+
+import os
+
+DATA_DIR = os.path.dirname(os.path.abspath(__file__))
+
+MAX_BARS = 255
+
+
+def rle(items, length):
+    """Run-length encode the items of a `{index: value}` dict of an array of `length` bytes."""
+    out = bytearray()
+    for i in range(length):
+        value = items.get(i, 0)
+        if value == 0 and out[-2:-1] == b'\0' and out[-1] < 255:
+            out[-1] += 1
+        elif value == 0:
+            out += b'\0\1'
+        else:
+            out.append(value)
+    return bytes(out)
+
+
+def song(title, key, tempo, markers, chords, last_bar, style=None, style_number=0,
+         version=0xbb, trailer=b''):
+    """Return the bytes of a song file. `chords` maps beats to (chord type, root) tuples."""
+    title = title.encode('latin-1')
+    data = bytearray([version, len(title)]) + title + bytes([0, 0, style_number, key])
+    data += tempo.to_bytes(2, 'little') + bytes([1])
+    data += rle(markers, MAX_BARS)
+    data += rle({beat: chord[0] for beat, chord in chords.items()}, MAX_BARS * 4)
+    data += rle({beat: chord[1] for beat, chord in chords.items()}, MAX_BARS * 4)
+    data += bytes([1, last_bar, 3])
+    data += bytes(range(40))  # Settings which are not parsed
+    if style is not None:
+        style = style.encode('ascii')
+        data += bytes([len(style)]) + style
+    data += bytes(16) + trailer
+    return bytes(data)
+
+
+# Songs by file name, as keyword arguments of `song`
+SONGS = {
+    'BLUES.SGU': dict(
+        title='Blues in F', key=6, tempo=120, markers={0: 1, 8: 2},
+        chords={0: (1, 6), 16: (7, 11), 24: (1, 6), 32: (7, 1), 40: (7, 11), 44: (7, 3)},
+        last_bar=12, style='ZZJAZZ.STY'),
+    'BALLAD.MGU': dict(
+        title='Ballad', key=27, tempo=72, markers={0: 1},
+        chords={beat: (4, 1 + beat % 12) for beat in range(0, 128, 4)},
+        last_bar=32, style='JAZBALAD.STY', trailer=bytes(range(200, 256)) * 4),
+    # A built-in style and no last bar of the chorus; the number of bars comes from the chords
+    'BUILTIN.SGU': dict(
+        title='Built-in', key=1, tempo=140, markers={0: 1},
+        chords={0: (1, 1), 30: (1, 8)}, last_bar=0, style_number=3),
+}
+
+# Edited songs by file name, as (original, edit steps, changed fields)
+EDITS = {
+    'BLUES_tempo=140.SGU': ('BLUES.SGU', ['tempo=140'], dict(tempo=140)),
+    'BLUES_length=24.SGU': ('BLUES.SGU', ['length=24'], dict(last_bar=24)),
+    'BLUES_substyle=5.SGU': ('BLUES.SGU', ['substyle=5'], dict(markers={0: 1, 4: 2, 8: 2})),
+    'BLUES_substyle=9.SGU': ('BLUES.SGU', ['substyle=9'], dict(markers={0: 1, 8: 1})),
+    'BALLAD_all.MGU': ('BALLAD.MGU', ['tempo=80', 'length=16', 'substyle=17'],
+                       dict(tempo=80, last_bar=16, markers={0: 1, 16: 2})),
+}
+
+
+def main():
+    for name, fields in SONGS.items():
+        with open(os.path.join(DATA_DIR, name), 'wb') as f:
+            f.write(song(**fields))
+    for name, (original, _, changes) in EDITS.items():
+        with open(os.path.join(DATA_DIR, name), 'wb') as f:
+            f.write(song(**dict(SONGS[original], **changes)))
+
+
+if __name__ == '__main__':
+    main()
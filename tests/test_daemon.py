@@ -0,0 +1,63 @@
+import functools
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+from pybiab.daemon import DaemonClient, serve
+from pybiab.render_farm import Renderer
+from pybiab.simulated_controller import SimulatedController
+
+pytestmark = pytest.mark.skipif(sys.platform == 'win32', reason='uses a Unix socket')
+
+
+@pytest.fixture
+def daemon(tmp_path, data_path):
+    """Start a daemon with a simulated controller, returning its address and output
+    directory."""
+    address = str(tmp_path / 'daemon.sock')
+    renderer = Renderer(functools.partial(SimulatedController, time_scale=0),
+                        song_dir=os.path.dirname(data_path('BLUES.SGU')),
+                        style_dir=str(tmp_path))
+    thread = threading.Thread(target=serve, args=(renderer, address))
+    thread.start()
+    deadline = time.monotonic() + 10
+    while not os.path.exists(address) and time.monotonic() < deadline:
+        time.sleep(.01)
+    yield address, tmp_path
+    if thread.is_alive():
+        with DaemonClient(address) as client:
+            client.stop()
+    thread.join(10)
+    assert not thread.is_alive()
+
+
+def test_daemon(daemon):
+    address, output_dir = daemon
+    with DaemonClient(address) as client:
+        assert client.ping() == ('ok', None)
+        output_path = str(output_dir / 'BLUES.mid')
+        assert client.render('BLUES.SGU', 'X.STY', output_path) == ('done', None)
+        assert os.path.exists(output_path)
+        status, error = client.render('BLUES.SGU', 'X.STY', output_path, key='H')
+        assert status == 'failed' and error.startswith('ValueError')
+        status, error = client._request('transpose', 'BLUES.SGU')
+        assert status == 'failed' and 'unknown command' in error
+        # A malformed request must not stop the daemon
+        status, error = client._request('render', 'BLUES.SGU')
+        assert status == 'failed' and error.startswith('TypeError')
+        status, error = client._request()
+        assert status == 'failed' and 'malformed request' in error
+        assert client.ping() == ('ok', None)
+    # The daemon serves the next client
+    with DaemonClient(address) as client:
+        assert client.ping() == ('ok', None)
+        assert client.stop() == ('ok', None)
+
+
+def test_daemon_already_listening(daemon):
+    address, _ = daemon
+    with pytest.raises(RuntimeError):
+        serve(None, address)
@@ -0,0 +1,95 @@
+import pytest
+
+from pybiab.instrumentation import InstrumentedController, RunLog, RunSummary, read_events
+from pybiab.readiness import WaitRecorder
+from pybiab.simulated_controller import SimulatedController, SimulatedFailure
+
+
+def test_run_summary():
+    summary = RunSummary()
+    for i in range(1, 101):
+        summary.add(dict(event='operation', time=1000. + i, operation='generate_all',
+                         duration=float(i), ok=i != 100))
+    summary.add(dict(event='wait', time=1001., name='ready', duration=.5, attempts=3,
+                     timed_out=True))
+    summary.add(dict(event='retry', time=1050., error='RuntimeError: x'))
+    summary.add(dict(event='restart', time=1060., error='RuntimeError: y'))
+    summary.add(dict(event='job', time=1100., job='a\tx', duration=10., status='done',
+                     attempts=1))
+    summary.add(dict(event='job', time=1100., job='b\tx', duration=10., status='failed',
+                     attempts=3))
+
+    report = summary.report()
+    assert report['operations']['generate_all'] == dict(
+        count=100, total=5050., p50=50., p95=95., p99=99., errors=1)
+    assert report['operations']['wait:ready'] == dict(
+        count=1, total=.5, p50=.5, p95=.5, p99=.5, errors=1)
+    assert report['operations']['job']['count'] == 2
+    assert report['jobs'] == {'done': 1, 'failed': 1}
+    assert report['retries'] == 1 and report['restarts'] == 1
+    # The run started with the first operation (which took 1 s) and ended with the jobs
+    assert summary.start_time == 1000. and summary.end_time == 1100.
+    assert report['jobs_per_hour'] == pytest.approx(36.)
+    assert '1 jobs done, 1 failed, 1 retries, 1 restarts, 36.0 jobs/hour' in summary.format()
+
+
+def test_run_summary_empty():
+    summary = RunSummary()
+    assert summary.report() == dict(operations={}, jobs={}, retries=0, restarts=0,
+                                    jobs_per_hour=0.)
+
+
+def test_instrumented_controller(tmp_path):
+    path = str(tmp_path / 'events.jsonl')
+    log = RunLog(path, worker=1)
+    controller = InstrumentedController(
+        SimulatedController(time_scale=0., failure_rate={'generate_all': 1.}), log)
+    controller.load_song('a.sgu')
+    assert controller.key_signature == 'C'
+    with pytest.raises(SimulatedFailure):
+        controller.generate_all()
+    log.close()
+
+    events = read_events(path)
+    assert all(event['worker'] == 1 for event in events)
+    operations = [(event['operation'], event['ok']) for event in events
+                  if event['event'] == 'operation']
+    assert operations == [('load_song', True), ('key_signature', True), ('generate_all', False)]
+    # The waits of the controller are logged too
+    assert [event['name'] for event in events if event['event'] == 'wait'] == ['load_song']
+    report = log.summary.report()
+    assert report['operations']['generate_all']['errors'] == 1
+    assert report['operations']['wait:load_song']['count'] == 1
+
+
+def test_instrumented_controller_startup_waits():
+    # The controller waits for the application to start before it is wrapped
+    controller = SimulatedController(try_connect=False, time_scale=0.)
+    log = RunLog()
+    InstrumentedController(controller, log).load_song('a.sgu')
+    assert list(log.summary.counts) == ['wait:start', 'wait:load_song', 'load_song']
+
+
+def test_wait_recorder_replay():
+    recorder = WaitRecorder(max_waits=2)
+    for i in range(3):
+        recorder.record('ready', float(i), attempts=2, context='x')
+    assert recorder.summary() == {'ready': dict(count=3, total=3., mean=1., max=2., attempts=6,
+                                                timeouts=0)}
+    log = RunLog()
+    recorder.replay(log)
+    # Only the last waits are kept for replaying, and they are only replayed once
+    assert log.summary.counts['wait:ready'] == 2
+    recorder.replay(log)
+    assert log.summary.counts['wait:ready'] == 2
+
+
+def test_run_summary_max_samples():
+    summary = RunSummary(max_samples=10)
+    for i in range(1, 101):
+        summary.add(dict(event='operation', time=1000. + i, operation='save_song',
+                         duration=float(i), ok=True))
+    # The count and total cover all events, the percentiles the last ones
+    assert summary.report()['operations']['save_song'] == dict(
+        count=100, total=5050., p50=95., p95=100., p99=100., errors=0)
+    assert len(summary.samples['save_song']) == 10
@@ -0,0 +1,89 @@
+import os
+import sqlite3
+
+import pytest
+
+from pybiab.job_ledger import JobLedger, atomic_output, find_outputs, write_atomic
+
+
+def test_job_ledger(tmp_path):
+    path = str(tmp_path / 'ledger.sqlite')
+    ledger = JobLedger(path)
+    assert ledger.is_new
+    ledger.add(['a', 'b', 'c', 'd'])
+    ledger.add(['a'])
+    assert ledger.counts() == {'queued': 4}
+    ledger.start('a')
+    assert ledger.counts() == {'queued': 3, 'running': 1}
+    ledger.finish('a')
+    ledger.start('b')
+    ledger.fail('b', 'boom')
+    ledger.start('b')
+    ledger.fail('b', 'boom again')
+    ledger.mark_done(['c', 'e'])
+    assert ledger.done() == {'a', 'c', 'e'}
+    assert ledger.failed() == [('b', 2, 'boom again')]
+    assert ledger.counts() == {'done': 3, 'failed': 1, 'queued': 1}
+    ledger.close()
+
+    ledger = JobLedger(path)
+    assert not ledger.is_new
+    # Adding jobs again keeps their state
+    ledger.add(['a', 'b'])
+    assert ledger.done() == {'a', 'c', 'e'}
+    ledger.close()
+
+
+def test_job_ledger_read_only(tmp_path):
+    path = str(tmp_path / 'ledger.sqlite')
+    with pytest.raises(FileNotFoundError):
+        JobLedger(path, 'r')
+    assert not os.path.exists(path)
+    with pytest.raises(ValueError):
+        JobLedger(path, 'w')
+
+    ledger = JobLedger(path)
+    ledger.mark_done(['a'])
+    ledger.close()
+    ledger = JobLedger(path, 'r')
+    assert ledger.done() == {'a'}
+    with pytest.raises(sqlite3.OperationalError):
+        ledger.mark_done(['b'])
+    ledger.close()
+    assert JobLedger(path, 'r').done() == {'a'}
+
+
+def test_atomic_output(tmp_path):
+    path = str(tmp_path / 'out.mid')
+    with atomic_output(path) as temp_path:
+        assert temp_path.endswith('.mid') and temp_path != path
+        with open(temp_path, 'wb') as f:
+            f.write(b'data')
+    with open(path, 'rb') as f:
+        assert f.read() == b'data'
+    assert find_outputs(path) == [path]
+
+    with pytest.raises(RuntimeError):
+        with atomic_output(str(tmp_path / 'failed.mid')) as temp_path:
+            with open(temp_path, 'wb') as f:
+                f.write(b'partial')
+            raise RuntimeError
+    assert os.listdir(str(tmp_path)) == ['out.mid']
+
+
+def test_atomic_output_appended_extension(tmp_path):
+    path = str(tmp_path / 'out')
+    with atomic_output(path) as temp_path:
+        # Like Band-in-a-Box, which appends the extension of the format
+        with open(temp_path + '.MGU', 'wb') as f:
+            f.write(b'data')
+    assert find_outputs(path) == [path + '.MGU']
+
+
+def test_write_atomic(tmp_path):
+    path = str(tmp_path / 'out.mid')
+    write_atomic(path, b'data')
+    write_atomic(path, b'new data')
+    with open(path, 'rb') as f:
+        assert f.read() == b'new data'
+    assert os.listdir(str(tmp_path)) == ['out.mid']
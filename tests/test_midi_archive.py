@@ -0,0 +1,150 @@
+import os
+import struct
+
+import pytest
+
+from pybiab.midi_archive import ArchiveEntry, MidiArchive, split_chunks
+
+
+def midi_bytes(*tracks):
+    data = b'MThd' + struct.pack('>Lhhh', 6, 1, len(tracks), 120)
+    for track in tracks:
+        data += b'MTrk' + struct.pack('>L', len(track)) + track
+    return data
+
+
+CONDUCTOR = b'\x00\xff\x51\x03\x07\xa1\x20\x00\xff\x2f\x00'
+
+
+def make_track(seed, length=200):
+    events = b''.join(bytes([0, 0x90, 36 + (seed + i) % 60, 100]) for i in range(length))
+    return events + b'\x00\xff\x2f\x00'
+
+
+def test_split_chunks():
+    data = midi_bytes(CONDUCTOR, make_track(1))
+    header, payloads = split_chunks(data)
+    assert header == data[:14] and len(payloads) == 2
+    assert header + b''.join(payloads) == data
+    # Anything else is a single payload
+    assert split_chunks(data + b'x') == (b'', [data + b'x'])
+    assert split_chunks(b'RIFF....') == (b'', [b'RIFF....'])
+
+
+def test_add_read_find(tmp_path):
+    path = str(tmp_path / 'archive')
+    files = {'a/x.mid': midi_bytes(CONDUCTOR, make_track(1)),
+             'a/y.mid': midi_bytes(CONDUCTOR, make_track(2)),
+             'b/x.wav': b'RIFF' + bytes(1000)}
+    archive = MidiArchive(path, 'a')
+    archive.add('a/x.mid', files['a/x.mid'], song='a.sgu', style='x.sty', key='C')
+    archive.add('a/y.mid', files['a/y.mid'], song='a.sgu', style='y.sty', key='C')
+    archive.add('b/x.wav', files['b/x.wav'], song='b.sgu', style='x.sty')
+    archive.close()
+
+    archive = MidiArchive(path)
+    assert len(archive) == 3 and 'a/x.mid' in archive and 'c.mid' not in archive
+    for name, data in files.items():
+        assert archive.read(name) == data
+    with pytest.raises(KeyError):
+        archive.read('c.mid')
+    assert archive.find(song='a.sgu') == [
+        ArchiveEntry('a/x.mid', 'a.sgu', 'x.sty', 'C', None, len(files['a/x.mid'])),
+        ArchiveEntry('a/y.mid', 'a.sgu', 'y.sty', 'C', None, len(files['a/y.mid']))]
+    assert [entry.name for entry in archive.find(style='x.sty')] == ['a/x.mid', 'b/x.wav']
+    assert archive.find(song='a.sgu', key='D') == []
+    # Opened for reading only
+    with pytest.raises(ValueError):
+        archive.add('c.mid', b'')
+    archive.close()
+
+
+def test_missing_archive(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        MidiArchive(str(tmp_path / 'missing'))
+    with pytest.raises(ValueError):
+        MidiArchive(str(tmp_path / 'missing'), 'w')
+
+
+def test_dedup(tmp_path):
+    archive = MidiArchive(str(tmp_path), 'a')
+    # The conductor track is shared by all files and the bass track by two of them
+    archive.add('1.mid', midi_bytes(CONDUCTOR, make_track(1), make_track(10)))
+    archive.add('2.mid', midi_bytes(CONDUCTOR, make_track(2), make_track(10)))
+    archive.add('3.mid', midi_bytes(CONDUCTOR, make_track(3)))
+    # Adding a file under an existing name replaces the entry
+    archive.add('3.mid', midi_bytes(CONDUCTOR, make_track(3)))
+    archive.commit()
+    stats = archive.stats()
+    assert stats['entries'] == 3 and stats['blobs'] == 5
+    # The tracks are compressible
+    assert stats['stored'] < stats['size']
+    archive.close()
+
+
+def test_iter_shard_rollover(tmp_path):
+    files = [('{}.mid'.format(i), midi_bytes(CONDUCTOR, make_track(i, length=100 + i)))
+             for i in range(10)]
+    archive = MidiArchive(str(tmp_path), 'a', shard_size=500, level=0)
+    for name, data in files:
+        archive.add(name, data)
+    archive.commit()
+    shards = archive.shards()
+    assert len(shards) > 2
+    assert all(os.path.exists(os.path.join(str(tmp_path), 'shard-{:05d}.pack'.format(shard)))
+               for shard in shards)
+
+    items = [(entry.name, data) for shard in shards for entry, data in archive.iter_shard(shard)]
+    assert items == files
+    assert [(entry.name, data) for entry, data in archive] == files
+    archive.close()
+
+
+def test_uncommitted_add_is_discarded(tmp_path):
+    path = str(tmp_path)
+    shard_path = os.path.join(path, 'shard-00000.pack')
+    archive = MidiArchive(path, 'a')
+    archive.add('1.mid', midi_bytes(CONDUCTOR, make_track(1)))
+    archive.commit()
+    committed_size = os.path.getsize(shard_path)
+
+    # Simulate a crash after the data of an addition was written, but before the commit
+    archive.add('2.mid', midi_bytes(CONDUCTOR, make_track(2)))
+    archive._writer.close()
+    archive._conn.close()
+    assert os.path.getsize(shard_path) > committed_size
+
+    archive = MidiArchive(path, 'a')
+    assert '2.mid' not in archive and len(archive) == 1
+    # The next transaction cuts off the data of the lost addition
+    data = midi_bytes(CONDUCTOR, make_track(3))
+    archive.add('3.mid', data)
+    archive.commit()
+    size, = archive._conn.execute('SELECT size FROM shards WHERE id = 0').fetchone()
+    assert os.path.getsize(shard_path) == size
+    assert [entry.name for entry, _ in archive.iter_shard(0)] == ['1.mid', '3.mid']
+    assert archive.read('3.mid') == data
+    archive.close()
+
+
+def test_extract(tmp_path):
+    archive = MidiArchive(str(tmp_path / 'archive'), 'a')
+    files = {'a/x.mid': midi_bytes(CONDUCTOR, make_track(1)),
+             'b/c/y.mid': midi_bytes(CONDUCTOR, make_track(2)),
+             'z.txt': b'text'}
+    for name, data in files.items():
+        archive.add(name, data)
+    archive.commit()
+
+    output_dir = tmp_path / 'all'
+    assert archive.extract(str(output_dir)) == 3
+    for name, data in files.items():
+        assert (output_dir / name).read_bytes() == data
+
+    output_dir = tmp_path / 'some'
+    assert archive.extract(str(output_dir), ['b/c/y.mid']) == 1
+    assert os.listdir(str(output_dir)) == ['b']
+    assert (output_dir / 'b' / 'c' / 'y.mid').read_bytes() == files['b/c/y.mid']
+    with pytest.raises(KeyError):
+        archive.extract(str(output_dir), ['missing.mid'])
+    archive.close()
@@ -0,0 +1,183 @@
+import struct
+
+import mido
+import pytest
+
+from pybiab.midi_utils import (TrackInfo, UnsupportedMidiError, fix_midi_bytes, fix_midi_file,
+                               fix_track, patch_mido)
+from pybiab.track_select import TrackSelector, parse_rule
+
+
+@pytest.fixture(autouse=True)
+def patched_mido():
+    patch_mido()
+
+
+def program(channel, program=5, time=0):
+    return mido.Message('program_change', channel=channel, program=program, time=time)
+
+
+def note(channel, note=60, time=0):
+    return mido.Message('note_on', channel=channel, note=note, velocity=100, time=time)
+
+
+def test_fix_track_removes_invalid_key_signatures():
+    track = mido.MidiTrack([mido.MetaMessage('key_signature', key=None),
+                            mido.MetaMessage('key_signature', key='Eb'),
+                            note(0),
+                            mido.MetaMessage('key_signature', key=None, time=10)])
+    expected = [track[1], track[2]]
+    assert fix_track(track) == TrackInfo([0], 2, True)
+    assert list(track) == expected
+
+
+def test_fix_track_duplicates_program_changes():
+    track = mido.MidiTrack([mido.MetaMessage('track_name', name='Bass'),
+                            program(1, time=3), note(1), note(3, time=4),
+                            mido.Message('control_change', channel=2, control=7, value=100),
+                            program(3, program=7)])
+    expected = [track[0],
+                track[1], program(2), program(3),
+                track[2], track[3], track[4],
+                track[5], program(1, program=7), program(2, program=7)]
+    assert fix_track(track) == TrackInfo([1, 2, 3], 0, True)
+    assert list(track) == expected
+
+
+def test_fix_track_unchanged():
+    # A program change is not duplicated if there is a single channel
+    messages = [program(4), note(4), mido.MetaMessage('key_signature', key='A')]
+    track = mido.MidiTrack(messages)
+    assert fix_track(track) == TrackInfo([4], 0, True)
+    assert list(track) == messages
+
+
+def test_fix_track_has_notes():
+    track = mido.MidiTrack([program(0), program(1),
+                            mido.Message('pitchwheel', channel=1, pitch=100)])
+    info = fix_track(track)
+    assert info.channels == [0, 1] and not info.has_notes
+    assert not fix_track(mido.MidiTrack()).has_notes
+    assert fix_track(mido.MidiTrack([mido.Message('note_off', channel=9, note=36)])).has_notes
+
+
+@pytest.mark.parametrize('engine', ['mido', 'raw'])
+def test_fix_midi_file_ignore_if_empty(engine, tmp_path):
+    midi_file = mido.MidiFile()
+    midi_file.add_track('Empty').extend([program(0), program(1)])
+    input_file, output_file = str(tmp_path / 'in.mid'), str(tmp_path / 'out.mid')
+    midi_file.save(input_file)
+    assert not fix_midi_file(input_file, output_file, ignore_if_empty=True, engine=engine)
+    assert not (tmp_path / 'out.mid').exists()
+    assert fix_midi_file(input_file, output_file, engine=engine)
+    assert len(mido.MidiFile(output_file).tracks[0]) == 6
+
+
+def track_chunk(*events):
+    data = b''.join(events)
+    return b'MTrk' + struct.pack('>L', len(data)) + data
+
+
+def midi_bytes(*tracks, midi_type=1):
+    return b'MThd' + struct.pack('>Lhhh', 6, midi_type, len(tracks), 120) + b''.join(tracks)
+
+
+END = b'\x00\xff\x2f\x00'
+CONDUCTOR = track_chunk(b'\x00\xff\x51\x03\x07\xa1\x20', b'\x00\xff\x58\x04\x04\x02\x18\x08',
+                        END)
+
+RAW_CASES = {
+    'running_status': midi_bytes(CONDUCTOR, track_chunk(
+        b'\x00\xff\x03\x04Bass',
+        b'\x00\xc0\x05',
+        b'\x00\x90\x3c\x64', b'\x10\x3c\x00',  # Running status after a program change
+        b'\x00\x91\x40\x64',
+        # The copy of this program change into channel 1 changes the running status of the next
+        b'\x00\xc0\x06', b'\x00\xc1\x07', b'\x00\x08',
+        b'\x00\xc1\x09', b'\x00\x90\x3c\x64',
+        b'\x05\x91\x40\x00',
+        END)),
+    'sysex_and_meta': midi_bytes(CONDUCTOR, track_chunk(
+        b'\x00\xf0\x04\x7e\x7f\x09\xf7',
+        b'\x00\xc2\x01', b'\x00\xf0\x03\x43\x10\xf7', b'\x00\xc2\x02',
+        b'\x00\xff\x01\x05hello',
+        b'\x04\xff\x60\x01\x00',  # Unknown meta message, read by mido with a delta time of 0
+        b'\x00\x92\x3c\x64',
+        b'\x03\xff\x2f\x00',  # end_of_track in the middle of the track
+        b'\x02\x92\x3c\x00',
+        b'\x81\x00\x92\x3e\x64',  # Non-canonical delta time
+        END)),
+    'invalid_key_signatures': midi_bytes(CONDUCTOR, track_chunk(
+        b'\x00\xff\x59\x02\x09\x00',
+        b'\x00\xff\x59\x02\xfd\x01',
+        b'\x07\xff\x59\x02\x00\x05',
+        b'\x00\x99\x24\x64', b'\x08\x24\x00',
+        END)),
+    'multi_channel': midi_bytes(CONDUCTOR, track_chunk(
+        b'\x00\xff\x03\x05Piano',
+        b'\x00\xc0\x00', b'\x00\xb0\x07\x64', b'\x00\xb3\x0a\x40',
+        b'\x00\x90\x3c\x64', b'\x00\x93\x40\x64', b'\x00\xe5\x00\x40',
+        b'\x30\x80\x3c\x40', b'\x00\x83\x40\x40',
+        b'\x00\xc3\x10', b'\x00\xc0\x11', b'\x00\xd0\x22',
+        END), track_chunk(b'\x00\xc1\x05', b'\x00\x91\x3c\x64', b'\x10\x3c\x00', END)),
+    'type_0': midi_bytes(track_chunk(
+        b'\x00\xff\x51\x03\x07\xa1\x20', b'\x00\xc0\x05', b'\x00\xc9\x00',
+        b'\x00\x90\x3c\x64', b'\x00\x99\x24\x64', b'\x08\x89\x24\x00', b'\x00\x80\x3c\x00',
+        END), midi_type=0),
+}
+
+
+def fix_with_both_engines(data, tmp_path, **kwargs):
+    input_file = str(tmp_path / 'in.mid')
+    with open(input_file, 'wb') as f:
+        f.write(data)
+    outputs = {}
+    for engine in ['mido', 'raw']:
+        output_file = str(tmp_path / (engine + '.mid'))
+        fix_midi_file(input_file, output_file, engine=engine, **kwargs)
+        with open(output_file, 'rb') as f:
+            outputs[engine] = f.read()
+    return outputs
+
+
+@pytest.mark.parametrize('case', sorted(RAW_CASES))
+def test_raw_engine_matches_mido(case, tmp_path, capsys):
+    data = RAW_CASES[case]
+    fix_midi_bytes(data)  # Supported, so the raw engine does not fall back to mido
+    outputs = fix_with_both_engines(data, tmp_path)
+    assert outputs['raw'] == outputs['mido']
+    assert 'Falling back' not in capsys.readouterr().err
+
+
+def test_raw_engine_matches_mido_with_selector(tmp_path):
+    selector = TrackSelector([parse_rule('remove channel 3')])
+    outputs = fix_with_both_engines(RAW_CASES['multi_channel'], tmp_path, selector=selector)
+    assert outputs['raw'] == outputs['mido']
+    assert len(mido.MidiFile(str(tmp_path / 'raw.mid')).tracks) == 2
+
+
+def test_raw_engine_falls_back_to_mido(tmp_path, capsys):
+    # mido reads a key signature of 3 bytes but writes it back with 2
+    data = midi_bytes(track_chunk(b'\x00\xff\x59\x03\x01\x00\x00', b'\x00\x90\x3c\x64', END))
+    with pytest.raises(UnsupportedMidiError):
+        fix_midi_bytes(data)
+    outputs = fix_with_both_engines(data, tmp_path)
+    assert 'Falling back to mido' in capsys.readouterr().err
+    assert outputs['raw'] == outputs['mido']
+
+
+@pytest.mark.parametrize('data', [b'', RAW_CASES['multi_channel'][:-10]],
+                         ids=['empty', 'truncated'])
+def test_raw_engine_unreadable(data, tmp_path, capsys):
+    if data:
+        with pytest.raises(UnsupportedMidiError):
+            fix_midi_bytes(data)
+    input_file = str(tmp_path / 'in.mid')
+    with open(input_file, 'wb') as f:
+        f.write(data)
+    # The raw engine falls back to mido, which fails like it does on its own
+    with pytest.raises(EOFError):
+        fix_midi_file(input_file, str(tmp_path / 'mido.mid'), engine='mido')
+    with pytest.raises(EOFError):
+        fix_midi_file(input_file, str(tmp_path / 'raw.mid'), engine='raw')
+    assert 'Falling back to mido' in capsys.readouterr().err
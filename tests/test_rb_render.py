@@ -0,0 +1,264 @@
+import os
+import shutil
+import sys
+
+import pytest
+
+from pybiab.job_ledger import JobLedger
+from pybiab.midi_archive import MidiArchive
+from pybiab.render_cache import RenderCache
+from pybiab.render_farm import DEFAULT_FORMAT, RenderJob, format_output_paths
+from pybiab.scripts import rb_render
+
+WAV_FORMAT = 'WAV File (*.WAV)'
+
+
+def make_job(output_dir, song='A.SGU', style='X.STY', key=None):
+    name = '{}.{}{}.mid'.format(song[:-4], style[:-4], '.' + key if key else '')
+    return RenderJob(song, style, key, os.path.join(output_dir, name))
+
+
+def touch(path, data=b'data'):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+@pytest.fixture
+def corpus(tmp_path, data_path):
+    """Create song and style directories with songs A and B and styles X and Y."""
+    song_dir, style_dir = tmp_path / 'songs', tmp_path / 'styles'
+    song_dir.mkdir()
+    style_dir.mkdir()
+    for song in ['A.SGU', 'B.SGU']:
+        shutil.copy(data_path('BLUES.SGU'), str(song_dir / song))
+    for style in ['X.STY', 'Y.STY']:
+        touch(str(style_dir / style), style.encode())
+    return tmp_path
+
+
+def run_main(monkeypatch, corpus, manifest, *options):
+    manifest_path = str(corpus / 'manifest.tsv')
+    with open(manifest_path, 'w', encoding='utf-8') as f:
+        f.writelines('\t'.join(fields) + '\n' for fields in manifest)
+    monkeypatch.setattr(sys, 'argv', [
+        'rb_render', str(corpus / 'songs'), str(corpus / 'styles'), str(corpus / 'out'),
+        manifest_path, '--simulate', '0', *options])
+    rb_render.main()
+
+
+def test_adopt_outputs(tmp_path):
+    output_dir = str(tmp_path)
+    formats = [DEFAULT_FORMAT, WAV_FORMAT]
+    jobs = [make_job(output_dir), make_job(output_dir, song='B.SGU')]
+    touch(jobs[0].output_path)
+    archive = MidiArchive(str(tmp_path / 'archive'), 'a')
+    archive.add('B.X.wav', b'wav')
+    archive.commit()
+    ledger = JobLedger(str(tmp_path / 'ledger.sqlite'))
+    ledger.add(key for job in jobs for key in rb_render.output_keys(job, formats))
+    adopted = rb_render.adopt_outputs(jobs, formats, output_dir, archive=archive, ledger=ledger)
+    assert adopted == {JobLedger.key(jobs[0].output_path),
+                       JobLedger.key(str(tmp_path / 'B.X.wav'))}
+    assert ledger.done() == adopted
+    ledger.close()
+    archive.close()
+    assert rb_render.adopt_outputs(jobs, formats, output_dir) == {
+        JobLedger.key(jobs[0].output_path)}
+
+
+def test_make_base_jobs(tmp_path):
+    output_dir = str(tmp_path)
+    jobs = [make_job(output_dir, key='D'), make_job(output_dir),
+            make_job(output_dir, song='B.SGU', key='E')]
+    base_jobs = rb_render.make_base_jobs(jobs, output_dir, suffix='v1')
+    assert base_jobs[('A.SGU', 'X.STY')] == jobs[1]
+    assert base_jobs[('B.SGU', 'X.STY')] == RenderJob(
+        'B.SGU', 'X.STY', None,
+        os.path.join(output_dir, rb_render.UNTRANSPOSED_DIR_NAME, 'B.X.v1.mid'))
+    assert len(base_jobs) == 2
+
+
+def test_plan_render_formats(tmp_path):
+    output_dir = str(tmp_path)
+    formats = [DEFAULT_FORMAT, WAV_FORMAT]
+    jobs = [make_job(output_dir), make_job(output_dir, song='B.SGU')]
+    # Only the MIDI output of the first job is done
+    done = {JobLedger.key(jobs[0].output_path)}
+    done |= set(rb_render.output_keys(jobs[1], formats))
+    run = rb_render.plan_render(jobs, formats, done)
+    assert run.jobs == [jobs[0]]
+    assert run.plan.existing == [jobs[1]]
+    assert run.derived == {} and run.ready == []
+
+
+def test_plan_render_transpositions(tmp_path):
+    output_dir = str(tmp_path)
+    jobs = [make_job(output_dir), make_job(output_dir, key='D'),
+            make_job(output_dir, song='B.SGU', key='E')]
+    base_jobs = rb_render.make_base_jobs(jobs, output_dir)
+    untransposed = base_jobs[('B.SGU', 'X.STY')]
+    run = rb_render.plan_render(jobs, [DEFAULT_FORMAT], {JobLedger.key(jobs[0].output_path)},
+                                base_jobs)
+    assert run.jobs == [untransposed]
+    assert run.ready == [jobs[0]]
+    assert run.derived == {jobs[0]: [jobs[1]], untransposed: [jobs[2]]}
+
+
+def test_lookup_cache(corpus):
+    output_dir = str(corpus / 'out')
+    os.mkdir(output_dir)
+    song_dir, style_dir = str(corpus / 'songs'), str(corpus / 'styles')
+    formats = [DEFAULT_FORMAT, WAV_FORMAT]
+    jobs = [make_job(output_dir), make_job(output_dir, style='Y.STY'),
+            make_job(output_dir, song='MISSING.SGU')]
+    cache = RenderCache(str(corpus / 'cache'))
+    hits, misses, cache_keys = rb_render.lookup_cache(cache, jobs, formats, song_dir,
+                                                      style_dir, 'v1')
+    assert hits == [] and misses == jobs
+    assert list(cache_keys) == jobs[:2]
+    assert [path for _, path in cache_keys[jobs[0]]] == [
+        path for _, path in format_output_paths(jobs[0].output_path, formats)]
+    for cache_key, path in cache_keys[jobs[0]]:
+        touch(path)
+        cache.store(cache_key, path)
+        os.remove(path)
+
+    hits, misses, cache_keys = rb_render.lookup_cache(cache, jobs, formats, song_dir,
+                                                      style_dir, 'v1')
+    assert hits == [jobs[0]] and misses == jobs[1:]
+    assert list(cache_keys) == [jobs[1]]
+    assert all(os.path.exists(path)
+               for _, path in format_output_paths(jobs[0].output_path, formats))
+    # The outputs of another RealBand version are not used
+    hits, _, _ = rb_render.lookup_cache(cache, jobs, formats, song_dir, style_dir, 'v2')
+    assert hits == []
+    cache.close()
+
+
+class FakePostProcessor:
+
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, path, name, **info):
+        self.submitted.append((path, name, info))
+
+
+def test_output_delivery(tmp_path):
+    output_dir = str(tmp_path / 'out')
+    os.mkdir(output_dir)
+    formats = [WAV_FORMAT, DEFAULT_FORMAT]
+    job = make_job(output_dir)._replace(output_path=os.path.join(output_dir, 'A.X.wav'))
+    for _, path in format_output_paths(job.output_path, formats):
+        touch(path)
+    post_processor = FakePostProcessor()
+    archive = MidiArchive(str(tmp_path / 'archive'), 'a')
+    delivery = rb_render.OutputDelivery(output_dir, formats, 'v1',
+                                        post_processor=post_processor, archive=archive)
+    delivery.deliver(job)
+    midi_path = os.path.join(output_dir, 'A.X.mid')
+    assert post_processor.submitted == [
+        (midi_path, 'A.X.mid', dict(song='A.SGU', style='X.STY', key=None, suffix='v1'))]
+    # The post-processor archives the MIDI output, the other outputs are moved there
+    assert [entry.name for entry in archive.entries()] == ['A.X.wav']
+    assert archive.read('A.X.wav') == b'data'
+    assert not os.path.exists(job.output_path) and os.path.exists(midi_path)
+    archive.close()
+
+
+def test_output_delivery_existing(tmp_path):
+    output_dir = str(tmp_path)
+    jobs = [make_job(output_dir), make_job(output_dir, song='B.SGU'),
+            make_job(output_dir, song='C.SGU')]
+    touch(jobs[0].output_path)
+    touch(jobs[1].output_path)
+    post_processor = FakePostProcessor()
+    rb_render.OutputDelivery(output_dir, [DEFAULT_FORMAT]).deliver_existing(jobs)
+    archive = MidiArchive(str(tmp_path / 'archive'), 'a')
+    archive.add('B.X.mid', b'data')
+    archive.commit()
+    delivery = rb_render.OutputDelivery(output_dir, [DEFAULT_FORMAT],
+                                        post_processor=post_processor, archive=archive)
+    delivery.deliver_existing(jobs)
+    archive.close()
+    assert [path for path, _, _ in post_processor.submitted] == [jobs[0].output_path]
+
+
+def test_output_delivery_requires_midi(tmp_path):
+    with pytest.raises(ValueError):
+        rb_render.OutputDelivery(str(tmp_path), [WAV_FORMAT], post_processor=FakePostProcessor())
+
+
+def test_collect_results(tmp_path):
+    output_dir = str(tmp_path)
+    base, other, untransposed, failed = [make_job(output_dir, song=song)
+                                         for song in ['A.SGU', 'B.SGU', 'C.SGU', 'D.SGU']]
+    derived = {base: [base._replace(key='D')], untransposed: [untransposed._replace(key='E')],
+               failed: [failed._replace(key='F')], other: [other._replace(key='G')]}
+    calls = []
+
+    def transpose(base_job, jobs):
+        calls.append(base_job)
+        for job in jobs:
+            yield job, 'done', None
+
+    results = [(base, 'done', None), (untransposed, 'done', None), (failed, 'failed', 'boom')]
+    collected = list(rb_render.collect_results(
+        results, {base, other, failed} | {job for jobs in derived.values() for job in jobs},
+        derived, [other], transpose))
+    assert calls == [other, base, untransposed]
+    assert collected == [
+        (derived[other][0], 'done', None),
+        (base, 'done', None), (derived[base][0], 'done', None),
+        # The untransposed job is not in the manifest
+        (derived[untransposed][0], 'done', None),
+        (failed, 'failed', 'boom'),
+        (derived[failed][0], 'failed', 'the original key failed to render')]
+
+
+def test_collect_results_stores(tmp_path):
+    output_dir = str(tmp_path)
+    jobs = [make_job(output_dir), make_job(output_dir, song='B.SGU')]
+    for job in jobs:
+        touch(job.output_path)
+    cache = RenderCache(str(tmp_path / 'cache'))
+    cache_keys = {job: [('key' + str(i), job.output_path)] for i, job in enumerate(jobs)}
+    results = [(jobs[0], 'done', None), (jobs[1], 'failed', 'boom')]
+    assert list(rb_render.collect_results(results, set(jobs), {}, [], None, cache,
+                                          cache_keys)) == results
+    assert cache.fetch('key0', str(tmp_path / 'copy.mid'))
+    assert not cache.fetch('key1', str(tmp_path / 'copy.mid'))
+    cache.close()
+
+
+def test_main(monkeypatch, capsys, corpus):
+    manifest = [('A.SGU', 'X.STY'), ('B.SGU', 'Y.STY'), ('MISSING.SGU', 'X.STY')]
+    run_main(monkeypatch, corpus, manifest, '--archive', str(corpus / 'archive'))
+    assert 'Rejected 1 lines' in capsys.readouterr().err
+    archive = MidiArchive(str(corpus / 'archive'))
+    assert sorted(entry.name for entry in archive.entries()) == ['A.X.mid', 'B.Y.mid']
+    archive.close()
+    assert not os.path.exists(str(corpus / 'out' / 'A.X.mid'))
+
+    run_main(monkeypatch, corpus, manifest, '--archive', str(corpus / 'archive'), '--plan-only')
+    captured = capsys.readouterr()
+    assert captured.out == ''
+    assert '2 jobs already done' in captured.err
+
+
+def test_main_offline_transpose(monkeypatch, capsys, corpus):
+    manifest = [('A.SGU', 'X.STY', 'D'), ('A.SGU', 'X.STY', 'E'), ('B.SGU', 'Y.STY')]
+    run_main(monkeypatch, corpus, manifest, '--offline-transpose', '--cache',
+             str(corpus / 'cache'))
+    err = capsys.readouterr().err
+    assert '2 jobs to derive by transposition' in err
+    assert sorted(os.listdir(str(corpus / 'out'))) == sorted([
+        rb_render.LEDGER_NAME, rb_render.TIMEOUTS_NAME, rb_render.UNTRANSPOSED_DIR_NAME,
+        'A.X.D.mid', 'A.X.E.mid', 'B.Y.mid'])
+
+    # Render everything again from the cache
+    shutil.rmtree(str(corpus / 'out'))
+    run_main(monkeypatch, corpus, manifest, '--offline-transpose', '--cache',
+             str(corpus / 'cache'))
+    assert '2 cache hits, 0 jobs left to render' in capsys.readouterr().err
+    assert os.path.exists(str(corpus / 'out' / 'A.X.E.mid'))
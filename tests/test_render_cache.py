@@ -0,0 +1,123 @@
+import os
+
+import pytest
+
+from pybiab.render_cache import RenderCache, parse_size
+
+
+def write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+@pytest.fixture
+def song_and_style(tmp_path):
+    song_path, style_path = str(tmp_path / 'A.SGU'), str(tmp_path / 'X.STY')
+    write(song_path, b'song')
+    write(style_path, b'style')
+    return song_path, style_path
+
+
+def test_job_key(tmp_path, song_and_style):
+    song_path, style_path = song_and_style
+    cache = RenderCache(str(tmp_path / 'cache'))
+    key = cache.job_key(song_path, style_path, None, 'MIDI', 'v1')
+    assert cache.job_key(song_path, style_path, None, 'MIDI', 'v1') == key
+    # The key depends on the contents of the files, not on their paths
+    copy_path = str(tmp_path / 'B.SGU')
+    write(copy_path, b'song')
+    assert cache.job_key(copy_path, style_path, None, 'MIDI', 'v1') == key
+    assert len({key, cache.job_key(song_path, style_path, 'D', 'MIDI', 'v1'),
+                cache.job_key(song_path, style_path, None, 'WAV', 'v1'),
+                cache.job_key(song_path, style_path, None, 'MIDI', 'v2'),
+                cache.job_key(style_path, song_path, None, 'MIDI', 'v1')}) == 5
+    # A changed file is read again
+    write(song_path, b'new song')
+    os.utime(song_path, ns=(0, 0))
+    assert cache.job_key(song_path, style_path, None, 'MIDI', 'v1') != key
+    cache.close()
+
+
+def test_fetch_and_store(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    output_path = str(tmp_path / 'out' / 'A.X.mid')
+    cache = RenderCache(cache_dir)
+    assert not cache.fetch('key', output_path)
+    assert not os.path.exists(output_path)
+
+    rendered_path = str(tmp_path / 'rendered.mid')
+    write(rendered_path, b'midi')
+    cache.store('key', rendered_path)
+    cache.close()
+
+    cache = RenderCache(cache_dir)
+    assert cache.fetch('key', output_path)
+    assert read(output_path) == b'midi'
+    assert cache.fetch('key', output_path)
+    stats = cache.stats()
+    assert stats['entries'] == 1 and stats['size'] == 4
+    assert (stats['hits'], stats['misses'], stats['stores']) == (2, 1, 1)
+    assert stats['hit_rate'] == 2 / 3
+    cache.close()
+
+
+def test_fetch_deleted_object(tmp_path):
+    rendered_path = str(tmp_path / 'rendered.mid')
+    write(rendered_path, b'midi')
+    cache = RenderCache(str(tmp_path / 'cache'))
+    cache.store('key', rendered_path)
+    os.remove(cache._object_path('key'))
+    output_path = str(tmp_path / 'A.X.mid')
+    assert not cache.fetch('key', output_path)
+    assert not os.path.exists(output_path)
+    # The entry is gone
+    assert cache.stats()['entries'] == 0 and cache.size() == 0
+    cache.close()
+
+
+def test_evict(tmp_path, monkeypatch):
+    now = [1000.]
+    monkeypatch.setattr('pybiab.render_cache.time.time', lambda: now[0])
+    cache = RenderCache(str(tmp_path / 'cache'))
+    for name in ['a', 'b', 'c', 'd']:
+        path = str(tmp_path / name)
+        write(path, b'x' * 10)
+        cache.store(name, path)
+        now[0] += 1
+    # Use 'a', so that 'b' is the least recently used
+    assert cache.fetch('a', str(tmp_path / 'fetched'))
+    assert cache.size() == 40
+
+    assert cache.evict(25) == 2
+    assert cache.size() == 20
+    assert cache.evict(25) == 0
+    for name, found in [('a', True), ('b', False), ('c', False), ('d', True)]:
+        assert cache.fetch(name, str(tmp_path / 'fetched')) == found
+        assert os.path.exists(cache._object_path(name)) == found
+    assert cache.stats()['evictions'] == 2
+    cache.close()
+
+
+def test_max_size(tmp_path):
+    cache = RenderCache(str(tmp_path / 'cache'), max_size=25)
+    for name in ['a', 'b', 'c']:
+        path = str(tmp_path / name)
+        write(path, b'x' * 10)
+        cache.store(name, path)
+    assert cache.size() <= 25
+    assert cache.stats()['entries'] == 2
+    cache.close()
+
+
+def test_parse_size():
+    assert parse_size('1000') == 1000
+    assert parse_size('2K') == 2048
+    assert parse_size('1.5mb') == 3 * 512 * 1024
+    assert parse_size(' 1G ') == 1024 ** 3
+    with pytest.raises(ValueError):
+        parse_size('lots')
@@ -0,0 +1,99 @@
+import functools
+import os
+
+from pybiab.instrumentation import RunLog
+from pybiab.readiness import TimeoutPolicy
+from pybiab.render_farm import RenderJob, group_by_song, render_parallel, render_serial
+from pybiab.simulated_controller import SimulatedController, SimulatedFailure
+
+
+def make_jobs(output_dir, pairs):
+    return [RenderJob(song, style, None, os.path.join(output_dir, '{}.{}.mid'.format(song, style)))
+            for song, style in pairs]
+
+
+class CrashingController(SimulatedController):
+    """Crashes the first time the `crash` style is loaded by any process, using a marker file."""
+
+    def __init__(self, marker, **kwargs):
+        super().__init__(**kwargs)
+        self._marker = marker
+
+    def load_style(self, path):
+        if os.path.basename(path) == 'crash' and not os.path.exists(self._marker):
+            open(self._marker, 'w').close()
+            self.kill()
+            raise SimulatedFailure('load_style failed')
+        super().load_style(path)
+
+
+class DyingController(CrashingController):
+    """Like `CrashingController`, but cannot be restarted after the crash."""
+
+    def __init__(self, marker, try_connect=True, **kwargs):
+        if not try_connect and os.path.exists(marker):
+            raise SimulatedFailure('start failed')
+        super().__init__(marker, try_connect=try_connect, **kwargs)
+
+
+def test_group_by_song(tmp_path):
+    jobs = make_jobs(str(tmp_path), [('a', 'x'), ('b', 'x'), ('a', 'y'), ('c', 'x'), ('b', 'y')])
+    assert group_by_song(jobs) == [[jobs[0], jobs[2]], [jobs[1], jobs[4]], [jobs[3]]]
+    assert group_by_song([]) == []
+
+
+def test_render_serial(tmp_path):
+    jobs = make_jobs(str(tmp_path), [('a', 'x'), ('a', 'y'), ('b', 'x')])
+    factory = functools.partial(SimulatedController, time_scale=0.)
+    results = list(render_serial(jobs, factory, song_dir='songs', style_dir='styles'))
+    assert results == [(job, 'done', None) for job in jobs]
+    assert all(os.path.exists(job.output_path) for job in jobs)
+
+
+def test_render_parallel(tmp_path):
+    jobs = make_jobs(str(tmp_path), [(song, style) for song in 'abcd' for style in 'xy'])
+    factories = [functools.partial(SimulatedController, time_scale=0.)] * 2
+    results = list(render_parallel(jobs, factories, song_dir='songs', style_dir='styles'))
+    assert sorted(results) == sorted((job, 'done', None) for job in jobs)
+    assert all(os.path.exists(job.output_path) for job in jobs)
+
+
+def test_render_parallel_failed_job(tmp_path):
+    jobs = make_jobs(str(tmp_path / 'out'), [('a', 'x'), ('a', 'crash'), ('a', 'y'), ('b', 'x')])
+    # The worker restarts its controller after a failed job and goes on with the next one
+    factories = [functools.partial(CrashingController, str(tmp_path / 'crashed'),
+                                   time_scale=0.)]
+    log = RunLog()
+    results = list(render_parallel(jobs, factories, log=log, song_dir='songs',
+                                   style_dir='styles', timeouts=TimeoutPolicy(num_trials=1)))
+    assert [(job, status) for job, status, _ in results] == [
+        (jobs[0], 'done'), (jobs[1], 'failed'), (jobs[2], 'done'), (jobs[3], 'done')]
+    assert results[1][2] == 'SimulatedFailure: load_style failed'
+    assert not os.path.exists(jobs[1].output_path)
+    assert log.summary.restarts == 1
+
+
+def test_render_parallel_hand_over(tmp_path):
+    output_dir = str(tmp_path / 'out')
+    jobs = make_jobs(output_dir, [('a', 'x'), ('a', 'crash'), ('a', 'y'), ('b', 'x')])
+    # The worker which gets song a cannot restart its controller after the crash style, so it
+    # dies and the job after it is handed over to the other worker
+    factories = [functools.partial(DyingController, str(tmp_path / 'crashed'),
+                                   time_scale=0.)] * 2
+    results = list(render_parallel(jobs, factories, song_dir='songs', style_dir='styles',
+                                   timeouts=TimeoutPolicy(num_trials=1)))
+    statuses = {job: status for job, status, _ in results}
+    assert len(results) == len(jobs)
+    assert statuses == {jobs[0]: 'done', jobs[1]: 'failed', jobs[2]: 'done', jobs[3]: 'done'}
+    assert [error for job, _, error in results if job == jobs[1]] == [
+        'SimulatedFailure: load_style failed']
+
+
+def test_render_parallel_no_workers_left(tmp_path):
+    jobs = make_jobs(str(tmp_path / 'out'), [('a', 'crash'), ('a', 'x'), ('b', 'x')])
+    factories = [functools.partial(DyingController, str(tmp_path / 'crashed'), time_scale=0.)]
+    results = list(render_parallel(jobs, factories, song_dir='songs', style_dir='styles',
+                                   timeouts=TimeoutPolicy(num_trials=1)))
+    assert [(job, status) for job, status, _ in results] == [
+        (jobs[0], 'failed'), (jobs[1], 'failed'), (jobs[2], 'failed')]
+    assert [error for _, _, error in results[1:]] == ['no workers left'] * 2
@@ -0,0 +1,54 @@
+import functools
+import os
+
+from pybiab.controller import RenderController
+from pybiab.instrumentation import RunLog
+from pybiab.job_ledger import JobLedger
+from pybiab.render_farm import RenderJob, render_serial
+from pybiab.render_plan import LoadCounts, count_loads, plan_jobs
+from pybiab.simulated_controller import SimulatedController
+
+PAIRS = [('a', 'x'), ('b', 'x'), ('a', 'y'), ('a', 'x'), ('b', 'y'), ('c', 'x'), ('b', 'x')]
+
+
+def make_jobs(output_dir, pairs=PAIRS):
+    # The jobs differ in their key, so that the same song and style can be repeated
+    return [RenderJob(song, style, RenderController.KEYS[i],
+                      os.path.join(output_dir, '{}.{}.{}.mid'.format(song, style, i)))
+            for i, (song, style) in enumerate(pairs)]
+
+
+def test_plan_jobs(tmp_path):
+    jobs = make_jobs(str(tmp_path))
+    plan = plan_jobs(jobs)
+    assert [(job.song, job.style) for job in plan.jobs] == [
+        ('a', 'x'), ('a', 'x'), ('a', 'y'), ('b', 'x'), ('b', 'x'), ('b', 'y'), ('c', 'x')]
+    assert sorted(plan.jobs) == sorted(jobs)
+    assert plan.existing == [] and plan.duplicates == []
+    assert count_loads(jobs) == LoadCounts(songs=6, styles=7)
+    assert count_loads(plan.jobs) == LoadCounts(songs=3, styles=5)
+
+
+def test_plan_jobs_existing_and_duplicates(tmp_path):
+    jobs = make_jobs(str(tmp_path))
+    open(jobs[1].output_path, 'w').close()
+    jobs.append(jobs[0]._replace(key='other'))
+    plan = plan_jobs(jobs)
+    assert plan.existing == [jobs[1]]
+    assert plan.duplicates == [jobs[-1]]
+    assert jobs[1] not in plan.jobs and len(plan.jobs) == len(PAIRS) - 1
+
+    # The ledger keys replace the check for existing outputs
+    plan = plan_jobs(jobs, done={JobLedger.key(jobs[2].output_path)})
+    assert plan.existing == [jobs[2]]
+    assert len(plan_jobs(jobs, skip_existing=False).jobs) == len(PAIRS)
+
+
+def test_count_loads_matches_renderer(tmp_path):
+    factory = functools.partial(SimulatedController, time_scale=0.)
+    for jobs in [make_jobs(str(tmp_path)), plan_jobs(make_jobs(str(tmp_path))).jobs]:
+        log = RunLog()
+        for _ in render_serial(jobs, factory, song_dir='songs', style_dir='styles', log=log):
+            pass
+        counts = log.summary.counts
+        assert count_loads(jobs) == LoadCounts(counts['load_song'], counts['load_style'])
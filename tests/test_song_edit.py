@@ -0,0 +1,43 @@
+import os
+
+import pytest
+
+from pybiab.song_edit import EditJob, edit_song_files, parse_step
+
+EDITS = [
+    ('BLUES.SGU', ['tempo=140'], 'BLUES_tempo=140.SGU'),
+    ('BLUES.SGU', ['length=24'], 'BLUES_length=24.SGU'),
+    ('BLUES.SGU', ['substyle=5'], 'BLUES_substyle=5.SGU'),
+    ('BLUES.SGU', ['substyle=9'], 'BLUES_substyle=9.SGU'),
+    ('BALLAD.MGU', ['tempo=80', 'length=16', 'substyle=17'], 'BALLAD_all.MGU'),
+]
+
+
+@pytest.mark.parametrize('name, steps, expected', EDITS)
+def test_edit_song_files(name, steps, expected, data_path, tmp_path):
+    job = EditJob(data_path(name), str(tmp_path / 'edited'))
+    results = list(edit_song_files([job], [parse_step(step) for step in steps]))
+    assert results == [(job, 'done', None)]
+
+    # The output gets the extension of the input
+    ext = os.path.splitext(name)[1]
+    assert os.listdir(str(tmp_path)) == ['edited' + ext]
+    with open(job.output_path + ext, 'rb') as f, open(data_path(expected), 'rb') as f_expected:
+        assert f.read() == f_expected.read()
+
+
+def test_edit_song_files_failure(data_path, tmp_path):
+    bad_path = tmp_path / 'BAD.SGU'
+    bad_path.write_bytes(b'\xbb\x05ab')
+    jobs = [EditJob(str(bad_path), str(tmp_path / 'bad')),
+            EditJob(data_path('BLUES.SGU'), str(tmp_path / 'good'))]
+    results = list(edit_song_files(jobs, [parse_step('tempo=100')]))
+    assert [status for _, status, _ in results] == ['failed', 'done']
+    assert results[0][2].startswith('SongFileError')
+    assert sorted(os.listdir(str(tmp_path))) == ['BAD.SGU', 'good.SGU']
+
+
+def test_edit_song_files_unsupported(data_path, tmp_path):
+    job = EditJob(data_path('BLUES.SGU'), str(tmp_path / 'edited'))
+    with pytest.raises(ValueError):
+        list(edit_song_files([job], [parse_step('ending=on')]))
@@ -0,0 +1,115 @@
+import pytest
+
+from pybiab.song_file import (SongFile, SongFileError, SongInfo, parse_song_info,
+                               read_song_info)
+
+SONGS = ['BLUES.SGU', 'BALLAD.MGU', 'BUILTIN.SGU']
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+@pytest.mark.parametrize('name', SONGS)
+def test_round_trip(name, data_path, tmp_path):
+    data = read(data_path(name))
+    song = SongFile(data)
+    assert song.to_bytes() == data
+    song.write(str(tmp_path / name))
+    assert read(str(tmp_path / name)) == data
+
+
+@pytest.mark.parametrize('name', SONGS)
+def test_unchanged_substyle_round_trip(name, data_path):
+    # Setting the substyle in effect re-encodes the markers, which must give the same bytes
+    data = read(data_path(name))
+    song = SongFile(data)
+    song.set_substyle(1, song.substyle(1))
+    assert song.to_bytes() == data
+
+
+def test_tempo(data_path):
+    song = SongFile.read(data_path('BLUES.SGU'))
+    assert song.tempo == 120
+    song.tempo = 140
+    assert song.to_bytes() == read(data_path('BLUES_tempo=140.SGU'))
+
+
+def test_last_bar(data_path):
+    song = SongFile.read(data_path('BLUES.SGU'))
+    assert song.last_bar == 12
+    song.last_bar = 24
+    assert song.to_bytes() == read(data_path('BLUES_length=24.SGU'))
+
+
+@pytest.mark.parametrize('bar, substyle, name', [
+    (5, 'b', 'BLUES_substyle=5.SGU'),
+    (9, 'a', 'BLUES_substyle=9.SGU'),
+])
+def test_toggle_substyle(bar, substyle, name, data_path):
+    song = SongFile.read(data_path('BLUES.SGU'))
+    song.toggle_substyle(bar)
+    assert song.substyle(bar) == substyle
+    assert song.to_bytes() == read(data_path(name))
+
+
+def test_substyle(data_path):
+    song = SongFile.read(data_path('BLUES.SGU'))
+    assert [song.substyle(bar) for bar in [1, 8, 9, 12]] == ['a', 'a', 'b', 'b']
+
+
+@pytest.mark.parametrize('attr, value', [('tempo', 0), ('tempo', 1001), ('last_bar', 0),
+                                         ('last_bar', 256)])
+def test_invalid_values(attr, value, data_path):
+    song = SongFile.read(data_path('BLUES.SGU'))
+    with pytest.raises(ValueError):
+        setattr(song, attr, value)
+
+
+def test_invalid_substyle(data_path):
+    song = SongFile.read(data_path('BLUES.SGU'))
+    with pytest.raises(ValueError):
+        song.set_substyle(5, 'c')
+
+
+@pytest.mark.parametrize('size', [0, 1, 10, 50])
+def test_truncated(size, data_path):
+    with pytest.raises(SongFileError):
+        SongFile(read(data_path('BLUES.SGU'))[:size])
+
+
+@pytest.mark.parametrize('name, info', [
+    ('BLUES.SGU', SongInfo(title='Blues in F', key='F', tempo=120, style='ZZJAZZ.STY',
+                           style_number=0, num_bars=12)),
+    ('BALLAD.MGU', SongInfo(title='Ballad', key='Am', tempo=72, style='JAZBALAD.STY',
+                            style_number=0, num_bars=32)),
+    # No last bar of the chorus, so the number of bars is that of the last chord
+    ('BUILTIN.SGU', SongInfo(title='Built-in', key='C', tempo=140, style=None, style_number=3,
+                             num_bars=8)),
+    ('BLUES_tempo=140.SGU', SongInfo(title='Blues in F', key='F', tempo=140, style='ZZJAZZ.STY',
+                                     style_number=0, num_bars=12)),
+])
+def test_parse_song_info(name, info, data_path):
+    assert parse_song_info(read(data_path(name))) == info
+    assert read_song_info(data_path(name)) == info
+    assert SongFile.read(data_path(name)).info == info
+
+
+@pytest.mark.parametrize('offset, value', [
+    (15, 0),  # Key number
+    (15, 35),
+    (16, 0),  # Tempo
+])
+def test_parse_song_info_invalid(offset, value, data_path):
+    data = bytearray(read(data_path('BLUES.SGU')))
+    data[offset] = value
+    if offset == 16:
+        data[offset + 1] = 0
+    with pytest.raises(SongFileError):
+        parse_song_info(bytes(data))
+
+
+def test_parse_song_info_invalid_title():
+    with pytest.raises(SongFileError):
+        parse_song_info(b'\xbb\x03a\x00b' + bytes(600))
@@ -0,0 +1,134 @@
+import collections
+import struct
+
+import mido
+import pytest
+
+from pybiab.midi_utils import fix_midi_file
+from pybiab.track_select import TrackSelector, _parse_numbers, parse_rule, read_rules
+
+
+def test_parse_numbers():
+    assert _parse_numbers('0-3, 7,9-9', 'channel') == frozenset([0, 1, 2, 3, 7, 9])
+    assert _parse_numbers('127', 'program') == frozenset([127])
+
+
+@pytest.mark.parametrize('value, field, message', [
+    ('16', 'channel', "channel '16' is out of range 0-15"),
+    ('120-128', 'program', "program '120-128' is out of range 0-127"),
+    ('5-3', 'channel', "channel '5-3' is out of range 0-15"),
+    ('x', 'channel', "invalid channel 'x'"),
+    ('1-x', 'program', "invalid program '1-x'"),
+])
+def test_parse_numbers_invalid(value, field, message):
+    with pytest.raises(ValueError) as e:
+        _parse_numbers(value, field)
+    assert str(e.value) == message
+
+
+def test_parse_rule():
+    rule = parse_rule('  remove name-re  ^Drums? (kit)$')
+    assert (rule.action, rule.field, rule.value.pattern) == ('remove', 'name-re', '^Drums? (kit)$')
+    assert rule.text == 'remove name-re  ^Drums? (kit)$'
+    for text in ['keep name', 'drop name Bass', 'keep color red', 'keep name-re (']:
+        with pytest.raises(ValueError):
+            parse_rule(text)
+
+
+def test_read_rules(tmp_path):
+    path = tmp_path / 'rules.txt'
+    path.write_text('# Drop the drums\n\nremove channel 9  # GM drums\nkeep name Bass\n')
+    rules = read_rules(str(path))
+    assert [rule.text for rule in rules] == ['remove channel 9', 'keep name Bass']
+
+    path.write_text('keep name Bass\n# comment\nkeep program 200\n')
+    with pytest.raises(ValueError) as e:
+        read_rules(str(path))
+    assert str(e.value) == "{}:3: program '200' is out of range 0-127".format(path)
+
+
+def test_select_remove_wins_over_keep():
+    selector = TrackSelector([parse_rule('keep name-re ^B'), parse_rule('remove channel 9')])
+    assert selector.select('Bass', channels=[1]) == (True, (0,))
+    assert selector.select('Bongos', channels=[9]) == (False, (0, 1))
+    # With keep rules, tracks matching none of them are removed
+    assert selector.select('Piano', channels=[0]) == (False, ())
+    assert TrackSelector().select('Piano') == (True, ())
+
+
+def test_select_conductor():
+    selector = TrackSelector([parse_rule('keep name Bass')])
+    # The tempo track is not removed for failing to match a keep rule...
+    assert selector.select('', conductor=True) == (True, ())
+    assert selector.select('', conductor=False) == (False, ())
+    # ...but a remove rule removes it
+    selector = TrackSelector([parse_rule('keep name Bass'), parse_rule('remove name-re ^$')])
+    assert selector.select('', conductor=True) == (False, (1,))
+
+
+def test_select_programs_and_counts():
+    selector = TrackSelector([parse_rule('remove program 0-7'), parse_rule('keep channel 0-8')])
+    assert selector.needs_messages
+    counts = collections.Counter()
+    for programs in [[0], [40], [3, 40]]:
+        keep, matched = selector.select('Track', channels=[0], programs=programs)
+        selector.count_matches(counts, matched)
+    assert counts == {'remove program 0-7': 2, 'keep channel 0-8': 3}
+
+
+def test_from_args(tmp_path):
+    path = tmp_path / 'rules.txt'
+    path.write_text('keep name-re .\n')
+    selector = TrackSelector.from_args(rules=['remove channel 9'], rules_files=[str(path)],
+                                       remove_re=['^Str'], remove=['Lead  Guitar '])
+    assert [rule.text for rule in selector.rules] == [
+        'keep name-re .', 'remove channel 9', 'remove name-re ^Str', 'remove name Lead  Guitar ']
+    # The names are kept exactly as given
+    assert selector.rules[-1].value == 'Lead  Guitar '
+    with pytest.raises(ValueError):
+        TrackSelector.from_args(remove_re=['('])
+
+
+def make_midi_file(path, names, key_signature=None):
+    """Save a type 1 file with a tempo track and a track with a note for each name, adding the
+    raw bytes of a key signature to the last track if given."""
+    tracks = [b'\x00\xff\x51\x03\x07\xa1\x20']
+    for channel, name in enumerate(names):
+        tracks.append(b'\x00\xff\x03' + bytes([len(name)]) + name.encode()
+                      + bytes([0, 0x90 | channel, 60, 100]))
+    if key_signature is not None:
+        tracks[-1] += b'\x00\xff\x59' + key_signature
+    with open(path, 'wb') as f:
+        f.write(b'MThd' + struct.pack('>Lhhh', 6, 1, len(tracks), 120))
+        for data in tracks:
+            data += b'\x00\xff\x2f\x00'
+            f.write(b'MTrk' + struct.pack('>L', len(data)) + data)
+
+
+def track_names(path):
+    return [track.name for track in mido.MidiFile(path).tracks]
+
+
+@pytest.mark.parametrize('engine', ['mido', 'raw'])
+def test_fix_midi_file_remove(engine, tmp_path):
+    input_file, output_file = str(tmp_path / 'in.mid'), str(tmp_path / 'out.mid')
+    make_midi_file(input_file, ['Bass', 'Strings 1', 'Strings 2', 'Piano'])
+    selector = TrackSelector([parse_rule('remove name Piano')])
+    counts = collections.Counter()
+    fix_midi_file(input_file, output_file, remove_re=['^Str'], remove=['Bass'], engine=engine,
+                  selector=selector, rule_counts=counts)
+    assert track_names(output_file) == ['']
+    assert counts == {'remove name Piano': 1, 'remove name-re ^Str': 2, 'remove name Bass': 1}
+
+
+def test_fix_midi_file_rule_counts_on_fallback(tmp_path, capsys):
+    # The raw engine selects the tracks, then gives up on the key signature of 3 bytes in the
+    # kept track
+    input_file, output_file = str(tmp_path / 'in.mid'), str(tmp_path / 'out.mid')
+    make_midi_file(input_file, ['Bass', 'Piano', 'Strings'], key_signature=b'\x03\x01\x00\x00')
+    counts = collections.Counter()
+    fix_midi_file(input_file, output_file, remove=['Bass', 'Piano'], engine='raw',
+                  rule_counts=counts)
+    assert 'Falling back to mido' in capsys.readouterr().err
+    assert track_names(output_file) == ['', 'Strings']
+    assert counts == {'remove name Bass': 1, 'remove name Piano': 1}